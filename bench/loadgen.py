@@ -0,0 +1,404 @@
+"""网关基准测试负载生成器
+
+默认会启动本地模拟上游 (mock_upstream.py) 和一个指向它的网关进程，依次运行各个负载，
+输出吞吐量、首 token 延迟 (TTFT)、p50/p99 延迟、每连接内存与每 token CPU 时间，
+并将结果保存到 bench/results/，便于在不同提交之间比较。
+
+用法:
+  python bench/loadgen.py                                   # 运行全部负载
+  python bench/loadgen.py --workloads text,multiturn -c 64 -d 20
+  python bench/loadgen.py --gateway http://127.0.0.1:8000   # 对已运行的网关发压 (不统计 CPU/内存)
+  python bench/loadgen.py --compare <提交A> <提交B>          # 比较两个提交的最近一次结果
+
+CPU 与内存统计读取 /proc，仅支持 Linux。
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = ROOT / "bench" / "results"
+WORKLOADS = ["text", "multiturn", "multiimage", "imagegen"]
+
+# ---------- 进程资源统计 (/proc) ----------
+
+def _children(pid: int) -> List[int]:
+    result = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            result.append(int(entry))
+    return result
+
+def process_tree(pid: int) -> List[int]:
+    """pid 及其所有子进程 (多 worker 时 uvicorn 的 worker 为子进程)"""
+    pids, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        pids.append(p)
+        stack.extend(_children(p))
+    return pids
+
+def cpu_seconds(pid: int) -> float:
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])  # utime + stime
+        except OSError:
+            pass
+    return total / ticks
+
+def rss_bytes(pid: int) -> int:
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+# ---------- 启动模拟上游与网关 ----------
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_http(url: str, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"等待服务启动超时: {url}")
+
+class Stack:
+    """启动模拟上游与网关子进程，退出时一并关闭"""
+
+    def __init__(self, args):
+        self.args = args
+        self.procs: List[subprocess.Popen] = []
+        self.tmp = tempfile.TemporaryDirectory(prefix="gemini-bench-")
+        self.gateway_pid: Optional[int] = None
+
+    def __enter__(self) -> str:
+        args = self.args
+        upstream_port, gateway_port = free_port(), free_port()
+        mock_cmd = [sys.executable, str(ROOT / "bench" / "mock_upstream.py"), "--port", str(upstream_port),
+                    "--ttft", str(args.ttft), "--chunks", str(args.chunks), "--chunk-delay", str(args.chunk_delay),
+                    "--slow-rate", str(args.slow_rate), "--slow-delay", str(args.slow_delay)]
+        self.procs.append(subprocess.Popen(mock_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        wait_http(f"http://127.0.0.1:{upstream_port}/_mock/stats")
+
+        upstream = f"http://127.0.0.1:{upstream_port}"
+        app_config = {
+            "proxy": "",
+            "host": "127.0.0.1",
+            "port": gateway_port,
+            "base_url": f"http://127.0.0.1:{gateway_port}",
+            "upstream_api_base": upstream,
+            "upstream_auth_base": upstream,
+            "log_level": "WARNING",
+            "image_save_dir": str(Path(self.tmp.name) / "images"),
+            "state_db_path": str(Path(self.tmp.name) / "state.db"),
+            "state_snapshot_path": str(Path(self.tmp.name) / "snapshot.db"),
+        }
+        app_config.update(json.loads(args.gateway_config or "{}"))
+        accounts = {"accounts": [
+            {"name": f"bench{i}", "config_id": "bench", "cookies": "__Secure-C_SES=bench; __Host-C_OSES=bench",
+             "csesidx": str(1000 + i), "project_id": "mock"}
+            for i in range(args.accounts)
+        ]}
+        app_path, accounts_path = Path(self.tmp.name) / "app.json", Path(self.tmp.name) / "accounts.json"
+        app_path.write_text(json.dumps(app_config))
+        accounts_path.write_text(json.dumps(accounts))
+        self.env = dict(os.environ, GEMINI_APP_CONFIG=str(app_path), GEMINI_ACCOUNTS_CONFIG=str(accounts_path))
+        self.gateway_url = f"http://127.0.0.1:{gateway_port}"
+        self.start_gateway()
+        return self.gateway_url
+
+    def start_gateway(self) -> None:
+        gateway_cmd = [sys.executable, str(ROOT / "src" / "gemini.py"), "--workers", str(self.args.workers)]
+        log = open(Path(self.tmp.name) / "gateway.log", "a")
+        gateway = subprocess.Popen(gateway_cmd, cwd=ROOT, env=self.env, stdout=log, stderr=subprocess.STDOUT)
+        self.procs.append(gateway)
+        self.gateway_pid = gateway.pid
+        wait_http(f"{self.gateway_url}/v1/models")
+        # 等待 Session 预热与 JWT 获取完成，避免计入首批请求
+        time.sleep(1.0)
+
+    def restart_gateway(self) -> None:
+        """正常关闭网关 (SIGINT) 后以相同配置重新启动"""
+        gateway = self.procs.pop()
+        gateway.send_signal(signal.SIGINT)
+        try:
+            gateway.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            gateway.kill()
+        self.start_gateway()
+
+    def __exit__(self, *exc) -> None:
+        for proc in reversed(self.procs):
+            proc.send_signal(signal.SIGINT)
+        for proc in reversed(self.procs):
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        self.tmp.cleanup()
+
+# ---------- 负载 ----------
+
+def make_image(size: int) -> str:
+    data = b"\x89PNG\r\n\x1a\n" + os.urandom(max(0, size - 8))
+    return "data:image/png;base64," + base64.b64encode(data).decode()
+
+def build_messages(workload: str, args) -> List[dict]:
+    tag = uuid.uuid4().hex[:8]
+    if workload == "multiimage":
+        content = [{"type": "text", "text": f"[{tag}] 描述这些图片"}]
+        content += [{"type": "image_url", "image_url": {"url": make_image(args.image_size)}} for _ in range(args.images)]
+        return [{"role": "user", "content": content}]
+    if workload == "imagegen":
+        return [{"role": "user", "content": f"[{tag}] generate image of a cat"}]
+    return [{"role": "user", "content": f"[{tag}] hello, tell me something"}]
+
+def request_headers(args) -> Optional[dict]:
+    if args.sse_window is None:
+        return None
+    return {"X-SSE-Coalesce-Window": str(args.sse_window)}
+
+async def chat_once(client: httpx.AsyncClient, url: str, model: str, messages: List[dict], headers: Optional[dict] = None) -> dict:
+    """发送一次流式请求，返回延迟、TTFT、收到的内容分片 (token) 数与回复文本"""
+    start = time.perf_counter()
+    ttft = None
+    tokens = 0
+    text = []
+    async with client.stream("POST", f"{url}/v1/chat/completions",
+                             json={"model": model, "messages": messages, "stream": True}, headers=headers) as r:
+        if r.status_code != 200:
+            await r.aread()
+            return {"ok": False, "status": r.status_code, "latency": time.perf_counter() - start,
+                    "retry_after": float(r.headers.get("retry-after", 0))}
+        async for line in r.aiter_lines():
+            if not line.startswith("data: ") or line == "data: [DONE]":
+                continue
+            delta = json.loads(line[6:])["choices"][0]["delta"]
+            if delta.get("content"):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                tokens += 1
+                text.append(delta["content"])
+    return {"ok": True, "status": 200, "latency": time.perf_counter() - start, "ttft": ttft, "tokens": tokens, "text": "".join(text)}
+
+async def user_loop(client, url, workload, args, stop_at, records):
+    while time.perf_counter() < stop_at:
+        messages = build_messages(workload, args)
+        turns = args.turns if workload == "multiturn" else 1
+        for turn in range(turns):
+            try:
+                res = await chat_once(client, url, args.model, messages, request_headers(args))
+            except httpx.HTTPError as e:
+                res = {"ok": False, "status": type(e).__name__, "latency": 0.0}
+            records.append(res)
+            if not res["ok"]:
+                # 被限流时按 Retry-After 退避 (最多等到负载结束)
+                await asyncio.sleep(min(res.get("retry_after", 0), max(0.0, stop_at - time.perf_counter())))
+                break
+            if time.perf_counter() >= stop_at:
+                break
+            messages = messages + [
+                {"role": "assistant", "content": res["text"]},
+                {"role": "user", "content": f"continue ({turn + 1})"},
+            ]
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+async def run_workload(url: str, workload: str, args, gateway_pid: Optional[int]) -> dict:
+    records: List[dict] = []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        # 预热
+        await chat_once(client, url, args.model, build_messages("text", args))
+        rss_idle = rss_bytes(gateway_pid) if gateway_pid else 0
+        rss_peak = rss_idle
+        cpu_start = cpu_seconds(gateway_pid) if gateway_pid else 0.0
+
+        start = time.perf_counter()
+        stop_at = start + args.duration
+        users = [asyncio.create_task(user_loop(client, url, workload, args, stop_at, records)) for _ in range(args.concurrency)]
+        while not all(u.done() for u in users):
+            await asyncio.sleep(0.2)
+            if gateway_pid:
+                rss_peak = max(rss_peak, rss_bytes(gateway_pid))
+        await asyncio.gather(*users)
+        elapsed = time.perf_counter() - start
+        cpu = (cpu_seconds(gateway_pid) - cpu_start) if gateway_pid else None
+
+    ok = [r for r in records if r["ok"]]
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r.get("ttft") is not None]
+    tokens = sum(r["tokens"] for r in ok)
+    chars = sum(len(r["text"]) for r in ok)
+    errors: Dict[str, int] = {}
+    for r in records:
+        if not r["ok"]:
+            errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+
+    def ms(v):
+        return round(v * 1000, 1) if v is not None else None
+
+    return {
+        "requests": len(ok),
+        "errors": errors,
+        "duration": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2),
+        "tokens_per_s": round(tokens / elapsed, 1),
+        "chars_per_s": round(chars / elapsed, 1),
+        "ttft_p50_ms": ms(percentile(ttfts, 0.5)),
+        "ttft_p95_ms": ms(percentile(ttfts, 0.95)),
+        "ttft_p99_ms": ms(percentile(ttfts, 0.99)),
+        "latency_p50_ms": ms(percentile(latencies, 0.5)),
+        "latency_p99_ms": ms(percentile(latencies, 0.99)),
+        "cpu_per_token_us": round(cpu / tokens * 1e6, 1) if cpu is not None and tokens else None,
+        "cpu_per_request_ms": round(cpu / len(ok) * 1e3, 2) if cpu is not None and ok else None,
+        "mem_per_conn_kb": round((rss_peak - rss_idle) / args.concurrency / 1024, 1) if gateway_pid else None,
+        "rss_peak_mb": round(rss_peak / 1024 / 1024, 1) if gateway_pid else None,
+    }
+
+# ---------- 结果保存与比较 ----------
+
+def git_commit() -> str:
+    try:
+        sha = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD", "--", "src"], cwd=ROOT) != 0
+        return sha + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def save_results(result: dict) -> Path:
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    path = RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{result['commit']}.json"
+    path.write_text(json.dumps(result, indent=2, ensure_ascii=False) + "\n")
+    return path
+
+def latest_result(commit: str) -> dict:
+    matches = sorted(p for p in RESULTS_DIR.glob("*.json") if p.stem.split("-", 2)[-1].startswith(commit))
+    if not matches:
+        raise SystemExit(f"没有找到提交 {commit} 的结果")
+    return json.loads(matches[-1].read_text())
+
+METRICS = ["throughput_rps", "tokens_per_s", "ttft_p50_ms", "ttft_p95_ms", "ttft_p99_ms", "latency_p50_ms", "latency_p99_ms", "cpu_per_request_ms",
+           "cpu_per_token_us", "mem_per_conn_kb"]
+
+def print_table(results: Dict[str, dict]) -> None:
+    print(f"{'workload':<12}" + "".join(f"{m:>18}" for m in METRICS))
+    for workload, r in results.items():
+        print(f"{workload:<12}" + "".join(f"{str(r.get(m)):>18}" for m in METRICS))
+
+def compare(a: str, b: str) -> None:
+    ra, rb = latest_result(a), latest_result(b)
+    print(f"{ra['commit']} -> {rb['commit']}")
+    print(f"{'workload':<12}{'metric':<20}{'before':>12}{'after':>12}{'change':>10}")
+    for workload in rb["workloads"]:
+        if workload not in ra["workloads"]:
+            continue
+        for m in METRICS:
+            before, after = ra["workloads"][workload].get(m), rb["workloads"][workload].get(m)
+            change = f"{(after - before) / before * 100:+.1f}%" if before and after is not None else ""
+            print(f"{workload:<12}{m:<20}{str(before):>12}{str(after):>12}{change:>10}")
+
+async def run(args) -> None:
+    workloads = [w.strip() for w in args.workloads.split(",") if w.strip()]
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        raise SystemExit(f"未知负载: {', '.join(sorted(unknown))}")
+
+    results: Dict[str, dict] = {}
+    if args.gateway:
+        for workload in workloads:
+            results[workload] = await run_workload(args.gateway, workload, args, None)
+            print(f"✅ {workload}: {json.dumps(results[workload], ensure_ascii=False)}")
+    else:
+        stack = Stack(args)
+        url = await asyncio.get_running_loop().run_in_executor(None, stack.__enter__)
+        try:
+            for workload in workloads:
+                results[workload] = await run_workload(url, workload, args, stack.gateway_pid)
+                print(f"✅ {workload}: {json.dumps(results[workload], ensure_ascii=False)}")
+        finally:
+            stack.__exit__(None, None, None)
+
+    print()
+    print_table(results)
+    if not args.no_save:
+        result = {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {k: v for k, v in vars(args).items() if k not in ("compare", "no_save")},
+            "workloads": results,
+        }
+        print(f"\n💾 结果已保存: {save_results(result).relative_to(ROOT)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini Business gateway load generator")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help=f"逗号分隔，可选 {', '.join(WORKLOADS)}")
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="并发用户数")
+    parser.add_argument("-d", "--duration", type=float, default=15, help="每个负载的持续时间 (秒)")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--turns", type=int, default=5, help="multiturn 负载每个对话的轮数")
+    parser.add_argument("--images", type=int, default=4, help="multiimage 负载每个请求的图片数")
+    parser.add_argument("--image-size", type=int, default=128 * 1024, help="multiimage 负载每张图片的字节数")
+    parser.add_argument("--gateway", help="对已运行的网关发压，不启动模拟上游与网关")
+    parser.add_argument("--workers", type=int, default=1, help="启动的网关 worker 数")
+    parser.add_argument("--accounts", type=int, default=4, help="模拟账户数")
+    parser.add_argument("--gateway-config", help="覆盖网关 app.json 配置的 JSON，如 '{\"session_pool_size\": 0}'")
+    parser.add_argument("--ttft", type=float, default=0.3, help="模拟上游首个文本分片前的延迟")
+    parser.add_argument("--chunks", type=int, default=40, help="模拟上游每个回复的文本分片数")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="模拟上游文本分片间隔")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="模拟上游 createSession 与首个文本分片偶发变慢的概率")
+    parser.add_argument("--slow-delay", type=float, default=2.0, help="模拟上游偶发变慢时增加的延迟")
+    parser.add_argument("--sse-window", type=float, help="通过 X-SSE-Coalesce-Window 请求头指定 SSE 分片合并窗口 (毫秒)")
+    parser.add_argument("--no-save", action="store_true", help="不保存结果")
+    parser.add_argument("--compare", nargs=2, metavar=("A", "B"), help="比较两个提交的最近一次结果")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""模拟 Gemini Business 上游，用于基准测试
+
+实现 getoxsrf、widgetCreateSession、widgetStreamAssist (分块输出 JSON 数组，可配置延迟)、
+widgetAddContextFile、widgetListSessionFileMetadata 与 downloadFile。
+
+提示词中包含 "generate image" 或 "画" 时，回复中会带一张生成的图片，网关随后会列出并下载该文件。
+
+--slow-rate / --slow-delay 让一部分 widgetCreateSession 与首个文本分片偶发变慢，用于模拟上游长尾延迟。
+
+用法: python bench/mock_upstream.py --port 9100 --ttft 0.3 --chunks 40 --chunk-delay 0.02
+"""
+import os
+import json
+import uuid
+import base64
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass, asdict
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+
+@dataclass
+class MockOptions:
+    auth_delay: float = 0.05        # getoxsrf 延迟
+    session_delay: float = 0.1      # widgetCreateSession 延迟
+    upload_delay: float = 0.05      # widgetAddContextFile 延迟
+    list_delay: float = 0.05        # widgetListSessionFileMetadata 延迟
+    ttft: float = 0.3               # widgetStreamAssist 首个文本分片前的延迟
+    chunks: int = 40                # 每个回复的文本分片数
+    chunk_chars: int = 12           # 每个文本分片的字符数
+    chunk_delay: float = 0.02       # 文本分片之间的间隔
+    image_bytes: int = 256 * 1024   # 生成图片的大小
+    download_delay: float = 0.05    # downloadFile 首字节延迟
+    slow_rate: float = 0.0          # widgetCreateSession 与 widgetStreamAssist 首个分片偶发变慢的概率 (模拟长尾)
+    slow_delay: float = 2.0         # 变慢时额外增加的延迟
+
+WORDS = ["gemini", "business", "gateway", "stream", "token", "你好", "世界", "测试", "latency", "session"]
+
+def create_app(opts: MockOptions) -> FastAPI:
+    app = FastAPI(title="Mock Gemini Business Upstream")
+    generated_files = {}  # session name -> [fileMetadata]
+    counters = {"getoxsrf": 0, "createSession": 0, "streamAssist": 0, "addContextFile": 0, "listFiles": 0, "downloadFile": 0}
+    # 生成图片内容在进程内固定，网关按内容去重后只会保存一份
+    image = b"\x89PNG\r\n\x1a\n" + os.urandom(max(0, opts.image_bytes - 8))
+
+    def slow_tail() -> float:
+        return opts.slow_delay if random.random() < opts.slow_rate else 0.0
+
+    def text_chunk(i: int) -> str:
+        rnd = random.Random(i)
+        text = ""
+        while len(text) < opts.chunk_chars:
+            text += rnd.choice(WORDS) + " "
+        return text[:opts.chunk_chars]
+
+    @app.get("/auth/getoxsrf")
+    async def getoxsrf():
+        counters["getoxsrf"] += 1
+        await asyncio.sleep(opts.auth_delay)
+        payload = {"xsrfToken": base64.urlsafe_b64encode(uuid.uuid4().bytes).decode().rstrip("="), "keyId": "mock-key"}
+        return Response(")]}'\n" + json.dumps(payload), media_type="application/json")
+
+    @app.post("/v1alpha/locations/global/widgetCreateSession")
+    async def create_session():
+        counters["createSession"] += 1
+        await asyncio.sleep(opts.session_delay + slow_tail())
+        name = f"projects/mock/locations/global/collections/default_collection/engines/agentspace-engine/sessions/{uuid.uuid4().hex}"
+        return {"session": {"name": name}}
+
+    @app.post("/v1alpha/locations/global/widgetAddContextFile")
+    async def add_context_file(request: Request):
+        counters["addContextFile"] += 1
+        await request.body()
+        await asyncio.sleep(opts.upload_delay)
+        return {"addContextFileResponse": {"fileId": uuid.uuid4().hex}}
+
+    @app.post("/v1alpha/locations/global/widgetListSessionFileMetadata")
+    async def list_files(request: Request):
+        counters["listFiles"] += 1
+        body = await request.json()
+        await asyncio.sleep(opts.list_delay)
+        name = body.get("listSessionFileMetadataRequest", {}).get("name", "")
+        return {"listSessionFileMetadataResponse": {"fileMetadata": generated_files.get(name, [])}}
+
+    @app.get("/download/v1alpha/projects/{project}/locations/global/collections/default_collection/engines/agentspace-engine/sessions/{session_file}")
+    async def download_file(project: str, session_file: str):
+        counters["downloadFile"] += 1
+        await asyncio.sleep(opts.download_delay)
+
+        async def body():
+            for i in range(0, len(image), 64 * 1024):
+                yield image[i:i + 64 * 1024]
+        return StreamingResponse(body(), media_type="image/png")
+
+    @app.post("/v1alpha/locations/global/widgetStreamAssist")
+    async def stream_assist(request: Request):
+        counters["streamAssist"] += 1
+        body = await request.json()
+        req = body.get("streamAssistRequest", {})
+        session = req.get("session", "")
+        query = "".join(p.get("text", "") for p in req.get("query", {}).get("parts", []))
+        wants_image = "generate image" in query or "画" in query
+
+        async def stream():
+            yield b"["
+            await asyncio.sleep(opts.ttft + slow_tail())
+            # 首个元素为思考过程，网关应当跳过
+            elements = [{"streamAssistResponse": {"answer": {"state": "IN_PROGRESS", "replies": [
+                {"groundedContent": {"content": {"text": "thinking...", "thought": True}}, "thought": True}]}}}]
+            for i in range(opts.chunks):
+                elements.append({"streamAssistResponse": {"answer": {"state": "IN_PROGRESS", "replies": [
+                    {"groundedContent": {"content": {"role": "model", "text": text_chunk(i)}}}]}}})
+            if wants_image:
+                file_id = uuid.uuid4().hex
+                generated_files.setdefault(session, []).append({
+                    "fileId": file_id, "fileName": f"{file_id}.png", "mimeType": "image/png", "fileOriginType": "AI_GENERATED",
+                })
+                elements.append({"streamAssistResponse": {"answer": {"state": "IN_PROGRESS", "replies": [
+                    {"groundedContent": {"content": {"role": "model", "file": {"fileId": file_id, "mimeType": "image/png"}}}}]}}})
+            elements.append({"streamAssistResponse": {"answer": {"state": "SUCCEEDED"}, "sessionInfo": {"session": session}}})
+
+            for i, el in enumerate(elements):
+                if i > 1:
+                    await asyncio.sleep(opts.chunk_delay)
+                data = ("," if i else "") + "\r\n" + json.dumps(el)
+                # 每个元素拆成两段发送，模拟元素跨越网络分块的情况
+                half = len(data) // 2
+                yield data[:half].encode()
+                yield data[half:].encode()
+            yield b"\r\n]"
+
+        return StreamingResponse(stream(), media_type="application/json")
+
+    @app.get("/_mock/stats")
+    async def mock_stats():
+        return {"options": asdict(opts), "counters": counters}
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Gemini Business upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    for name, value in asdict(MockOptions()).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+    opts = MockOptions(**{k: getattr(args, k) for k in asdict(MockOptions())})
+    uvicorn.run(create_app(opts), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
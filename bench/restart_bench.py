@@ -0,0 +1,82 @@
+"""网关重启后的上游调用峰值
+
+启动模拟上游与网关，先建立一批多轮对话，然后正常重启网关 (SIGINT)，统计重启及随后每个对话
+再发送一轮期间模拟上游收到的 getoxsrf / widgetCreateSession 调用数与该轮的延迟。
+关闭状态快照作为对照: --gateway-config '{"state_snapshot_path": ""}'
+
+用法:
+  python bench/restart_bench.py --conversations 64
+  python bench/restart_bench.py --conversations 64 --gateway-config '{"state_snapshot_path": ""}'
+"""
+import json
+import uuid
+import asyncio
+import argparse
+from pathlib import Path
+
+import httpx
+
+from loadgen import Stack, chat_once, percentile
+
+async def next_turn(client: httpx.AsyncClient, url: str, model: str, conversations: list) -> list:
+    """每个对话并发发送下一轮，返回各请求结果 (对话历史随之更新)"""
+    async def one(messages):
+        res = await chat_once(client, url, model, messages)
+        if res["ok"]:
+            messages += [{"role": "assistant", "content": res["text"]}, {"role": "user", "content": "continue"}]
+        return res
+    return await asyncio.gather(*[one(messages) for messages in conversations])
+
+def upstream_counters(upstream: str) -> dict:
+    return httpx.get(f"{upstream}/_mock/stats").json()["counters"]
+
+def summarize(results: list) -> dict:
+    latencies = [r["latency"] for r in results if r["ok"]]
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    return {
+        "errors": sum(1 for r in results if not r["ok"]),
+        "latency_p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+        "latency_p99_ms": round(p99 * 1000, 1) if p99 is not None else None,
+    }
+
+async def run(args) -> None:
+    stack = Stack(args)
+    url = await asyncio.get_running_loop().run_in_executor(None, stack.__enter__)
+    try:
+        upstream = json.loads((Path(stack.tmp.name) / "app.json").read_text())["upstream_api_base"]
+        conversations = [[{"role": "user", "content": f"[{uuid.uuid4().hex[:8]}] hello"}] for _ in range(args.conversations)]
+        async with httpx.AsyncClient(timeout=120) as client:
+            for _ in range(args.turns):
+                await next_turn(client, url, args.model, conversations)
+            before_restart = upstream_counters(upstream)
+            await asyncio.get_running_loop().run_in_executor(None, stack.restart_gateway)
+            after_restart = upstream_counters(upstream)
+            results = await next_turn(client, url, args.model, conversations)
+            after_turn = upstream_counters(upstream)
+
+        report = {
+            "restart": {k: after_restart[k] - before_restart[k] for k in ("getoxsrf", "createSession")},
+            "next_turn": {k: after_turn[k] - after_restart[k] for k in ("getoxsrf", "createSession", "streamAssist")},
+            **summarize(results),
+        }
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    finally:
+        stack.__exit__(None, None, None)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure upstream calls after a gateway restart")
+    parser.add_argument("--conversations", type=int, default=64, help="重启前建立的对话数")
+    parser.add_argument("--turns", type=int, default=2, help="重启前每个对话的轮数")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--workers", type=int, default=1, help="启动的网关 worker 数")
+    parser.add_argument("--accounts", type=int, default=4, help="模拟账户数")
+    parser.add_argument("--gateway-config", help="覆盖网关 app.json 配置的 JSON")
+    parser.add_argument("--ttft", type=float, default=0.1, help="模拟上游首个文本分片前的延迟")
+    parser.add_argument("--chunks", type=int, default=10, help="模拟上游每个回复的文本分片数")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="模拟上游文本分片间隔")
+    args = parser.parse_args()
+    args.slow_rate, args.slow_delay = 0.0, 0.0
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
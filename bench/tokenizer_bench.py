@@ -0,0 +1,81 @@
+"""token 计数基准测试
+
+比较原先的 len//4 估算与当前分词后端的吞吐量，以及长对话在有/无按消息缓存时计算 usage 的耗时。
+
+用法:
+  python bench/tokenizer_bench.py
+  python bench/tokenizer_bench.py --turns 100 --backend tiktoken
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+ZH = "今天天气很好，我们一起去公园散步吧。这是一个用来评估分词速度的测试句子，包含常见的标点符号。"
+EN = "The quick brown fox jumps over the lazy dog, then it runs away quickly into the forest. "
+
+def throughput(fn, text: str, seconds: float = 1.0) -> float:
+    """返回每秒处理的字符数 (百万)"""
+    n, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        fn(text)
+        n += 1
+    return len(text) * n / (time.perf_counter() - start) / 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Token counting benchmark")
+    parser.add_argument("--backend", default="cjk", help="分词后端 (cjk | tiktoken)")
+    parser.add_argument("--turns", type=int, default=50, help="长对话的轮数")
+    parser.add_argument("--turn-chars", type=int, default=400, help="每条消息的字符数")
+    args = parser.parse_args()
+
+    # 使用独立的配置文件，避免读取真实账户
+    tmp = tempfile.TemporaryDirectory()
+    app_path, accounts_path = Path(tmp.name) / "app.json", Path(tmp.name) / "accounts.json"
+    app_path.write_text(json.dumps({"tokenizer": args.backend, "log_level": "WARNING", "image_save_dir": str(Path(tmp.name) / "images")}))
+    accounts_path.write_text(json.dumps({"accounts": []}))
+    os.environ.update(GEMINI_APP_CONFIG=str(app_path), GEMINI_ACCOUNTS_CONFIG=str(accounts_path))
+    sys.path.insert(0, str(ROOT / "src"))
+    import tokens
+    from models import Message
+    from cache import TOKEN_CACHE
+
+    samples = {
+        "zh": ZH * 100,
+        "en": EN * 100,
+        "mixed": (ZH + EN) * 50,
+    }
+    print(f"{'text':<8}{'chars':>8}{'len//4':>10}{args.backend:>10}{'len//4 Mchar/s':>18}{args.backend + ' Mchar/s':>18}")
+    for name, text in samples.items():
+        print(f"{name:<8}{len(text):>8}{len(text) // 4:>10}{tokens.count_text_tokens(text):>10}"
+              f"{throughput(lambda t: len(t) // 4, text):>18.1f}{throughput(tokens.count_text_tokens, text):>18.1f}")
+
+    # 长对话：每次请求都携带完整历史，只有最后一轮是新的
+    turn = (ZH + EN) * (args.turn_chars // len(ZH + EN) + 1)
+    history = []
+    for i in range(args.turns):
+        history.append(Message(role="user" if i % 2 == 0 else "assistant", content=f"[{i}] {turn[:args.turn_chars]}"))
+    history.append(Message(role="user", content=[{"type": "text", "text": "看图"}, {"type": "image_url", "image_url": {"url": "https://example.com/a.png"}}]))
+
+    def per_request(memo: bool, repeat: int = 200) -> float:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            if not memo:
+                TOKEN_CACHE._data.clear()
+            tokens.calculate_usage(history, "")
+        return (time.perf_counter() - start) / repeat * 1e6
+
+    TOKEN_CACHE._data.clear()
+    usage = tokens.calculate_usage(history, "")
+    print(f"\n{args.turns} 轮对话 ({sum(len(m.content) if isinstance(m.content, str) else 0 for m in history)} 字符, 1 张图片): "
+          f"prompt_tokens={usage['prompt_tokens']}")
+    print(f"  无缓存: {per_request(False):.1f} us/请求")
+    print(f"  按消息缓存: {per_request(True):.1f} us/请求")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import math
+import asyncio
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from config import logger, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT
+from auth import Account
+from scheduler import scheduler
+
+class _Waiter:
+    __slots__ = ("tenant", "preferred", "future")
+
+    def __init__(self, tenant: str, preferred: Optional[Account]):
+        self.tenant = tenant
+        self.preferred = preferred
+        # 放行时设置为 (账户, scheduler.begin 返回的开始时间)
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+class AdmissionController:
+    """请求准入控制：所有健康账户的并发名额都已占满时，请求进入有界队列等待
+
+    队列按调用方 (ChatRequest.user 或 API Key) 分组，名额释放时在各调用方之间轮流放行，
+    单个调用方的大量请求不会饿死其他调用方。队列已满时丢弃排队最多的调用方最新的请求
+    (若新请求正来自该调用方则直接拒绝)；被拒绝或等待超时的请求返回 429 与 Retry-After。
+    """
+
+    def __init__(self, max_queue: int, timeout: float):
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._size = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = {"queue_full": 0, "evicted": 0, "timeout": 0}
+        scheduler.on_release = self.dispatch
+
+    def __len__(self) -> int:
+        return self._size
+
+    async def acquire(self, tenant: str, preferred: Optional[Account] = None) -> Tuple[Account, float]:
+        """取得一个账户的并发名额，返回 (账户, 开始时间)；调用方需在请求结束时调用 scheduler.end 归还"""
+        if not self._size:
+            account = scheduler.try_pick(preferred=preferred)
+            if account is not None:
+                self.admitted += 1
+                return account, scheduler.begin(account)
+
+        # 已有请求在排队时新请求也要排队，不能越过队列直接占用释放出来的名额
+        waiter = self._enqueue(tenant, preferred)
+        logger.debug(f"⏳ 账户名额已满，请求进入队列 (调用方 {tenant}, 排队 {self._size})")
+        try:
+            await asyncio.wait((waiter.future,), timeout=self.timeout)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        if not waiter.future.done():
+            self._abandon(waiter)
+            self.rejected["timeout"] += 1
+            raise self._reject("Timed out waiting for an available account")
+        return waiter.future.result()
+
+    def _enqueue(self, tenant: str, preferred: Optional[Account]) -> _Waiter:
+        if self._size >= self.max_queue:
+            # 队列已满：丢弃排队最多的调用方最新的请求，为排队较少的调用方腾出位置
+            victim_tenant = max(self._queues, key=lambda t: len(self._queues[t]), default=None)
+            own = len(self._queues.get(tenant, ()))
+            if victim_tenant is None or len(self._queues[victim_tenant]) <= own + 1:
+                self.rejected["queue_full"] += 1
+                raise self._reject("Too many queued requests")
+            victim = self._queues[victim_tenant].pop()
+            self._size -= 1
+            self.rejected["evicted"] += 1
+            victim.future.set_exception(self._reject("Request evicted from admission queue"))
+
+        waiter = _Waiter(tenant, preferred)
+        self._queues.setdefault(tenant, deque()).append(waiter)
+        self._size += 1
+        self.queued += 1
+        return waiter
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        """等待结束 (超时或请求被取消)：仍在队列中则移出；已分配到名额则归还"""
+        if not waiter.future.done():
+            waiter.future.cancel()
+            queue = self._queues.get(waiter.tenant)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                self._size -= 1
+                if not queue:
+                    del self._queues[waiter.tenant]
+        elif not waiter.future.cancelled() and waiter.future.exception() is None:
+            account, start = waiter.future.result()
+            scheduler.end(account, start, 499)
+
+    def dispatch(self) -> None:
+        """有名额释放时按调用方轮流放行排队的请求，直到没有可用名额"""
+        while self._size:
+            for tenant in list(self._queues):
+                queue = self._queues[tenant]
+                waiter = queue[0]
+                try:
+                    account = scheduler.try_pick(preferred=waiter.preferred)
+                except HTTPException:
+                    # 暂无健康账户，等待熔断冷却后由定时检查放行
+                    return
+                if account is None:
+                    return
+                queue.popleft()
+                self._size -= 1
+                # 放行过的调用方移到末尾，下一个名额优先给其他调用方
+                del self._queues[tenant]
+                if queue:
+                    self._queues[tenant] = queue
+                self.admitted += 1
+                waiter.future.set_result((account, scheduler.begin(account)))
+
+    async def run_dispatcher(self, interval: float = 1.0) -> None:
+        """定期检查排队请求：熔断冷却结束或其他 worker 释放名额时不会触发 on_release"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.dispatch()
+            except Exception as e:
+                logger.error(f"❌ 准入队列调度失败: {e}")
+
+    def retry_after(self) -> int:
+        """按当前排队长度、账户名额与平均延迟估算客户端应等待的秒数"""
+        capacity = scheduler.capacity() or 1
+        latency = scheduler.mean_latency() or 1.0
+        return max(1, min(math.ceil(self.timeout) or 1, math.ceil(latency * (self._size + 1) / capacity)))
+
+    def _reject(self, detail: str) -> HTTPException:
+        return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(self.retry_after())})
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "queue_depth": self._size,
+            "max_queue": self.max_queue,
+            "timeout": self.timeout,
+            "tenants": {tenant: len(queue) for tenant, queue in self._queues.items()},
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": dict(self.rejected),
+        }
+
+ADMISSION = AdmissionController(ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
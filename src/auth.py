@@ -3,36 +3,135 @@ import time
 import asyncio
 import base64
 import os
-from typing import List, Optional
+import random
+from typing import Dict, List, Optional, Tuple
 
 from fastapi import HTTPException
 
-from config import logger, http_client
+from config import logger, UPSTREAM_AUTH_BASE, JWT_REFRESH_RATIO, JWT_REFRESH_JITTER, JWT_RETRY_BASE, JWT_RETRY_MAX
 from utils import create_jwt
+from clients import get_client
+from state import STATE_STORE
+from metrics import stage
 
 class JWTManager:
-    def __init__(self, secure_c_ses: str, host_c_oses: Optional[str], csesidx: str):
+    def __init__(self, secure_c_ses: str, host_c_oses: Optional[str], csesidx: str, name: str = ""):
         self.secure_c_ses = secure_c_ses
         self.host_c_oses = host_c_oses
         self.csesidx = csesidx
+        self.name = name
         self.jwt: str = ""
         self.expires: float = 0
+        self.issued_at: float = 0
         self._lock = asyncio.Lock()
+        # 刷新统计
+        self.refresh_count = 0
+        self.refresh_failures = 0
+        self.consecutive_failures = 0
+        self.last_refresh_latency = 0.0
+        self.total_refresh_latency = 0.0
+        self.last_error: Optional[str] = None
 
     async def get(self) -> str:
+        # 快速路径：令牌有效时不经过锁，后台刷新期间请求也不会被阻塞
+        if time.time() < self.expires:
+            return self.jwt
         async with self._lock:
-            if time.time() > self.expires:
-                await self._refresh()
+            # 多 worker 时先尝试采用其他 worker 已刷新的令牌
+            if time.time() >= self.expires and not await self._adopt_shared():
+                await self._timed_refresh()
             return self.jwt
 
+    async def _adopt_shared(self) -> bool:
+        """从共享存储读取比当前更新且仍有效的令牌"""
+        if STATE_STORE is None:
+            return False
+        return self.adopt(await STATE_STORE.call(STATE_STORE.load_jwt, self.name))
+
+    def adopt(self, row: Optional[Tuple[str, float, float]]) -> bool:
+        """采用 (jwt, issued_at, expires) 表示的令牌，仅当它比当前更新且仍有效"""
+        if not row or row[1] <= self.issued_at or time.time() >= row[2]:
+            return False
+        self.jwt, self.issued_at, self.expires = row
+        return True
+
+    async def _timed_refresh(self) -> None:
+        start = time.perf_counter()
+        try:
+            with stage("jwt_refresh", self.name):
+                await self._refresh()
+        except Exception as e:
+            self.refresh_failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(e)
+            raise
+        finally:
+            self.last_refresh_latency = time.perf_counter() - start
+        self.refresh_count += 1
+        self.consecutive_failures = 0
+        if STATE_STORE is not None:
+            await STATE_STORE.call(STATE_STORE.save_jwt, self.name, self.jwt, self.issued_at, self.expires)
+        self.total_refresh_latency += self.last_refresh_latency
+        self.last_error = None
+
+    def next_refresh_delay(self) -> float:
+        """距下次主动刷新的等待时间：令牌寿命的 JWT_REFRESH_RATIO 处，加随机抖动错开各账户"""
+        lifetime = self.expires - self.issued_at
+        jitter = random.uniform(-JWT_REFRESH_JITTER, JWT_REFRESH_JITTER) * lifetime
+        target = self.issued_at + lifetime * JWT_REFRESH_RATIO + jitter
+        return max(0.0, target - time.time())
+
+    async def run_refresher(self) -> None:
+        """后台主动刷新 JWT，失败时指数退避重试"""
+        peer_refreshing = False
+        while True:
+            if peer_refreshing:
+                delay = JWT_RETRY_BASE
+            elif self.consecutive_failures:
+                delay = min(JWT_RETRY_BASE * 2 ** (self.consecutive_failures - 1), JWT_RETRY_MAX)
+                delay *= random.uniform(0.5, 1.0)
+            elif self.expires:
+                delay = self.next_refresh_delay()
+            else:
+                delay = random.uniform(0, JWT_RETRY_BASE)
+            issued_before = self.issued_at
+            peer_refreshing = False
+            await asyncio.sleep(delay)
+            try:
+                async with self._lock:
+                    # 等待期间已被请求路径或其他 worker 刷新过，则按新令牌重新计时
+                    await self._adopt_shared()
+                    if self.issued_at != issued_before and time.time() < self.expires:
+                        continue
+                    # 多 worker 时只由取得租约的 worker 刷新，其他 worker 稍后采用其结果
+                    if STATE_STORE is not None and not await STATE_STORE.call(STATE_STORE.try_lease, f"jwt:{self.name}", JWT_RETRY_MAX):
+                        peer_refreshing = True
+                        continue
+                    await self._timed_refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ 账户 {self.name} 后台刷新 JWT 失败 (连续 {self.consecutive_failures} 次): {e}")
+
+    def stats(self) -> dict:
+        return {
+            "valid": time.time() < self.expires,
+            "expires_in": round(max(0.0, self.expires - time.time()), 1),
+            "refresh_count": self.refresh_count,
+            "refresh_failures": self.refresh_failures,
+            "last_refresh_latency": round(self.last_refresh_latency, 4),
+            "avg_refresh_latency": round(self.total_refresh_latency / self.refresh_count, 4) if self.refresh_count else 0.0,
+            "last_error": self.last_error,
+        }
+
     async def _refresh(self) -> None:
         cookie = f"__Secure-C_SES={self.secure_c_ses}"
         if self.host_c_oses:
             cookie += f"; __Host-C_OSES={self.host_c_oses}"
         
         logger.debug("🔑 正在刷新 JWT...")
-        r = await http_client.get(
-            "https://business.gemini.google/auth/getoxsrf",
+        r = await get_client("auth").get(
+            f"{UPSTREAM_AUTH_BASE}/auth/getoxsrf",
             params={"csesidx": self.csesidx},
             headers={
                 "cookie": cookie,
@@ -48,9 +147,10 @@ class JWTManager:
         data = json.loads(txt)
 
         key_bytes = base64.urlsafe_b64decode(data["xsrfToken"] + "==")
-        self.jwt     = create_jwt(key_bytes, data["keyId"], self.csesidx)
-        self.expires = time.time() + 270
-        logger.info(f"✅ JWT 刷新成功")
+        self.jwt       = create_jwt(key_bytes, data["keyId"], self.csesidx)
+        self.issued_at = time.time()
+        self.expires   = self.issued_at + 270
+        logger.info(f"✅ JWT 刷新成功 {self.name}")
 
 def parse_cookies(cookies_str: str) -> dict:
     """解析cookies字符串，提取需要的参数"""
@@ -94,15 +194,33 @@ class Account:
         self.csesidx = data['csesidx']
         self.project_id = data['project_id']
         
-        self.jwt_mgr = JWTManager(self.secure_c_ses, self.host_c_oses, self.csesidx)
+        self.jwt_mgr = JWTManager(self.secure_c_ses, self.host_c_oses, self.csesidx, self.name)
+
+    @property
+    def signature(self) -> tuple:
+        """账户配置的全部字段，重新加载配置时据此判断账户是否有变化"""
+        return (self.config_id, self.secure_c_ses, self.host_c_oses, self.csesidx, self.project_id)
+
+def accounts_config_path() -> str:
+    return os.environ.get("GEMINI_ACCOUNTS_CONFIG") or ('config/config.test.json' if os.path.exists('config/config.test.json') else 'config/config.json')
+
+def read_accounts(config_file: str) -> List[Account]:
+    """读取并校验账户配置文件，失败时抛出异常"""
+    with open(config_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    result = [Account(acc) for acc in data.get('accounts', [])]
+    names = [acc.name for acc in result]
+    duplicated = sorted({name for name in names if names.count(name) > 1})
+    if duplicated:
+        raise ValueError(f"账户名称重复: {', '.join(duplicated)}")
+    return result
 
 def load_accounts() -> List[Account]:
-    config_file = 'config/config.test.json' if os.path.exists('config/config.test.json') else 'config/config.json'
+    config_file = accounts_config_path()
     try:
-        with open(config_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        result = read_accounts(config_file)
         logger.info(f"✅ 加载配置文件: {config_file}")
-        return [Account(acc) for acc in data.get('accounts', [])]
+        return result
     except FileNotFoundError:
         logger.error("❌ 配置文件未找到，请在config文件夹中创建config.json或config.test.json")
         return []
@@ -110,4 +228,30 @@ def load_accounts() -> List[Account]:
         logger.error(f"❌ 加载{config_file}失败: {e}")
         return []
 
-accounts = load_accounts()
\ No newline at end of file
+accounts = load_accounts()
+
+# 账户名 -> (账户, 后台 JWT 刷新任务)
+_refreshers: Dict[str, Tuple[Account, asyncio.Task]] = {}
+
+def start_jwt_refreshers() -> List[asyncio.Task]:
+    """为每个账户启动后台 JWT 刷新任务，返回新启动的任务
+
+    账户列表变化后再次调用：为新增或更换了凭据的账户启动任务，停止已移除或被替换的账户的任务。
+    """
+    current = {acc.name: acc for acc in accounts}
+    for name, (acc, task) in list(_refreshers.items()):
+        if current.get(name) is not acc:
+            task.cancel()
+            del _refreshers[name]
+    started = []
+    for acc in accounts:
+        if acc.name not in _refreshers:
+            task = asyncio.create_task(acc.jwt_mgr.run_refresher())
+            _refreshers[acc.name] = (acc, task)
+            started.append(task)
+    return started
+
+def stop_jwt_refreshers() -> None:
+    for _, task in _refreshers.values():
+        task.cancel()
+    _refreshers.clear()
@@ -0,0 +1,156 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from config import (
+    logger, SESSION_CACHE_SIZE, SESSION_TTL_SECONDS, CHAT_ID_CACHE_SIZE, CHAT_ID_TTL_SECONDS,
+    IMAGE_URL_CACHE_SIZE, IMAGE_URL_CACHE_TTL, IMAGE_URL_CACHE_BYTES,
+    RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_BYTES, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL,
+)
+from state import STATE_STORE, SQLiteCache
+
+class TTLCache:
+    """带容量上限 (LRU 淘汰) 与过期时间的内存缓存，附带命中/未命中/淘汰计数
+
+    max_bytes > 0 时额外按 set() 传入的 size 累计占用，超出字节预算同样按 LRU 淘汰。
+    """
+
+    def __init__(self, name: str, max_size: int, ttl: float, max_bytes: int = 0):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._data: "OrderedDict[str, Tuple[float, Any, int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, count=False) is not None
+
+    def get(self, key: str, count: bool = True) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            if count:
+                self.misses += 1
+            return None
+        stored_at, value, size = item
+        if time.time() - stored_at >= self.ttl:
+            del self._data[key]
+            self.total_bytes -= size
+            self.expirations += 1
+            if count:
+                self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        if count:
+            self.hits += 1
+        return value
+
+    async def aget(self, key: str) -> Optional[Any]:
+        """与 SQLiteCache.aget 一致的接口，内存缓存直接读取"""
+        return self.get(key)
+
+    async def aset(self, key: str, value: Any, size: int = 0) -> None:
+        self.set(key, value, size)
+
+    def set(self, key: str, value: Any, size: int = 0) -> None:
+        old = self._data.pop(key, None)
+        if old:
+            self.total_bytes -= old[2]
+        self._data[key] = (time.time(), value, size)
+        self.total_bytes += size
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._data) > self.max_size or (self.max_bytes and self.total_bytes > self.max_bytes and len(self._data) > 1):
+            _, (_, _, evicted_size) = self._data.popitem(last=False)
+            self.total_bytes -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key: str) -> Optional[Any]:
+        item = self._data.pop(key, None)
+        if item is None:
+            return None
+        self.total_bytes -= item[2]
+        return item[1]
+
+    def items(self) -> List[Tuple[str, float, Any, int]]:
+        """所有条目 (key, 写入时间, 值, 大小)，按最近访问时间从旧到新排列"""
+        return [(key, stored_at, value, size) for key, (stored_at, value, size) in self._data.items()]
+
+    def restore(self, items: Iterable[Tuple[str, float, Any, int]]) -> int:
+        """按 items() 的格式恢复条目 (保留原写入时间)，跳过已过期或已存在的条目，返回恢复数量"""
+        deadline = time.time() - self.ttl
+        restored = 0
+        # 逆序逐个移到最前：恢复的条目保持原有顺序，并视为比现有条目更久未访问
+        for key, stored_at, value, size in reversed(list(items)):
+            if stored_at <= deadline or key in self._data:
+                continue
+            self._data[key] = (stored_at, value, size)
+            self._data.move_to_end(key, last=False)
+            self.total_bytes += size
+            restored += 1
+        self._evict()
+        return restored
+
+    def sweep(self) -> int:
+        """清理所有已过期条目，返回清理数量"""
+        deadline = time.time() - self.ttl
+        expired = [k for k, (stored_at, _, _) in self._data.items() if stored_at <= deadline]
+        for k in expired:
+            self.total_bytes -= self._data.pop(k)[2]
+        self.expirations += len(expired)
+        return len(expired)
+
+    async def run_sweeper(self, interval: float) -> None:
+        """后台定期清理过期条目，避免只在读取时才检查过期导致内存持续增长"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = self.sweep()
+                if removed:
+                    logger.debug(f"🧹 {self.name} 清理过期条目 {removed} 个")
+            except Exception as e:
+                logger.error(f"❌ {self.name} 清理失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "backend": "memory",
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+# ---------- 全局缓存实例 ----------
+# key: "{tenant}:{conversation_key}" -> {"session_id": str, "updated_at": float, "account": str,
+#   "sent_count": int, "history_hash": str, "reply_hash": str, "file_ids": {图片内容摘要: fileId}}
+# 使用 sqlite 状态后端时，Session 缓存与 chat_id 映射存放在共享存储中，多个 worker 间保持会话亲和
+if STATE_STORE is not None:
+    SESSION_CACHE = SQLiteCache("SESSION_CACHE", STATE_STORE, SESSION_CACHE_SIZE, SESSION_TTL_SECONDS)
+    # key: chat_id -> account name
+    CHAT_ID_TO_ACCOUNT = SQLiteCache("CHAT_ID_TO_ACCOUNT", STATE_STORE, CHAT_ID_CACHE_SIZE, CHAT_ID_TTL_SECONDS)
+else:
+    SESSION_CACHE = TTLCache("SESSION_CACHE", SESSION_CACHE_SIZE, SESSION_TTL_SECONDS)
+    # key: chat_id -> account name
+    CHAT_ID_TO_ACCOUNT = TTLCache("CHAT_ID_TO_ACCOUNT", CHAT_ID_CACHE_SIZE, CHAT_ID_TTL_SECONDS)
+# key: 远程图片 URL (图片数据较大，始终保存在进程内) -> {"mime": str, "data": str_base64, "etag": str, "last_modified": str}
+IMAGE_URL_CACHE = TTLCache("IMAGE_URL_CACHE", IMAGE_URL_CACHE_SIZE, IMAGE_URL_CACHE_TTL, IMAGE_URL_CACHE_BYTES)
+# key: 规范化的请求指纹 -> {"pieces": [回复文本片段], "account": str} (仅在开启 response_cache 时使用，保存在进程内)
+RESPONSE_CACHE = TTLCache("RESPONSE_CACHE", RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_BYTES)
+# key: 格式化后消息文本的摘要 -> token 数 (不含图片)
+TOKEN_CACHE = TTLCache("TOKEN_CACHE", TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
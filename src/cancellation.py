@@ -0,0 +1,80 @@
+import time
+import asyncio
+from typing import Any, AsyncIterator, Awaitable
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+from config import logger, DISCONNECT_POLL_INTERVAL
+
+class ClientDisconnected(Exception):
+    """客户端在响应完成前断开连接"""
+
+async def run_cancellable(request: Request, coro: Awaitable[Any], timeout: float) -> Any:
+    """运行协程直到完成；客户端断开时取消并抛出 ClientDisconnected，超时则取消并抛出 asyncio.TimeoutError
+
+    取消会传递到协程内部，正在进行的 httpx 请求随之关闭。
+    """
+    task = asyncio.ensure_future(coro)
+    disconnected = False
+
+    async def watch() -> None:
+        nonlocal disconnected
+        while not task.done():
+            if await request.is_disconnected():
+                disconnected = True
+                task.cancel()
+                return
+            await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        return await asyncio.wait_for(task, max(0.0, timeout))
+    except asyncio.CancelledError:
+        if disconnected:
+            raise ClientDisconnected()
+        raise
+    finally:
+        watcher.cancel()
+
+async def prepend_chunk(first: str, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+    """先输出已取出的首个分片，再继续输出剩余分片；关闭时一并关闭底层生成器"""
+    try:
+        yield first
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.aclose()
+
+class CancellableStreamingResponse(StreamingResponse):
+    """客户端断开或超过截止时间时关闭响应生成器
+
+    Starlette 在客户端断开后不会关闭 body_iterator，生成器会一直挂起到被垃圾回收，
+    期间占用上游连接与账户在途计数；这里在响应结束时显式关闭它。
+    """
+
+    def __init__(self, content: AsyncIterator[str], deadline: float, **kwargs):
+        super().__init__(content, **kwargs)
+        self.deadline = deadline
+
+    async def __call__(self, scope, receive, send) -> None:
+        task = asyncio.current_task()
+        timed_out = False
+
+        def on_deadline() -> None:
+            nonlocal timed_out
+            timed_out = True
+            task.cancel()
+
+        handle = asyncio.get_running_loop().call_later(max(0.0, self.deadline - time.monotonic()), on_deadline)
+        try:
+            await super().__call__(scope, receive, send)
+        except asyncio.CancelledError:
+            if not timed_out:
+                raise
+            if hasattr(task, "uncancel"):
+                task.uncancel()
+            logger.warning("⏱️ 流式响应超过请求截止时间，已中断")
+        finally:
+            handle.cancel()
+            await self.body_iterator.aclose()
@@ -1,17 +1,22 @@
 import json
-import re
+import time
 import hashlib
 import random
 import base64
-from typing import List
+import asyncio
+from typing import AsyncIterator, List, Optional
 
 from fastapi import HTTPException
 
-from config import logger, MODEL_MAPPING, http_client
+from config import logger, MODEL_MAPPING, UPSTREAM_API_BASE, IMAGE_FETCH_CONCURRENCY, SSE_COALESCE_MAX_CHARS
 from auth import Account, accounts
 from session import create_google_session, upload_context_file, list_session_files, download_file
-from utils import get_common_headers
+from utils import get_common_headers, JSONArrayStreamParser, json_dumps, encode_json_string
 from models import Message
+from payload import InlineImage, resolve_inline_image
+from cache import IMAGE_URL_CACHE
+from metrics import stage, observe_stage
+from clients import get_client, get_account_client
 
 def get_conversation_key(messages: List[dict]) -> str:
     if not messages: return "empty"
@@ -25,8 +30,52 @@ def get_conversation_key(messages: List[dict]) -> str:
     key_str = json.dumps(first_msg, sort_keys=True)
     return hashlib.md5(key_str.encode()).hexdigest()
 
-async def parse_last_message(messages: List[Message]):
-    """解析最后一条消息，分离文本和图片"""
+async def fetch_remote_image(url: str) -> Optional[dict]:
+    """下载远程图片，返回 {"mime": str, "data": str_base64}，失败返回 None
+
+    带 ETag / Last-Modified 的响应会缓存下来，再次引用同一 URL 时发送条件请求，304 时直接复用缓存。
+    """
+    cached = IMAGE_URL_CACHE.get(url)
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["if-none-match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["if-modified-since"] = cached["last_modified"]
+    try:
+        r = await get_client("images").get(url, headers=headers)
+        if r.status_code == 304 and cached:
+            logger.debug(f"♻️ 远程图片未变化，复用缓存: {url}")
+            return {"mime": cached["mime"], "data": cached["data"]}
+        if r.status_code == 200:
+            mime_type = r.headers.get("content-type", "image/png")
+            b64_data = base64.b64encode(r.content).decode()
+            etag, last_modified = r.headers.get("etag"), r.headers.get("last-modified")
+            if etag or last_modified:
+                IMAGE_URL_CACHE.set(url, {
+                    "mime": mime_type,
+                    "data": b64_data,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                }, size=len(b64_data))
+            return {"mime": mime_type, "data": b64_data}
+        logger.warning(f"⚠️ 下载图片失败: {url}")
+    except Exception as e:
+        logger.warning(f"⚠️ 下载图片异常: {e}")
+    return None
+
+def parse_data_uri(url: str) -> Optional[dict]:
+    """解析 base64 Data URI: data:image/png;base64,xxxxxx"""
+    header, sep, data = url.partition(",")
+    if not sep or not header.startswith("data:image/") or not header.endswith(";base64"):
+        return None
+    return {"mime": header[5:-7], "data": data}
+
+async def parse_last_message(messages: List[Message], inline_images: Optional[List[InlineImage]] = None):
+    """解析最后一条消息，分离文本和图片 (远程图片并发下载，保持原有顺序)
+
+    inline_images 为读取请求体时提取出的图片，消息中以占位符引用。
+    """
     if not messages:
         return "", []
     
@@ -34,73 +83,209 @@ async def parse_last_message(messages: List[Message]):
     content = last_msg.content
     
     text_content = ""
-    images = [] # List of {"mime": str, "data": str_base64}
+    images = [] # List of {"mime": str, "data": str_base64 | InlineImage}，远程图片先以下载任务占位
 
     if isinstance(content, str):
         text_content = content
     elif isinstance(content, list):
+        sem = asyncio.Semaphore(IMAGE_FETCH_CONCURRENCY)
+
+        async def fetch(url: str) -> Optional[dict]:
+            async with sem:
+                return await fetch_remote_image(url)
+
         for part in content:
             if part.get("type") == "text":
                 text_content += part.get("text", "")
             elif part.get("type") == "image_url":
                 url = part.get("image_url", {}).get("url", "")
-                # 解析 Data URI: data:image/png;base64,xxxxxx
-                if url.startswith("data:"):
-                    match = re.match(r"data:(image/[^;]+);base64,(.+)", url)
-                    if match:
-                        images.append({"mime": match.group(1), "data": match.group(2)})
+                inline = resolve_inline_image(url, inline_images or [])
+                if inline is not None:
+                    images.append({"mime": inline.mime, "data": inline})
+                elif url.startswith("data:"):
+                    image = parse_data_uri(url)
+                    if image:
+                        images.append(image)
                     else:
                         logger.warning(f"⚠️ 暂不支持非 Base64 数据URI: {url[:30]}...")
                 elif url.startswith(("http://", "https://")):
-                    # 下载远程图片
-                    try:
-                        r = await http_client.get(url)
-                        if r.status_code == 200:
-                            mime_type = r.headers.get("content-type", "image/png")
-                            b64_data = base64.b64encode(r.content).decode()
-                            images.append({"mime": mime_type, "data": b64_data})
-                        else:
-                            logger.warning(f"⚠️ 下载图片失败: {url}")
-                    except Exception as e:
-                        logger.warning(f"⚠️ 下载图片异常: {e}")
+                    images.append(asyncio.ensure_future(fetch(url)))
                 else:
                     logger.warning(f"⚠️ 暂不支持的图片URL格式: {url[:30]}...")
 
+        pending = [img for img in images if isinstance(img, asyncio.Future)]
+        if pending:
+            with stage("image_fetch"):
+                await asyncio.gather(*pending)
+            images = [img.result() if isinstance(img, asyncio.Future) else img for img in images]
+            images = [img for img in images if img]
+
     return text_content, images
 
+def message_text(msg: Message) -> str:
+    """消息的文本内容，图片以占位符表示"""
+    if isinstance(msg.content, str):
+        return msg.content
+    parts = []
+    for part in msg.content:
+        if part.get("type") == "text":
+            parts.append(part.get("text", ""))
+        elif part.get("type") == "image_url":
+            parts.append("[图片]")
+    return "".join(parts)
+
+def format_message(msg: Message) -> str:
+    """将单条消息格式化为上下文文本，图片以占位符表示"""
+    role = "User" if msg.role in ["user", "system"] else "Assistant"
+    return f"{role}: {message_text(msg)}\n\n"
+
 def build_full_context_text(messages: List[Message]) -> str:
     """仅拼接历史文本，图片只处理当次请求的"""
-    prompt = ""
+    return "".join(format_message(msg) for msg in messages)
+
+def get_history_hash(messages: List[Message]) -> str:
+    """对话历史指纹，用于判断缓存 Session 已见过的历史是否与本次请求一致"""
+    h = hashlib.md5()
     for msg in messages:
-        role = "User" if msg.role in ["user", "system"] else "Assistant"
-        content_str = ""
-        if isinstance(msg.content, str):
-            content_str = msg.content
-        elif isinstance(msg.content, list):
-            for part in msg.content:
-                if part.get("type") == "text":
-                    content_str += part.get("text", "")
-                elif part.get("type") == "image_url":
-                    content_str += "[图片]"
-        
-        prompt += f"{role}: {content_str}\n\n"
-    return prompt
-
-def create_chunk(id: str, created: int, model: str, delta: dict, finish_reason: str = None) -> str:
-    chunk = {
-        "id": id,
-        "object": "chat.completion.chunk",
-        "created": created,
-        "model": model,
-        "choices": [{
-            "index": 0,
-            "delta": delta,
-            "finish_reason": finish_reason
-        }]
-    }
-    return json.dumps(chunk)
+        h.update(format_message(msg).encode())
+    return h.hexdigest()
+
+def get_reply_hash(text: str) -> str:
+    """助手回复的指纹 (忽略首尾空白，部分客户端回传历史时会去掉)"""
+    return hashlib.md5(text.strip().encode()).hexdigest()
+
+def get_unseen_messages(messages: List[Message], sent_count: int, history_hash: str, reply_hash: str) -> Optional[List[Message]]:
+    """返回缓存 Session 尚未见过的消息；历史出现分叉时返回 None
+
+    Session 已收到前 sent_count 条消息，并在其后生成了指纹为 reply_hash 的助手回复，
+    因此本次请求应以相同的前缀 + 内容相同的 assistant 消息开头，之后才是新的轮次。
+    客户端编辑或重新生成了这条回复时，上游 Session 中的回复已与客户端不一致，需要改用新 Session。
+    sent_count 为 0 说明该 Session 的回复没有完成，其中已有的上下文未知，同样改用新 Session。
+    """
+    if sent_count == 0:
+        return None
+    if len(messages) <= sent_count + 1:
+        return None
+    if messages[sent_count].role != "assistant":
+        return None
+    if get_reply_hash(message_text(messages[sent_count])) != reply_hash:
+        return None
+    if get_history_hash(messages[:sent_count]) != history_hash:
+        return None
+    return messages[sent_count + 1:]
+
+class ChunkRenderer:
+    """渲染 OpenAI 流式 chunk：每个请求预先渲染一次固定部分 (id/created/model)，每个分片只需转义 delta 文本"""
+
+    def __init__(self, id: str, created: int, model: str):
+        head = json_dumps({"id": id, "object": "chat.completion.chunk", "created": created, "model": model}).decode()
+        prefix = f'data: {head[:-1]},"choices":[{{"index":0,"delta":'
+        self._content_prefix = prefix + '{"content":'
+        self._content_suffix = '},"finish_reason":null}]}\n\n'
+        self.role_chunk = prefix + '{"role":"assistant"},"finish_reason":null}]}\n\n'
+        self.stop_chunk = prefix + '{},"finish_reason":"stop"}]}\n\n'
+
+    def content(self, text: str) -> str:
+        return f"{self._content_prefix}{encode_json_string(text)}{self._content_suffix}"
 
-async def stream_chat_generator(account: Account, session: str, text_content: str, file_ids: List[str], model_name: str, chat_id: str, created_time: int, is_stream: bool = True):
+async def coalesce_text(source: AsyncIterator[str], window: float, max_chars: int) -> AsyncIterator[str]:
+    """合并 window 秒内陆续到达的回复片段 (累计达到 max_chars 时立即输出)，减少输出的 SSE 分片数
+
+    首段文本总是立即输出。上游片段由后台任务读取到缓冲区，每个合并窗口只唤醒一次输出端。
+    """
+    buffer: List[str] = []
+    size = 0
+    done = False
+    batching = False
+    error: Optional[BaseException] = None
+    wake = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    async def pump() -> None:
+        nonlocal size, done, error
+        try:
+            async for text in source:
+                buffer.append(text)
+                size += len(text)
+                # 合并窗口内只在累计达到 max_chars 时提前唤醒
+                if not batching or size >= max_chars:
+                    wake.set()
+        except Exception as e:
+            error = e
+        finally:
+            done = True
+            wake.set()
+
+    task = asyncio.ensure_future(pump())
+    try:
+        first = True
+        while True:
+            await wake.wait()
+            wake.clear()
+            if buffer and not first and not done and size < max_chars:
+                # 窗口到期由定时器唤醒 (asyncio.wait_for 每次都会创建新任务，开销较大)
+                batching = True
+                timer = loop.call_later(window, wake.set)
+                await wake.wait()
+                timer.cancel()
+                batching = False
+                wake.clear()
+            first = False
+            if buffer:
+                text = "".join(buffer)
+                buffer.clear()
+                size = 0
+                yield text
+            if done and not buffer:
+                if error is not None:
+                    raise error
+                return
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await source.aclose()
+
+async def render_chunks(source: AsyncIterator[str], renderer: ChunkRenderer, window: float = 0.0) -> AsyncIterator[str]:
+    """将回复文本渲染为 SSE 分片 (用于合并请求、缓存命中与开启分片合并的流式请求)
+
+    首个分片在收到首段文本后才输出，在此之前的失败仍可以作为 HTTP 错误返回。
+    window > 0 时合并该时间窗口内到达的片段 (见 coalesce_text)。
+    """
+    if window > 0:
+        source = coalesce_text(source, window, SSE_COALESCE_MAX_CHARS)
+    try:
+        started = False
+        async for text in source:
+            if not started:
+                started = True
+                yield renderer.role_chunk + renderer.content(text)
+            else:
+                yield renderer.content(text)
+        if not started:
+            yield renderer.role_chunk
+        yield renderer.stop_chunk + "data: [DONE]\n\n"
+    finally:
+        await source.aclose()
+
+def reply_has_generated_file(reply: dict) -> bool:
+    """判断回复片段中是否带有生成的文件 (如 AI 生成的图片)"""
+    stack = [reply.get("groundedContent", {})]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if "fileId" in node or "inlineData" in node:
+                return True
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return False
+
+async def stream_chat_generator(account: Account, session: str, text_content: str, file_ids: List[str], model_name: str, renderer: Optional[ChunkRenderer] = None, result: Optional[dict] = None):
+    """renderer 不为空时输出 SSE 分片，否则 (非流式请求) 直接输出回复文本
+
+    result 不为空时，会在其中记录 has_generated_files (回复中是否出现生成的文件) 与 reply (回复文本片段列表)
+    """
     jwt = await account.jwt_mgr.get()
     headers = get_common_headers(jwt)
     
@@ -131,36 +316,53 @@ async def stream_chat_generator(account: Account, session: str, text_content: st
             "modelId": target_model_id
         }
 
-    if is_stream:
-        chunk = create_chunk(chat_id, created_time, model_name, {"role": "assistant"}, None)
-        print(f"DEBUG: Yielding role chunk: {chunk}")
-        yield f"data: {chunk}\n\n"
-
-    r = await http_client.post(
-        "https://biz-discoveryengine.googleapis.com/v1alpha/locations/global/widgetStreamAssist",
+    # 使用流式请求，每收到一个完整的 streamAssistResponse 元素就立即下发
+    sent_at = time.perf_counter()
+    first_byte = False
+    async with get_account_client(account.name).stream(
+        "POST",
+        f"{UPSTREAM_API_BASE}/v1alpha/locations/global/widgetStreamAssist",
         headers=headers,
-        json=body,
-    )
-    
-    if r.status_code != 200:
-        raise HTTPException(status_code=r.status_code, detail=f"Upstream Error {r.text}")
+        content=json_dumps(body),
+    ) as r:
+        if r.status_code != 200:
+            await r.aread()
+            observe_stage("stream_ttfb", account.name, time.perf_counter() - sent_at, failed=True)
+            raise HTTPException(status_code=r.status_code, detail=f"Upstream Error {r.text}")
 
-    try:
-        data_list = r.json()
-    except Exception as e:
-        logger.error(f"❌ JSON 解析失败: {e}")
-        raise HTTPException(status_code=502, detail="Invalid JSON response")
-
-    for data in data_list:
-        for reply in data.get("streamAssistResponse", {}).get("answer", {}).get("replies", []):
-            text = reply.get("groundedContent", {}).get("content", {}).get("text", "")
-            if text and not reply.get("thought"):
-                chunk = create_chunk(chat_id, created_time, model_name, {"content": text}, None)
-                print(f"DEBUG: Yielding text chunk: {chunk}")
-                if is_stream:
-                    yield f"data: {chunk}\n\n"
-    
-    if is_stream:
-        final_chunk = create_chunk(chat_id, created_time, model_name, {}, "stop")
-        print(f"DEBUG: Yielding final text chunk: {final_chunk}")
-        yield f"data: {final_chunk}\n\n"
\ No newline at end of file
+        # 上游确认成功后才输出首个分片，此前的失败仍可以切换账户重试
+        if renderer:
+            yield renderer.role_chunk
+
+        parser = JSONArrayStreamParser()
+        async for raw in r.aiter_text():
+            if not first_byte:
+                # 上游首字节耗时 (widgetStreamAssist 发出请求到收到首个响应体数据)
+                first_byte = True
+                observe_stage("stream_ttfb", account.name, time.perf_counter() - sent_at)
+            try:
+                data_list = parser.feed(raw)
+            except Exception as e:
+                logger.error(f"❌ JSON 解析失败: {e}")
+                raise HTTPException(status_code=502, detail="Invalid JSON response")
+
+            for data in data_list:
+                for reply in data.get("streamAssistResponse", {}).get("answer", {}).get("replies", []):
+                    if result is not None and not result.get("has_generated_files") and reply_has_generated_file(reply):
+                        result["has_generated_files"] = True
+                    text = reply.get("groundedContent", {}).get("content", {}).get("text", "")
+                    if text and not reply.get("thought"):
+                        logger.debug("Yielding text: %r", text)
+                        if result is not None:
+                            result.setdefault("reply", []).append(text)
+                        yield renderer.content(text) if renderer else text
+
+        try:
+            parser.close()
+        except ValueError as e:
+            logger.error(f"❌ JSON 解析失败: {e}")
+            raise HTTPException(status_code=502, detail="Invalid JSON response")
+
+    observe_stage("stream_total", account.name, time.perf_counter() - sent_at)
+    if renderer:
+        yield renderer.stop_chunk
\ No newline at end of file
@@ -0,0 +1,179 @@
+import os
+import time
+from typing import Dict, Optional
+
+import httpx
+
+from config import logger, TIMEOUT_SECONDS, HTTP_POOLS
+
+try:
+    import h2  # noqa: F401  HTTP/2 为可选依赖: pip install "httpx[http2]"
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 默认连接池配置；api 为每个账户各自独立的一组连接
+DEFAULT_POOLS = {
+    "auth": {"max_connections": 10, "max_keepalive": 5, "http2": False},
+    "api": {"max_connections": 50, "max_keepalive": 20, "http2": False},
+    "images": {"max_connections": 20, "max_keepalive": 10, "http2": False},
+}
+
+class PoolStats:
+    """连接池统计：在途请求 (饱和度)、新建连接数、建连耗时与等待空闲连接的耗时"""
+
+    def __init__(self, name: str, max_connections: int, http2: bool):
+        self.name = name
+        self.max_connections = max_connections
+        self.http2 = http2
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.connections_opened = 0
+        self.connect_time_total = 0.0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "http2": self.http2,
+            "max_connections": self.max_connections,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "saturation": round(self.in_flight / self.max_connections, 4) if self.max_connections else 0.0,
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "avg_connect_time": round(self.connect_time_total / self.connections_opened, 4) if self.connections_opened else 0.0,
+            "avg_wait_time": round(self.wait_time_total / self.requests, 4) if self.requests else 0.0,
+            "max_wait_time": round(self.wait_time_max, 4),
+        }
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """响应体关闭时才算请求结束，流式响应在读取期间持续计入在途请求"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, stats: PoolStats):
+        self._stream = stream
+        self._stats = stats
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._stats.in_flight -= 1
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """包装 httpx 传输层，通过 httpcore 的 trace 扩展记录建连与等待连接的耗时"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, stats: PoolStats):
+        self._transport = transport
+        self._stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        stats = self._stats
+        start = time.perf_counter()
+        marks: Dict[str, float] = {}
+
+        async def trace(event: str, info: dict) -> None:
+            now = time.perf_counter()
+            if event == "connection.connect_tcp.started":
+                marks["connect_start"] = now
+            elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                marks["connect_end"] = now
+            elif event.endswith("send_request_headers.started"):
+                marks.setdefault("sent", now)
+
+        request.extensions = {**request.extensions, "trace": trace}
+        stats.requests += 1
+        stats.in_flight += 1
+        stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            stats.in_flight -= 1
+            raise
+
+        connect_time = 0.0
+        if "connect_start" in marks:
+            connect_time = marks.get("connect_end", marks["connect_start"]) - marks["connect_start"]
+            stats.connections_opened += 1
+            stats.connect_time_total += connect_time
+        wait_time = max(0.0, marks.get("sent", start) - start - connect_time)
+        stats.wait_time_total += wait_time
+        stats.wait_time_max = max(stats.wait_time_max, wait_time)
+
+        response.stream = _TrackedStream(response.stream, stats)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+def _env_proxy(scheme: str) -> Optional[str]:
+    if scheme == "https":
+        return os.environ.get("HTTPS_PROXY") or os.environ.get("https_proxy") or os.environ.get("ALL_PROXY") or os.environ.get("all_proxy")
+    return os.environ.get("HTTP_PROXY") or os.environ.get("http_proxy") or os.environ.get("ALL_PROXY") or os.environ.get("all_proxy")
+
+def create_client(name: str, pool_class: str) -> httpx.AsyncClient:
+    """按连接池类别的配置创建带统计的 httpx 客户端，代理沿用 HTTP(S)_PROXY 环境变量"""
+    cfg = {**DEFAULT_POOLS[pool_class], **HTTP_POOLS.get(pool_class, {})}
+    http2 = bool(cfg.get("http2"))
+    if http2 and not HTTP2_AVAILABLE:
+        logger.warning(f"⚠️ 连接池 {name} 配置了 HTTP/2 但未安装 h2，回退到 HTTP/1.1 (pip install \"httpx[http2]\")")
+        http2 = False
+
+    limits = httpx.Limits(max_keepalive_connections=cfg["max_keepalive"], max_connections=cfg["max_connections"])
+    stats = PoolStats(name, cfg["max_connections"], http2)
+    POOL_STATS[name] = stats
+
+    def transport(scheme: str) -> InstrumentedTransport:
+        proxy = _env_proxy(scheme)
+        return InstrumentedTransport(
+            httpx.AsyncHTTPTransport(verify=False, http2=http2, limits=limits, proxy=proxy),
+            stats,
+        )
+
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(TIMEOUT_SECONDS, connect=60.0),
+        trust_env=False,
+        mounts={"http://": transport("http"), "https://": transport("https")},
+    )
+
+# ---------- 全局客户端 ----------
+POOL_STATS: Dict[str, PoolStats] = {}
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+def get_client(pool_class: str) -> httpx.AsyncClient:
+    """按上游类别获取共享客户端：auth (business.gemini.google)、images (用户图片 URL)"""
+    client = _clients.get(pool_class)
+    if client is None:
+        client = _clients[pool_class] = create_client(pool_class, pool_class)
+    return client
+
+def get_account_client(account_name: str) -> httpx.AsyncClient:
+    """获取账户专属的 discoveryengine 客户端，单个繁忙账户不会占满其他账户的连接"""
+    key = f"api:{account_name}"
+    client = _clients.get(key)
+    if client is None:
+        client = _clients[key] = create_client(key, "api")
+    return client
+
+async def close_account_client(account_name: str) -> None:
+    key = f"api:{account_name}"
+    client = _clients.pop(key, None)
+    POOL_STATS.pop(key, None)
+    if client is not None:
+        await client.aclose()
+
+async def close_all_clients() -> None:
+    for client in list(_clients.values()):
+        await client.aclose()
+    _clients.clear()
+
+def pool_stats() -> Dict[str, dict]:
+    return {name: s.stats() for name, s in POOL_STATS.items()}
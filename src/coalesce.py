@@ -0,0 +1,150 @@
+import json
+import asyncio
+import hashlib
+from typing import AsyncIterator, Dict, List, Optional
+
+from config import logger, RESPONSE_CACHE_ENABLED
+from models import ChatRequest
+from metrics import RequestTimings
+from cache import RESPONSE_CACHE
+
+def has_images(req: ChatRequest) -> bool:
+    return any(
+        isinstance(msg.content, list) and any(part.get("type") == "image_url" for part in msg.content)
+        for msg in req.messages
+    )
+
+def request_key(req: ChatRequest, tenant: str) -> str:
+    """规范化的请求指纹：调用方、模型与各消息的角色和文本 (采样参数不会发送到上游，不计入)"""
+    messages = []
+    for msg in req.messages:
+        if isinstance(msg.content, str):
+            text = msg.content
+        else:
+            text = "".join(part.get("text", "") for part in msg.content if part.get("type") == "text")
+        messages.append((msg.role, text))
+    raw = json.dumps([tenant, req.model, messages], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+async def replay(pieces: List[str]) -> AsyncIterator[str]:
+    """按原有分片输出缓存的回复"""
+    for piece in pieces:
+        yield piece
+
+class Flight:
+    """一次进行中的上游生成，多个相同请求共享其输出
+
+    生成在独立任务中进行，输出的文本片段保存在缓冲区中，各订阅者从头读取后再跟随新片段；
+    所有订阅者都离开 (如客户端断开) 时取消上游请求。
+    """
+
+    def __init__(self, key: str, producer: AsyncIterator[str], timings: RequestTimings, cacheable: bool):
+        self.key = key
+        self.timings = timings
+        self.cacheable = cacheable
+        self.pieces: List[str] = []
+        self.size = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        # 所有订阅者都已离开、上游请求正在取消，不再接受新的订阅者
+        self.abandoned = False
+        self._changed = asyncio.Event()
+        self._producer = producer
+        self.task = asyncio.ensure_future(self._run())
+
+    @property
+    def account(self) -> str:
+        """实际完成生成的账户 (故障转移后会变化)"""
+        return self.timings.account
+
+    async def _run(self) -> None:
+        try:
+            async for piece in self._producer:
+                self.pieces.append(piece)
+                self.size += len(piece)
+                self._notify()
+        except asyncio.CancelledError as e:
+            self.error = e
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+            COALESCER.finish(self)
+            await self._producer.aclose()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        self.subscribers += 1
+        i = 0
+        try:
+            while True:
+                while i < len(self.pieces):
+                    yield self.pieces[i]
+                    i += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.abandoned = True
+                logger.info("🔌 共享请求的订阅者均已离开，取消上游请求")
+                self.task.cancel()
+
+class Coalescer:
+    """相同请求合并 (single-flight)：同一指纹的请求在进行中时，后到的请求订阅已有的生成而不再请求上游
+
+    完成的生成在开启响应缓存时写入 RESPONSE_CACHE，之后相同的请求直接返回缓存内容。
+    """
+
+    def __init__(self, response_cache=None):
+        self.response_cache = response_cache
+        self._flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def get(self, key: str) -> Optional[Flight]:
+        flight = self._flights.get(key)
+        return flight if flight is not None and not flight.abandoned and flight.error is None else None
+
+    def start(self, key: str, producer: AsyncIterator[str], timings: RequestTimings, cacheable: bool) -> Flight:
+        flight = Flight(key, producer, timings, cacheable)
+        self._flights[key] = flight
+        # 任务结束时移除 (在 _run 开始前就被取消时 _run 的 finally 不会执行)
+        flight.task.add_done_callback(lambda _: self._remove(flight))
+        self.leaders += 1
+        return flight
+
+    def join(self, flight: Flight) -> AsyncIterator[str]:
+        self.coalesced += 1
+        logger.info(f"🔗 合并相同请求，共享进行中的生成 (账户 {flight.account})")
+        return flight.subscribe()
+
+    def _remove(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def finish(self, flight: Flight) -> None:
+        """生成结束 (含失败或取消) 时由 Flight 调用，成功的回复写入响应缓存"""
+        if flight.error is None and flight.cacheable and self.response_cache is not None:
+            self.response_cache.set(
+                flight.key,
+                {"pieces": flight.pieces, "account": flight.account},
+                size=flight.size,
+            )
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+COALESCER = Coalescer(RESPONSE_CACHE if RESPONSE_CACHE_ENABLED else None)
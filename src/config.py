@@ -1,23 +1,38 @@
 import os
-import logging
-import httpx
 import json
-from typing import Dict, Any
+import queue
+import atexit
+import logging
+import logging.handlers
 from pathlib import Path
 
 # ---------- 日志配置 ----------
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(message)s",
-    datefmt="%H:%M:%S",
-)
+# 日志记录经队列交给后台线程写出，事件循环中不做同步的终端 IO
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s", datefmt="%H:%M:%S"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_output)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+_log_handler = logging.handlers.QueueHandler(_log_queue)
+_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_log_handler])
 logger = logging.getLogger("gemini")
 
 # ---------- 读取应用配置 ----------
-APP_CONFIG_PATH = Path(__file__).resolve().parent.parent / "config" / "app.json"
+# GEMINI_APP_CONFIG 环境变量可指定其他配置文件 (如基准测试使用的配置)
+APP_CONFIG_PATH = Path(os.environ.get("GEMINI_APP_CONFIG") or Path(__file__).resolve().parent.parent / "config" / "app.json")
+
+def read_app_config(path: Path = APP_CONFIG_PATH) -> dict:
+    """读取应用配置文件，失败时抛出异常"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError("应用配置必须是 JSON 对象")
+    return data
+
 try:
-    with open(APP_CONFIG_PATH, 'r', encoding='utf-8') as f:
-        app_config = json.load(f)
+    app_config = read_app_config()
 except FileNotFoundError:
     logger.warning(f"⚠️ 应用配置文件未找到: {APP_CONFIG_PATH}，使用默认配置")
     app_config = {}
@@ -26,16 +41,50 @@ except Exception as e:
     app_config = {}
 
 # ---------- 配置 ----------
+# 网关日志级别；设为 DEBUG 时会逐个输出回复分片
+LOG_LEVEL = app_config.get("log_level", "INFO")
+logger.setLevel(LOG_LEVEL.upper())
 TIMEOUT_SECONDS = 600
+# 单个请求的总截止时间 (含重试与流式输出)，超时后取消上游请求
+REQUEST_TIMEOUT_SECONDS = app_config.get("request_timeout", TIMEOUT_SECONDS)
+# 非流式请求及流式首包前检测客户端断开的轮询间隔
+DISCONNECT_POLL_INTERVAL = app_config.get("disconnect_poll_interval", 1.0)
 PROXY = app_config.get("proxy", "http://127.0.0.1:10808")
 HOST = app_config.get("host", "0.0.0.0")
 PORT = app_config.get("port", 8000)
 BASE_URL = app_config.get("base_url", "http://localhost:8000")
+# 上游地址 (基准测试时指向本地模拟服务)
+UPSTREAM_API_BASE = app_config.get("upstream_api_base", "https://biz-discoveryengine.googleapis.com")
+UPSTREAM_AUTH_BASE = app_config.get("upstream_auth_base", "https://business.gemini.google")
+
+# ---------- 流式输出 ----------
+# 合并该时间窗口 (毫秒) 内到达的回复片段后再输出一个 SSE 分片，0 表示逐片段输出；
+# 客户端可用 X-SSE-Coalesce-Window 请求头按请求指定 (最大 SSE_COALESCE_MAX_WINDOW)
+SSE_COALESCE_WINDOW_MS = app_config.get("sse_coalesce_window", 0)
+SSE_COALESCE_MAX_WINDOW_MS = 500
+# 合并窗口内累计的文本达到该字符数时立即输出
+SSE_COALESCE_MAX_CHARS = app_config.get("sse_coalesce_max_chars", 2048)
 
 # ---------- 图片生成相关常量 ----------
 BASE_DIR = Path(__file__).resolve().parent
-IMAGE_SAVE_DIR = BASE_DIR.parent / "generated_images"
-IMAGE_SAVE_DIR.mkdir(exist_ok=True)
+# 相对路径相对于项目根目录
+IMAGE_SAVE_DIR = BASE_DIR.parent / app_config.get("image_save_dir", "generated_images")
+IMAGE_SAVE_DIR.mkdir(parents=True, exist_ok=True)
+IMAGE_MAX_BYTES = app_config.get("image_max_bytes", 1024 * 1024 * 1024)
+IMAGE_MAX_AGE = app_config.get("image_max_age", 7 * 24 * 3600)
+IMAGE_JANITOR_INTERVAL = app_config.get("image_janitor_interval", 300)
+# 仅在回复中检测到生成的文件时才查询会话文件列表；关闭后每次回复后都会查询
+DETECT_GENERATED_FILES = app_config.get("detect_generated_files", True)
+
+# ---------- 请求体 ----------
+# 对话请求体的最大字节数 (0 表示不限制)；请求中的 base64 图片在读取时提取出来，超过阈值的转存到临时文件
+MAX_REQUEST_BYTES = app_config.get("max_request_bytes", 100 * 1024 * 1024)
+REQUEST_SPOOL_THRESHOLD = app_config.get("request_spool_threshold", 1024 * 1024)
+
+# ---------- 图片上传/下载并发 ----------
+UPLOAD_CONCURRENCY = app_config.get("upload_concurrency", 4)
+IMAGE_FETCH_CONCURRENCY = app_config.get("image_fetch_concurrency", 4)
+IMAGE_SAVE_CONCURRENCY = app_config.get("image_save_concurrency", 4)
 
 # ---------- 模型映射配置 ----------
 MODEL_MAPPING = {
@@ -45,18 +94,96 @@ MODEL_MAPPING = {
     "gemini-3-pro-preview": "gemini-3-pro-preview"
 }
 
-# ---------- 全局 Session 缓存 ----------
-# key: conversation_key -> {"session_id": str, "updated_at": float, "account": str}
-SESSION_CACHE: Dict[str, Dict[str, Any]] = {}
-CHAT_ID_TO_ACCOUNT: Dict[str, str] = {}
+# ---------- JWT 主动刷新 ----------
+JWT_REFRESH_RATIO = app_config.get("jwt_refresh_ratio", 0.8)
+JWT_REFRESH_JITTER = app_config.get("jwt_refresh_jitter", 0.05)
+JWT_RETRY_BASE = app_config.get("jwt_retry_base", 1.0)
+JWT_RETRY_MAX = app_config.get("jwt_retry_max", 30.0)
+
+# ---------- token 计数 ----------
+# 分词后端: cjk (本地估算，区分中日韩文字与拉丁文字) | tiktoken (需安装 tiktoken)
+TOKENIZER = app_config.get("tokenizer", "cjk")
+# 每张图片计入的 token 数
+IMAGE_TOKENS = app_config.get("image_tokens", 258)
+# 按消息内容缓存 token 数的最大条目数
+TOKEN_CACHE_SIZE = app_config.get("token_cache_size", 10000)
+# token 数缓存条目的保留时间 (秒)
+TOKEN_CACHE_TTL = app_config.get("token_cache_ttl", 3600)
+
+# ---------- Session 缓存配置 ----------
+SESSION_CACHE_SIZE = app_config.get("session_cache_size", 10000)
+SESSION_TTL_SECONDS = app_config.get("session_ttl", 300)
+CHAT_ID_CACHE_SIZE = app_config.get("chat_id_cache_size", 10000)
+CHAT_ID_TTL_SECONDS = app_config.get("chat_id_ttl", 3600)
+CACHE_SWEEP_INTERVAL = app_config.get("cache_sweep_interval", 30)
+
+# ---------- 远程图片缓存 ----------
+IMAGE_URL_CACHE_SIZE = app_config.get("image_url_cache_size", 256)
+IMAGE_URL_CACHE_TTL = app_config.get("image_url_cache_ttl", 3600)
+IMAGE_URL_CACHE_BYTES = app_config.get("image_url_cache_bytes", 256 * 1024 * 1024)
+
+# ---------- 相同请求合并与响应缓存 ----------
+# 相同的纯文本请求 (同一调用方、模型与消息) 在进行中时共享同一次上游生成
+REQUEST_COALESCING = app_config.get("request_coalescing", True)
+# 响应缓存默认关闭，仅适合输出可复用的确定性任务；字节预算按回复文本长度计算
+RESPONSE_CACHE_ENABLED = app_config.get("response_cache", False)
+RESPONSE_CACHE_SIZE = app_config.get("response_cache_size", 1000)
+RESPONSE_CACHE_TTL = app_config.get("response_cache_ttl", 300)
+RESPONSE_CACHE_BYTES = app_config.get("response_cache_bytes", 64 * 1024 * 1024)
+
+# ---------- Session 预热池 ----------
+SESSION_POOL_SIZE = app_config.get("session_pool_size", 2)
+SESSION_POOL_MAX_AGE = app_config.get("session_pool_max_age", 600)
+SESSION_POOL_INTERVAL = app_config.get("session_pool_interval", 30)
 
 # ---------- 负载均衡 ----------
-last_account_index = -1
-
-# ---------- HTTP 客户端 ----------
-http_client = httpx.AsyncClient(
-    verify=False,
-    http2=False,
-    timeout=httpx.Timeout(TIMEOUT_SECONDS, connect=60.0),
-    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50)
-)
\ No newline at end of file
+SCHEDULER_POLICY = app_config.get("scheduler_policy", "p2c")  # round_robin | least_in_flight | p2c
+ACCOUNT_MAX_CONCURRENCY = app_config.get("account_max_concurrency", 32)
+EWMA_ALPHA = app_config.get("ewma_alpha", 0.2)
+CIRCUIT_FAILURE_THRESHOLD = app_config.get("circuit_failure_threshold", 3)
+CIRCUIT_COOLDOWN_SECONDS = app_config.get("circuit_cooldown", 30)
+
+# ---------- 准入控制 ----------
+# 所有健康账户的并发名额都已占满时，请求最多排队的数量 (0 表示不排队，直接返回 429) 与最长等待时间
+ADMISSION_QUEUE_SIZE = app_config.get("admission_queue_size", 256)
+ADMISSION_QUEUE_TIMEOUT = app_config.get("admission_queue_timeout", 30)
+
+# ---------- 故障转移重试 ----------
+RETRY_MAX_ATTEMPTS = app_config.get("retry_max_attempts", 2)
+RETRY_DEADLINE_SECONDS = app_config.get("retry_deadline", 60)
+
+# ---------- 对冲请求 ----------
+# 首 token (含 Session 创建) 超过账户近期延迟的 hedge_quantile 分位数仍未到达时，在另一个健康账户上发起相同请求
+HEDGING_ENABLED = app_config.get("hedging", False)
+HEDGE_QUANTILE = app_config.get("hedge_quantile", 0.95)
+# 对冲延迟的下限 (秒)，避免延迟很低时频繁对冲
+HEDGE_MIN_DELAY = app_config.get("hedge_min_delay", 0.5)
+# 每秒最多发起的对冲次数
+HEDGE_MAX_PER_SECOND = app_config.get("hedge_max_per_second", 1.0)
+# 账户的首 token 延迟样本少于该数量时不对冲
+HEDGE_MIN_SAMPLES = app_config.get("hedge_min_samples", 20)
+
+# ---------- 状态存储 ----------
+# memory: 状态保存在进程内 (单 worker)；sqlite: 多个 worker 共享同一个 SQLite (WAL) 数据库
+# GEMINI_STATE_BACKEND 环境变量优先，gemini.py 以多 worker 启动时会通过它切换到 sqlite
+STATE_BACKEND = os.environ.get("GEMINI_STATE_BACKEND") or app_config.get("state_backend", "memory")
+# 相对路径相对于项目根目录
+STATE_DB_PATH = BASE_DIR.parent / app_config.get("state_db_path", "data/state.db")
+# 各 worker 向共享存储同步调度器在途计数与熔断状态的间隔
+STATE_SYNC_INTERVAL = app_config.get("state_sync_interval", 1.0)
+# memory 后端定期将 Session 缓存、chat_id 映射与各账户 JWT 快照到该 SQLite 文件，重启后恢复仍有效的条目；设为空字符串关闭
+_snapshot_path = app_config.get("state_snapshot_path", "data/snapshot.db")
+STATE_SNAPSHOT_PATH = BASE_DIR.parent / _snapshot_path if _snapshot_path else None
+STATE_SNAPSHOT_INTERVAL = app_config.get("state_snapshot_interval", 60)
+WORKERS = app_config.get("workers", 1)
+
+# ---------- 配置热更新 ----------
+# 定期检查账户配置与 app.json 的修改时间，变化后重新加载 (秒，0 表示关闭)
+CONFIG_WATCH_INTERVAL = app_config.get("config_watch_interval", 5)
+# POST /admin/reload 的访问令牌 (Authorization: Bearer <token>)；为空时该接口不可用
+ADMIN_TOKEN = app_config.get("admin_token", "")
+
+# ---------- HTTP 连接池 ----------
+# 按上游类别划分: auth (getoxsrf)、api (discoveryengine，每个账户独立一组连接)、images (用户图片 URL)
+# 每类可配置 max_connections / max_keepalive / http2，未配置的项使用 clients.DEFAULT_POOLS
+HTTP_POOLS = app_config.get("http_pools", {})
@@ -1,10 +1,15 @@
 import os
+import argparse
 import uvicorn
 from auth import accounts
 from main import app
-from config import HOST, PORT, PROXY
+from config import HOST, PORT, PROXY, WORKERS, STATE_BACKEND
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gemini-Business OpenAI Gateway")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker 进程数，大于 1 时使用共享的 sqlite 状态存储")
+    args = parser.parse_args()
+
     if not accounts:
         print("Error: No accounts loaded.")
         exit(1)
@@ -16,4 +21,12 @@ if __name__ == "__main__":
         print(f"Using proxy: {PROXY}")
     
     print(f"Starting server on {HOST}:{PORT}")
-    uvicorn.run(app, host=HOST, port=PORT)
\ No newline at end of file
+    if args.workers > 1:
+        # 多 worker 需要共享 Session 缓存、chat_id 映射、调度状态与 JWT，worker 进程继承该环境变量
+        if STATE_BACKEND == "memory":
+            os.environ["GEMINI_STATE_BACKEND"] = "sqlite"
+            print("Using sqlite state backend for multiple workers")
+        print(f"Workers: {args.workers}")
+        uvicorn.run("main:app", host=HOST, port=PORT, workers=args.workers)
+    else:
+        uvicorn.run(app, host=HOST, port=PORT)
@@ -0,0 +1,141 @@
+import time
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+from config import (
+    logger, HEDGING_ENABLED, HEDGE_QUANTILE, HEDGE_MIN_DELAY, HEDGE_MAX_PER_SECOND, HEDGE_MIN_SAMPLES,
+)
+
+T = TypeVar("T")
+
+# 每个账户保留的最近首 token 延迟样本数
+_WINDOW = 200
+
+def _quantile(samples, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+class Hedger:
+    """对冲请求：首 token 迟迟未到时，在另一个健康账户上发起相同的请求，先拿到首 token 的一方胜出
+
+    对冲延迟按账户最近首 token 延迟的分位数 (默认 p95) 自适应，样本不足时不对冲；
+    对冲频率由令牌桶限制在每秒 max_per_second 次以内，控制额外的上游调用。
+    """
+
+    def __init__(self, enabled: bool, quantile: float, min_delay: float, max_per_second: float, min_samples: int):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_per_second = max_per_second
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+        self._tokens = max(1.0, max_per_second)
+        self._refilled_at = time.monotonic()
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.skipped = {"budget": 0, "no_account": 0}
+
+    def observe(self, account: str, seconds: float) -> None:
+        """记录账户的首 token 延迟 (从发起尝试到收到首段回复，含 Session 创建与图片上传)"""
+        samples = self._samples.get(account)
+        if samples is None:
+            samples = self._samples[account] = deque(maxlen=_WINDOW)
+        samples.append(seconds)
+
+    def delay(self, account: str) -> Optional[float]:
+        """该账户的对冲延迟；未开启或样本不足时返回 None (不对冲)"""
+        if not self.enabled:
+            return None
+        samples = self._samples.get(account)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        return max(self.min_delay, _quantile(samples, self.quantile))
+
+    def try_budget(self) -> bool:
+        """从令牌桶中取一次对冲的额度"""
+        now = time.monotonic()
+        capacity = max(1.0, self.max_per_second)
+        self._tokens = min(capacity, self._tokens + (now - self._refilled_at) * self.max_per_second)
+        self._refilled_at = now
+        if self._tokens < 1.0:
+            self.skipped["budget"] += 1
+            return False
+        self._tokens -= 1.0
+        return True
+
+    async def race(self, primary: Awaitable[T], start_hedge: Callable[[], Optional[Awaitable[T]]], delay: float,
+                   discard: Callable[[T], Awaitable[None]]) -> Tuple[bool, T, Optional[BaseException]]:
+        """等待 primary；delay 秒后仍未完成时调用 start_hedge 发起对冲 (返回 None 表示无法对冲)
+
+        返回 (是否由对冲胜出, 胜出方的结果, primary 的异常)。落败的一方被取消，已完成的结果交给 discard 清理；
+        一方失败时继续等待另一方，两方都失败时抛出 primary 的异常。
+        """
+        tasks = [asyncio.ensure_future(primary)]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                hedge = start_hedge()
+                if hedge is not None:
+                    self.hedged += 1
+                    tasks.append(asyncio.ensure_future(hedge))
+                    logger.info(f"🪁 首 token 超过 {delay:.2f}s 未到达，发起对冲请求")
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 同时完成时优先采用 primary
+                for task in sorted(done, key=tasks.index):
+                    if task.exception() is None:
+                        winner = task
+                        break
+                if winner is not None:
+                    break
+            if winner is None:
+                raise tasks[0].exception()
+            hedge_won = winner is not tasks[0]
+            if len(tasks) > 1:
+                if hedge_won:
+                    self.hedge_wins += 1
+                else:
+                    self.primary_wins += 1
+            primary_error = None
+            if hedge_won and tasks[0].done() and not tasks[0].cancelled():
+                primary_error = tasks[0].exception()
+            return hedge_won, winner.result(), primary_error
+        finally:
+            # 取消落败方并等待其结束 (各自释放资源)；已成功完成但未被采用的结果交给 discard
+            losers = [task for task in tasks if task is not winner]
+            for task in losers:
+                task.cancel()
+            for result in await asyncio.gather(*losers, return_exceptions=True):
+                if not isinstance(result, BaseException):
+                    await discard(result)
+
+    def first_token_stats(self) -> Dict[str, dict]:
+        stats = {}
+        for account, samples in self._samples.items():
+            if samples:
+                stats[account] = {
+                    "samples": len(samples),
+                    "p50": round(_quantile(samples, 0.5), 4),
+                    "p95": round(_quantile(samples, 0.95), 4),
+                    "p99": round(_quantile(samples, 0.99), 4),
+                }
+        return stats
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "quantile": self.quantile,
+            "min_delay": self.min_delay,
+            "max_per_second": self.max_per_second,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "primary_wins": self.primary_wins,
+            "skipped": dict(self.skipped),
+            "first_token": self.first_token_stats(),
+        }
+
+HEDGER = Hedger(HEDGING_ENABLED, HEDGE_QUANTILE, HEDGE_MIN_DELAY, HEDGE_MAX_PER_SECOND, HEDGE_MIN_SAMPLES)
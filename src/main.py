@@ -1,46 +1,110 @@
-import json
+import hmac
 import uuid
 import time
 import random
-from typing import List
+import asyncio
+import hashlib
+from typing import AsyncIterator, Callable, List, Optional
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi.responses import Response
 from fastapi.staticfiles import StaticFiles
 
-from config import logger, MODEL_MAPPING, last_account_index, CHAT_ID_TO_ACCOUNT, SESSION_CACHE, IMAGE_SAVE_DIR
+from config import (
+    logger, MODEL_MAPPING, IMAGE_SAVE_DIR, CACHE_SWEEP_INTERVAL, RETRY_DEADLINE_SECONDS, DETECT_GENERATED_FILES,
+    REQUEST_TIMEOUT_SECONDS, REQUEST_COALESCING, RESPONSE_CACHE_ENABLED, SSE_COALESCE_WINDOW_MS, SSE_COALESCE_MAX_WINDOW_MS,
+    CONFIG_WATCH_INTERVAL, ADMIN_TOKEN,
+)
+from cache import SESSION_CACHE, CHAT_ID_TO_ACCOUNT, IMAGE_URL_CACHE, RESPONSE_CACHE, TOKEN_CACHE
+from tokens import calculate_usage
+from coalesce import COALESCER, has_images, request_key, replay
+from pool import acquire_session, run_pool_maintainer, pool_stats
+from clients import close_all_clients, pool_stats as http_pool_stats
+from scheduler import scheduler, error_status
+from admission import ADMISSION
+from storage import run_image_janitor, STORAGE_STATS
+from retry import RETRY_STATS, should_retry
+from hedge import HEDGER
+from metrics import REGISTRY, begin_request, stage, observe_stage
+from state import STATE_STORE, WORKER_ID
+from snapshot import SNAPSHOT
+from cancellation import ClientDisconnected, run_cancellable, prepend_chunk, CancellableStreamingResponse
 from models import Message, ChatRequest, ChatImage
-from auth import Account, accounts
-from chat import parse_last_message, build_full_context_text, create_chunk, stream_chat_generator, get_conversation_key
-from session import create_google_session, list_session_files, save_generated_image, upload_context_file
-
-def estimate_tokens(content) -> int:
-    """简单估算token数，大约4个字符1个token"""
-    if isinstance(content, str):
-        return len(content) // 4
-    elif isinstance(content, list):
-        total = 0
-        for item in content:
-            if isinstance(item, str):
-                total += len(item) // 4
-            elif isinstance(item, dict) and "text" in item:
-                total += len(item["text"]) // 4
-        return total
-    return 0
-
-def calculate_usage(prompt_text: str, completion_content) -> dict:
-    """计算token使用情况"""
-    prompt_tokens = estimate_tokens(prompt_text)
-    completion_tokens = estimate_tokens(completion_content)
-    return {
-        "prompt_tokens": prompt_tokens,
-        "completion_tokens": completion_tokens,
-        "total_tokens": prompt_tokens + completion_tokens
-    }
+from payload import read_chat_request, close_inline_images
+from auth import Account, accounts, start_jwt_refreshers, stop_jwt_refreshers
+from reload import RELOADER
+from chat import parse_last_message, build_full_context_text, ChunkRenderer, render_chunks, stream_chat_generator, get_conversation_key, get_history_hash, get_reply_hash, get_unseen_messages
+from session import list_session_files, save_generated_images, upload_context_files, UPLOAD_STATS
+
+def get_sse_window(req: ChatRequest, header: Optional[str]) -> float:
+    """本请求的 SSE 分片合并窗口 (秒)：请求头 X-SSE-Coalesce-Window (毫秒) 优先，其次使用配置"""
+    if not req.stream:
+        return 0.0
+    window_ms = SSE_COALESCE_WINDOW_MS
+    if header is not None:
+        try:
+            window_ms = float(header)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid X-SSE-Coalesce-Window header")
+    return min(max(window_ms, 0.0), SSE_COALESCE_MAX_WINDOW_MS) / 1000
+
+def get_caller_identity(req: ChatRequest, authorization: Optional[str]) -> str:
+    """调用方标识：优先使用 ChatRequest.user，其次使用 API Key 的摘要"""
+    if req.user:
+        return f"user:{req.user}"
+    if authorization:
+        api_key = authorization[7:] if authorization.lower().startswith("bearer ") else authorization
+        return f"key:{hashlib.sha256(api_key.encode()).hexdigest()[:16]}"
+    return "anonymous"
 
 # ---------- OpenAI 兼容接口 ----------
 app = FastAPI(title="Gemini-Business OpenAI Gateway")
 
+@app.on_event("startup")
+async def start_background_tasks():
+    # 恢复上次退出前的状态快照 (需在 JWT 刷新与 Session 池预热开始之前)
+    if SNAPSHOT is not None:
+        try:
+            SNAPSHOT.restore()
+        except Exception as e:
+            logger.error(f"❌ 恢复状态快照失败: {e}")
+    # 后台定期清理过期缓存条目
+    app.state.background_tasks = [
+        asyncio.create_task(SESSION_CACHE.run_sweeper(CACHE_SWEEP_INTERVAL)),
+        asyncio.create_task(CHAT_ID_TO_ACCOUNT.run_sweeper(CACHE_SWEEP_INTERVAL)),
+        *([asyncio.create_task(RESPONSE_CACHE.run_sweeper(CACHE_SWEEP_INTERVAL))] if RESPONSE_CACHE_ENABLED else []),
+        # 后台预热并维护各账户的 Session 池
+        asyncio.create_task(run_pool_maintainer()),
+        # 后台按大小与时间预算清理生成图片目录
+        asyncio.create_task(run_image_janitor()),
+        # 后台主动刷新各账户 JWT
+        *start_jwt_refreshers(),
+        # 定期放行准入队列中等待的请求 (熔断冷却结束、其他 worker 释放名额时)
+        asyncio.create_task(ADMISSION.run_dispatcher()),
+    ]
+    if STATE_STORE is not None:
+        # 多 worker 共享调度器在途计数与熔断状态
+        app.state.background_tasks.append(asyncio.create_task(scheduler.run_state_sync()))
+    if SNAPSHOT is not None:
+        # 定期写入状态快照
+        app.state.background_tasks.append(asyncio.create_task(SNAPSHOT.run()))
+    if CONFIG_WATCH_INTERVAL > 0:
+        # 配置文件修改后自动重新加载
+        app.state.background_tasks.append(asyncio.create_task(RELOADER.run_watcher()))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
+    # 重新加载配置后启动的 JWT 刷新任务不在 background_tasks 中
+    stop_jwt_refreshers()
+    if SNAPSHOT is not None:
+        try:
+            await SNAPSHOT.save(final=True)
+        except Exception as e:
+            logger.error(f"❌ 写入状态快照失败: {e}")
+    await close_all_clients()
+
 # 挂载静态文件
 app.mount("/images", StaticFiles(directory=str(IMAGE_SAVE_DIR)), name="images")
 
@@ -60,129 +124,461 @@ async def list_models():
 
 @app.get("/v1/chat/completions/{chat_id}/account")
 async def get_account(chat_id: str):
-    account = CHAT_ID_TO_ACCOUNT.get(chat_id)
+    account = await CHAT_ID_TO_ACCOUNT.aget(chat_id)
     if account:
         return {"account": account}
     else:
         raise HTTPException(status_code=404, detail="Chat ID not found")
 
+@app.get("/stats")
+async def get_stats():
+    return {
+        "worker": WORKER_ID,
+        "session_cache": SESSION_CACHE.stats(),
+        "chat_id_cache": CHAT_ID_TO_ACCOUNT.stats(),
+        "image_url_cache": IMAGE_URL_CACHE.stats(),
+        "token_cache": TOKEN_CACHE.stats(),
+        "response_cache": RESPONSE_CACHE.stats() if RESPONSE_CACHE_ENABLED else None,
+        "coalescing": COALESCER.stats(),
+        "uploads": dict(UPLOAD_STATS),
+        "image_storage": dict(STORAGE_STATS),
+        "session_pools": pool_stats(),
+        "jwt": {acc.name: acc.jwt_mgr.stats() for acc in accounts},
+        "scheduler": scheduler.stats(),
+        "admission": ADMISSION.stats(),
+        "retry": RETRY_STATS.stats(),
+        "hedging": HEDGER.stats(),
+        "http_pools": http_pool_stats(),
+        "snapshot": SNAPSHOT.stats() if SNAPSHOT is not None else None,
+        "config_reload": RELOADER.stats(),
+    }
+
+# ---------- 管理接口 ----------
+def check_admin(authorization: Optional[str]) -> None:
+    """管理接口鉴权：校验 Bearer 令牌；未配置 admin_token 时管理接口不可用
+
+    不按来源地址放行本机请求：部署在反向代理之后时，所有外部请求的来源地址都是本机。
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = authorization[7:] if authorization and authorization.lower().startswith("bearer ") else ""
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@app.post("/admin/reload")
+async def admin_reload(authorization: Optional[str] = Header(None)):
+    """重新加载账户配置与 app.json，返回账户变化与各配置项的生效情况"""
+    check_admin(authorization)
+    try:
+        return await RELOADER.reload("admin")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Reload failed: {e}")
+
+# ---------- Prometheus 指标 ----------
+def _cache_metrics(attr: str):
+    return lambda: [((c.name,), getattr(c, attr)) for c in (SESSION_CACHE, CHAT_ID_TO_ACCOUNT, IMAGE_URL_CACHE, RESPONSE_CACHE, TOKEN_CACHE)]
+
+REGISTRY.collector("gateway_cache_hits_total", "缓存命中次数", "counter", ("cache",), _cache_metrics("hits"))
+REGISTRY.collector("gateway_cache_misses_total", "缓存未命中次数", "counter", ("cache",), _cache_metrics("misses"))
+REGISTRY.collector("gateway_cache_evictions_total", "缓存淘汰次数", "counter", ("cache",), _cache_metrics("evictions"))
+REGISTRY.collector("gateway_cache_entries", "缓存条目数", "gauge", ("cache",),
+                   lambda: [((c.name,), len(c)) for c in (SESSION_CACHE, CHAT_ID_TO_ACCOUNT, IMAGE_URL_CACHE, RESPONSE_CACHE, TOKEN_CACHE)])
+REGISTRY.collector("gateway_upstream_calls_saved_total", "因合并相同请求或命中响应缓存而省去的上游生成次数", "counter", ("reason",),
+                   lambda: [(("coalesced",), COALESCER.coalesced), (("response_cache",), RESPONSE_CACHE.hits)])
+REGISTRY.collector("gateway_account_in_flight", "账户在途请求数 (本 worker)", "gauge", ("account",),
+                   lambda: [((name,), s["in_flight"]) for name, s in scheduler.stats()["accounts"].items()])
+REGISTRY.collector("gateway_account_ewma_latency_seconds", "账户请求延迟 EWMA", "gauge", ("account",),
+                   lambda: [((name,), s["ewma_latency"]) for name, s in scheduler.stats()["accounts"].items()])
+REGISTRY.collector("gateway_account_circuit_open", "账户是否处于熔断状态", "gauge", ("account",),
+                   lambda: [((name,), int(s["circuit_open"])) for name, s in scheduler.stats()["accounts"].items()])
+REGISTRY.collector("gateway_admission_queue_depth", "准入队列中等待的请求数", "gauge", (), lambda: [((), len(ADMISSION))])
+REGISTRY.collector("gateway_admission_rejected_total", "准入控制拒绝的请求数 (429)", "counter", ("reason",),
+                   lambda: [((k,), v) for k, v in ADMISSION.rejected.items()])
+REGISTRY.collector("gateway_admission_queued_total", "进入准入队列排队的请求数", "counter", (), lambda: [((), ADMISSION.queued)])
+REGISTRY.collector("gateway_session_pool_ready", "预热池中可用的 Session 数", "gauge", ("account",),
+                   lambda: [((name,), s["ready"]) for name, s in pool_stats().items()])
+REGISTRY.collector("gateway_session_pool_hits_total", "从预热池取到 Session 的次数", "counter", ("account",),
+                   lambda: [((name,), s["hits"]) for name, s in pool_stats().items()])
+REGISTRY.collector("gateway_session_pool_misses_total", "预热池为空、当场创建 Session 的次数", "counter", ("account",),
+                   lambda: [((name,), s["misses"]) for name, s in pool_stats().items()])
+REGISTRY.collector("gateway_http_pool_in_flight", "HTTP 连接池在途请求数", "gauge", ("pool",),
+                   lambda: [((name,), s["in_flight"]) for name, s in http_pool_stats().items()])
+REGISTRY.collector("gateway_retries_total", "故障转移重试次数", "counter", (), lambda: [((), RETRY_STATS.retries)])
+REGISTRY.collector("gateway_hedges_total", "对冲请求次数 (按胜出方)", "counter", ("winner",),
+                   lambda: [(("hedge",), HEDGER.hedge_wins), (("primary",), HEDGER.primary_wins)])
+REGISTRY.collector("gateway_uploads_total", "图片上传次数", "counter", ("result",),
+                   lambda: [((k,), v) for k, v in UPLOAD_STATS.items()])
+REGISTRY.collector("gateway_config_reloads_total", "配置重新加载次数", "counter", ("result",),
+                   lambda: [(("ok",), RELOADER.reloads), (("error",), RELOADER.failures)])
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+async def serve_shared(req: ChatRequest, request: Request, source: AsyncIterator[str], chat_id: str, created_time: int,
+                       deadline: float, account_name: Callable[[], str], sse_window: float = 0.0):
+    """输出回复文本 (合并请求订阅的生成、缓存的回复或开启分片合并的流式请求)，按本请求的 stream 设置渲染
+
+    account_name 在回复完成后调用，取得实际完成生成的账户 (故障转移后会变化)。
+    """
+    try:
+        if req.stream:
+            stream = render_chunks(source, ChunkRenderer(chat_id, created_time, req.model), sse_window)
+            first_chunk = await run_cancellable(request, stream.__anext__(), deadline - time.monotonic())
+            return CancellableStreamingResponse(prepend_chunk(first_chunk, stream), deadline, media_type="text/event-stream")
+
+        async def collect() -> str:
+            try:
+                return "".join([text async for text in source])
+            finally:
+                await source.aclose()
+
+        content = await run_cancellable(request, collect(), deadline - time.monotonic())
+    except ClientDisconnected:
+        logger.info("🔌 客户端已断开，停止输出共享的回复")
+        return Response(status_code=499)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Request deadline exceeded")
+
+    await CHAT_ID_TO_ACCOUNT.aset(chat_id, account_name())
+    return {
+        "id": chat_id,
+        "object": "chat.completion",
+        "created": created_time,
+        "model": req.model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": calculate_usage(req.messages, content)
+    }
+
 @app.post("/v1/chat/completions")
-async def chat(req: ChatRequest):
+async def chat(request: Request, authorization: Optional[str] = Header(None), cache_control: Optional[str] = Header(None),
+               x_sse_coalesce_window: Optional[str] = Header(None)):
+    request_deadline = time.monotonic() + REQUEST_TIMEOUT_SECONDS
+
+    # 边接收请求体边提取 base64 图片，JSON 解析与校验只处理去掉图片数据后的部分
+    req, inline_images = await read_chat_request(request)
+    sse_window = get_sse_window(req, x_sse_coalesce_window)
+
     # 1. 模型校验
     if req.model not in MODEL_MAPPING:
         raise HTTPException(status_code=404, detail=f"Model '{req.model}' not found.")
 
-    # 2. 获取对话指纹
-    conv_key = get_conversation_key([msg.dict() for msg in req.messages])
+    # 2. 获取对话指纹 (包含调用方标识，避免不同租户使用相同系统提示词时串用同一个 Session)
+    tenant = get_caller_identity(req, authorization)
+
+    # 相同的纯文本请求：命中响应缓存直接返回，已有相同请求在进行中则共享其生成；
+    # 客户端发送 Cache-Control: no-cache / no-store 时总是重新生成
+    coalesce_key = None
+    no_cache = any(d in (cache_control or "").lower() for d in ("no-cache", "no-store"))
+    if (REQUEST_COALESCING or RESPONSE_CACHE_ENABLED) and not no_cache and not has_images(req):
+        coalesce_key = request_key(req, tenant)
+        cached_response = RESPONSE_CACHE.get(coalesce_key) if RESPONSE_CACHE_ENABLED else None
+        flight = COALESCER.get(coalesce_key) if REQUEST_COALESCING and not cached_response else None
+        if cached_response or flight:
+            if cached_response:
+                logger.info(f"💾 命中响应缓存 [{req.model}]")
+                source, account_name = replay(cached_response["pieces"]), lambda: cached_response["account"]
+            else:
+                source, account_name = COALESCER.join(flight), lambda: flight.account
+            return await serve_shared(
+                req, request, source, f"chatcmpl-{uuid.uuid4()}", int(time.time()),
+                request_deadline, account_name, sse_window,
+            )
+    conv_key = f"{tenant}:{get_conversation_key([msg.dict() for msg in req.messages])}"
     
-    # 3. 检查 Session 缓存
-    cached_session = SESSION_CACHE.get(conv_key)
+    # 3. 检查 Session 缓存 (过期由缓存自身处理)
+    cached_session = await SESSION_CACHE.aget(conv_key)
     google_session = None
     account = None
+    messages_to_send = req.messages
+    session_files = {}
+    saved_files = []
     
     if cached_session:
-        # 检查缓存是否过期 (5分钟)
-        if time.time() - cached_session["updated_at"] < 300:
+        # 只发送 Session 尚未见过的新轮次；历史分叉时改用新 Session
+        unseen = get_unseen_messages(
+            req.messages, cached_session.get("sent_count", 0), cached_session.get("history_hash", ""), cached_session.get("reply_hash", ""),
+        )
+        if unseen is None:
+            logger.info("⚠️ 对话历史与缓存 Session 不一致，开启新 Session")
+        else:
             google_session = cached_session["session_id"]
             account_name = cached_session["account"]
-            account = next((a for a in accounts if a.name == account_name), None)
-            if account:
-                logger.info(f"🔄 使用缓存 Session: {google_session} 账户: {account.name}")
+            account = scheduler.get(account_name)
+            messages_to_send = unseen
+            session_files = cached_session.get("file_ids", {})
+            saved_files = cached_session.get("saved_files", [])
+            if account and not scheduler.is_healthy(account):
+                logger.info(f"⚡ 账户 {account.name} 当前不可用，开启新 Session")
+                account = None
+            elif account:
+                logger.info(f"🔄 使用缓存 Session: {google_session} 账户: {account.name} (增量发送 {len(unseen)} 条消息)")
     
-    # 4. 如果没有缓存或过期，选择账户并创建新 Session
-    if not google_session or not account:
-        # 选择账户 (负载均衡 - 轮询)
-        global last_account_index
-        last_account_index = (last_account_index + 1) % len(accounts)
-        account = accounts[last_account_index]
+    chat_id = f"chatcmpl-{uuid.uuid4()}"
+    created_time = int(time.time())
+    # 记录本请求各阶段耗时 (由请求派生的任务，如图片下载，也计入其中)
+    timings = begin_request(chat_id, req.model, req.stream)
+
+    # 4. 准入控制：取得账户并发名额 (缓存 Session 所在账户优先)，所有账户都已满载时按调用方公平排队
+    preferred = account if google_session else None
+    try:
+        with stage("queue_wait"):
+            account, slot_start = await run_cancellable(request, ADMISSION.acquire(tenant, preferred), request_deadline - time.monotonic())
+    except ClientDisconnected:
+        timings.finish(499)
+        return Response(status_code=499)
+    except asyncio.TimeoutError:
+        timings.finish(504)
+        raise HTTPException(status_code=504, detail="Request deadline exceeded")
+    except HTTPException as e:
+        timings.finish(e.status_code)
+        raise
+    timings.account = account.name
+
+    # 如果没有缓存、缓存账户不可用或已满载，在选中的账户上稍后创建新 Session
+    if account is not preferred:
+        if preferred is not None:
+            logger.info(f"⚡ 账户 {preferred.name} 已满载，开启新 Session")
+        google_session = None
+        messages_to_send = req.messages
+        session_files = {}
+        saved_files = []
         logger.info(f"🆕 开启新对话 [{req.model}] 使用账户: {account.name}")
-        
-        # 创建新 Session
-        google_session = await create_google_session(account)
-        
-        # 更新缓存
-        SESSION_CACHE[conv_key] = {
-            "session_id": google_session,
-            "updated_at": time.time(),
-            "account": account.name
-        }
 
-    # 5. 解析请求内容
-    last_text, current_images = await parse_last_message(req.messages)
+    # 5. 解析请求内容 (远程图片下载在后台进行，与 Session 创建并行)
+    images_task = asyncio.ensure_future(parse_last_message(req.messages, inline_images))
     
-    # 新对话使用全量文本上下文 (图片只传当前的)
-    text_to_send = build_full_context_text(req.messages)
+    # 新 Session 使用全量文本上下文，复用 Session 只发送新增轮次 (图片只传当前的)
+    text_to_send = build_full_context_text(messages_to_send)
 
-    chat_id = f"chatcmpl-{uuid.uuid4()}"
-    created_time = int(time.time())
+    # 流式请求输出预渲染的 SSE 分片；非流式请求直接收集回复文本，无需序列化后再解析。
+    # 可合并的请求由共享的生成任务输出回复文本，各订阅者再按自己的 stream 设置渲染；
+    # 开启分片合并的流式请求同样先输出文本，合并后再渲染
+    renderer = ChunkRenderer(chat_id, created_time, req.model) if req.stream and coalesce_key is None and not sse_window else None
 
     # 封装生成器 (含图片上传和重试逻辑)
-    async def response_wrapper(session: str, acc: Account):
+    async def generate_response(session: str, acc: Account, text: str, uploaded: dict, saved: list):
         # 图片 ID 列表 (每次 Session 变化都需要重新上传，因为 fileId 绑定在 Session 上)
         file_ids = []
         
-        # 如果有图片，先上传
+        # 如果有图片，先并发上传 (该 Session 已上传过的相同图片直接复用 fileId)
+        # 对冲时两个尝试共享同一个下载任务，落败方被取消时不能连带取消它
+        _, current_images = await asyncio.shield(images_task)
         if current_images:
-            for img in current_images:
-                fid = await upload_context_file(acc, session, img["mime"], img["data"])
-                file_ids.append(fid)
+            file_ids = await upload_context_files(acc, session, current_images, uploaded)
 
         # 发起对话
+        stream_result = {}
         async for chunk in stream_chat_generator(
             acc,
             session, 
-            text_to_send, 
+            text, 
             file_ids, 
             req.model, 
-            chat_id, 
-            created_time, 
-            req.stream
+            renderer,
+            stream_result
         ):
-            print(f"DEBUG: Yielding from generator: {chunk}")
             yield chunk
 
-        # 在文本生成后，检查是否有AI生成的图片
-        ai_files = await list_session_files(acc, session)
-        if ai_files:
-            for i, file_meta in enumerate(ai_files):
-                try:
-                    chat_image = await save_generated_image(
-                        acc, session, file_meta["fileId"], 
-                        file_meta.get("fileName"), file_meta.get("mimeType", "image/png"), 
-                        chat_id, i+1
-                    )
-                    # 产生图像描述chunk
-                    image_content = f"\n\n![generated image]({chat_image.url})"
-                    chunk = create_chunk(chat_id, created_time, req.model, {"content": image_content}, None)
-                    print(f"DEBUG: Yielding image content chunk: {chunk}")
-                    yield f"data: {chunk}\n\n"
-                except Exception as e:
-                    logger.error(f"保存图片失败: {e}")
+        # 在文本生成后，仅当回复中出现生成的文件时才查询 AI 生成的图片；
+        # 已在之前轮次保存过的文件不再重复下载
+        if stream_result.get("has_generated_files") or not DETECT_GENERATED_FILES:
+            ai_files = await list_session_files(acc, session)
+            new_files = [f for f in ai_files if f.get("fileId") not in saved]
+            for chat_image in await save_generated_images(acc, session, new_files, chat_id):
+                # 产生图像描述chunk
+                image_content = f"\n\n![generated image]({chat_image.url})"
+                logger.debug(f"Yielding image content: {image_content}")
+                stream_result.setdefault("reply", []).append(image_content)
+                yield renderer.content(image_content) if renderer else image_content
+            saved.extend(f["fileId"] for f in new_files if f.get("fileId"))
+
+        # 记录 Session 已见过的历史，下一轮只需发送新增消息
+        await SESSION_CACHE.aset(conv_key, {
+            "session_id": session,
+            "updated_at": time.time(),
+            "account": acc.name,
+            "sent_count": len(req.messages),
+            "history_hash": get_history_hash(req.messages),
+            # 客户端下一轮回传的 assistant 消息须与本次回复一致，否则改用新 Session
+            "reply_hash": get_reply_hash("".join(stream_result.get("reply", []))),
+            "file_ids": uploaded,
+            "saved_files": saved
+        })
 
         # 流结束
-        print("DEBUG: Yielding [DONE]")
-        yield "data: [DONE]\n\n"
+        if renderer:
+            yield "data: [DONE]\n\n"
 
-    if req.stream:
-        return StreamingResponse(response_wrapper(google_session, account), media_type="text/event-stream")
-    
-    full_content = ""
-    async for chunk_str in response_wrapper(google_session, account):
-        if chunk_str.startswith("data: [DONE]"): break
-        if chunk_str.startswith("data: "):
+    async def open_stream(acc: Account, slot: float, session: Optional[str], text: str, uploaded: dict, saved: list):
+        """在 acc 上发起一次尝试 (Session 为 None 时从预热池取)，取出首段回复后返回
+        (账户, 开始时间, 已上传文件, 已保存文件, Session, 是否新 Session, 生成器, 已取出的分片)"""
+        attempt_start = time.perf_counter()
+        created = session is None
+        if created:
+            # 从预热池取 Session (池为空时当场创建)，与图片下载并行
+            with stage("acquire_session", acc.name):
+                session = await acquire_session(acc)
+        gen = generate_response(session, acc, text, uploaded, saved)
+        head = []
+        try:
+            async for chunk in gen:
+                head.append(chunk)
+                # 流式请求的 role 分片在上游确认成功时就会输出，需等到首段内容
+                if renderer is None or chunk is not renderer.role_chunk:
+                    break
+        except BaseException:
+            await gen.aclose()
+            raise
+        seconds = time.perf_counter() - attempt_start
+        HEDGER.observe(acc.name, seconds)
+        observe_stage("first_token", acc.name, seconds)
+        return acc, slot, uploaded, saved, session, created, gen, head
+
+    def start_hedge(exclude: set):
+        """选一个有空闲名额的健康账户，新建 Session 发起相同的请求；无法对冲时返回 None"""
+        try:
+            # 有请求在排队时不占用名额对冲
+            acc = scheduler.try_pick(exclude=exclude) if not len(ADMISSION) else None
+        except HTTPException:
+            acc = None
+        if acc is None:
+            HEDGER.skipped["no_account"] += 1
+            return None
+        if not HEDGER.try_budget():
+            return None
+        hedge_start = scheduler.begin(acc)
+
+        async def run():
             try:
-                data = json.loads(chunk_str[6:])
-                delta = data["choices"][0]["delta"]
-                if "content" in delta: full_content += delta["content"]
-            except: pass
+                return await open_stream(acc, hedge_start, None, build_full_context_text(req.messages), {}, [])
+            except BaseException as e:
+                scheduler.end(acc, hedge_start, error_status(e))
+                raise
+
+        return run()
+
+    async def discard_stream(result) -> None:
+        """关闭未被采用的尝试；对冲账户的名额在此归还，原账户的名额由 response_wrapper 归还"""
+        acc, slot, *_, gen, _ = result
+        await gen.aclose()
+        if acc is not account:
+            scheduler.end(acc, slot, 499)
+
+    # 账户调度与故障转移：向客户端输出任何数据之前，可重试的上游错误会换一个账户、
+    # 新建 Session 并重新上传图片后重试；请求结束时释放账户在途计数并反馈结果
+    wrapper_started = False
+
+    async def response_wrapper():
+        nonlocal account, google_session, session_files, saved_files, wrapper_started
+        wrapper_started = True
+        start, text = slot_start, text_to_send
+        tried = set()
+        attempt = 0
+        deadline = time.monotonic() + RETRY_DEADLINE_SECONDS
+        RETRY_STATS.requests += 1
+        request_status = 200
+        try:
+            while True:
+                tried.add(account.name)
+                status = None
+                yielded = False
+                try:
+                    primary = open_stream(account, start, google_session, text, session_files, saved_files)
+                    delay = HEDGER.delay(account.name)
+                    if delay is None:
+                        result = await primary
+                    else:
+                        # 首 token 超过对冲延迟仍未到达时，在另一个账户上并行发起相同请求，采用先到的一方
+                        hedge_won, result, primary_error = await HEDGER.race(primary, lambda: start_hedge(tried), delay, discard_stream)
+                        if hedge_won:
+                            scheduler.end(account, start, error_status(primary_error) if primary_error else 499)
+                            logger.info(f"🪁 对冲请求胜出，改用账户 {result[0].name}")
+                    account, start, session_files, saved_files, session, created, gen, head = result
+                    tried.add(account.name)
+                    timings.account = account.name
+                    if created:
+                        # 新 Session 在回复完成后才写入缓存：回复中途失败时 Session 中已有部分上下文，不能再复用
+                        google_session = session
+
+                    try:
+                        for chunk in head:
+                            yielded = True
+                            yield chunk
+                        async for chunk in gen:
+                            yield chunk
+                    finally:
+                        await gen.aclose()
+                    if attempt:
+                        RETRY_STATS.recovered += 1
+                    return
+                except BaseException as e:
+                    status = error_status(e)
+                    if yielded or not should_retry(e, attempt, deadline):
+                        RETRY_STATS.record_failure(e)
+                        raise
+                    last_error = e
+                finally:
+                    scheduler.end(account, start, status)
+
+                try:
+                    next_account = scheduler.pick(exclude=tried)
+                except HTTPException:
+                    RETRY_STATS.record_failure(last_error)
+                    raise last_error
+                attempt += 1
+                RETRY_STATS.record_retry(status)
+                logger.warning(f"🔁 账户 {account.name} 请求失败 ({status})，切换到账户 {next_account.name} 重试 (第 {attempt} 次)")
+                account, google_session, session_files, saved_files = next_account, None, {}, []
+                timings.account = account.name
+                text = build_full_context_text(req.messages)
+                start = scheduler.begin(account)
+        except BaseException as e:
+            request_status = error_status(e)
+            raise
+        finally:
+            if not images_task.done():
+                images_task.cancel()
+            close_inline_images(inline_images)
+            timings.finish(request_status)
+
+    async def collect_content() -> str:
+        return "".join([text async for text in response_wrapper()])
+
+    # 客户端断开或超过请求截止时间时取消上游工作，并释放账户在途计数
+    try:
+        if coalesce_key is not None:
+            # 本请求与之后合并进来的相同请求都订阅同一个生成任务；所有订阅者离开时才取消上游请求
+            flight = COALESCER.start(coalesce_key, response_wrapper(), timings, cacheable=RESPONSE_CACHE_ENABLED)
+            return await serve_shared(req, request, flight.subscribe(), chat_id, created_time, request_deadline, lambda: flight.account, sse_window)
+
+        if sse_window:
+            return await serve_shared(req, request, response_wrapper(), chat_id, created_time, request_deadline, lambda: timings.account, sse_window)
+
+        if req.stream:
+            stream = response_wrapper()
+            # 预先取出首个分片：在此之前的失败 (含重试耗尽) 仍以正常的 HTTP 错误返回给客户端
+            first_chunk = await run_cancellable(request, stream.__anext__(), request_deadline - time.monotonic())
+            return CancellableStreamingResponse(prepend_chunk(first_chunk, stream), request_deadline, media_type="text/event-stream")
 
-    # 返回完整内容
-    content = full_content
+        # 返回完整内容
+        content = await run_cancellable(request, collect_content(), request_deadline - time.monotonic())
+    except ClientDisconnected:
+        logger.info(f"🔌 客户端已断开，取消上游请求 账户: {account.name}")
+        return Response(status_code=499)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Request deadline exceeded")
+    finally:
+        if not wrapper_started:
+            # 生成器在启动前就被取消时，其中的 finally 不会执行，需要在这里释放在途计数
+            scheduler.end(account, slot_start, 499)
+            close_inline_images(inline_images)
+            timings.finish(499)
 
-    CHAT_ID_TO_ACCOUNT[chat_id] = account.name
+    await CHAT_ID_TO_ACCOUNT.aset(chat_id, account.name)
     
-    # 计算usage
-    usage = calculate_usage(text_to_send, content)
+    # 计算usage (prompt 按完整对话计算，与是否增量发送无关)
+    usage = calculate_usage(req.messages, content)
     
     return {
         "id": chat_id,
@@ -0,0 +1,204 @@
+import time
+import json
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import logger
+
+# 延迟直方图的桶边界 (秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    """样本值的文本格式：整数原样输出 (不能用 %g，超过 6 位有效数字会被舍入)，浮点数保留完整精度"""
+    if isinstance(value, int) or (isinstance(value, float) and value.is_integer()):
+        return str(int(value))
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签: [各桶计数..., +Inf 计数], 总和
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        item = self._values.get(label_values)
+        if item is None:
+            item = self._values[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = item
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="%g"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            cumulative += counts[-1]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+# 采集时由回调生成的指标: 回调返回 [(标签值, 数值), ...]
+GaugeCallback = Callable[[], Iterable[Tuple[Tuple[str, ...], float]]]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List = []
+        self._collectors: List[Tuple[str, str, str, Tuple[str, ...], GaugeCallback]] = []
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, name: str, help: str, kind: str, labels: Tuple[str, ...], callback: GaugeCallback) -> None:
+        """注册采集时计算的指标 (如缓存命中数、账户在途请求数)，kind 为 gauge 或 counter"""
+        self._collectors.append((name, help, kind, labels, callback))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, help, kind, labels, callback in self._collectors:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            try:
+                for label_values, value in callback():
+                    lines.append(f"{name}{_labels(labels, label_values)} {_format_value(value)}")
+            except Exception as e:
+                logger.error(f"❌ 采集指标 {name} 失败: {e}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+STAGE_DURATION = REGISTRY.histogram(
+    "gateway_stage_duration_seconds", "各阶段耗时 (jwt_refresh、create_session、image_upload、stream_ttfb 等)",
+    ("stage", "account", "model"),
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "gateway_stage_errors_total", "各阶段失败次数", ("stage", "account", "model"),
+)
+REQUEST_DURATION = REGISTRY.histogram(
+    "gateway_request_duration_seconds", "请求总耗时 (流式请求含完整输出)", ("model", "account", "stream", "status"),
+)
+REQUESTS = REGISTRY.counter(
+    "gateway_requests_total", "请求数", ("model", "account", "stream", "status"),
+)
+
+# ---------- 单个请求的耗时明细 ----------
+
+class RequestTimings:
+    """单个请求各阶段的耗时明细，请求结束时以一行 JSON 记录到日志"""
+
+    def __init__(self, chat_id: str, model: str, stream: bool):
+        self.chat_id = chat_id
+        self.model = model
+        self.stream = stream
+        self.account = ""
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.finished = False
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def finish(self, status: int) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        total = time.perf_counter() - self.start
+        labels = (self.model, self.account, "true" if self.stream else "false", str(status))
+        REQUEST_DURATION.observe(total, *labels)
+        REQUESTS.inc(*labels)
+        logger.info("⏱️ " + json.dumps({
+            "chat_id": self.chat_id,
+            "model": self.model,
+            "account": self.account,
+            "stream": self.stream,
+            "status": status,
+            "total": round(total, 4),
+            "stages": {k: round(v, 4) for k, v in self.stages.items()},
+        }, ensure_ascii=False))
+
+_current_request: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar("request_timings", default=None)
+
+def begin_request(chat_id: str, model: str, stream: bool) -> RequestTimings:
+    """为当前请求开始记录耗时；由请求派生的任务会继承同一个 RequestTimings"""
+    timings = RequestTimings(chat_id, model, stream)
+    _current_request.set(timings)
+    return timings
+
+def detach_request() -> None:
+    """后台任务 (如预热 Session) 可能从请求中派生，调用后其耗时不再计入该请求"""
+    _current_request.set(None)
+
+def observe_stage(stage: str, account: str, seconds: float, failed: bool = False) -> None:
+    timings = _current_request.get()
+    model = timings.model if timings else ""
+    STAGE_DURATION.observe(seconds, stage, account, model)
+    if failed:
+        STAGE_ERRORS.inc(stage, account, model)
+    if timings:
+        timings.add(stage, seconds)
+
+@contextmanager
+def stage(name: str, account: str = ""):
+    """记录一个阶段的耗时 (异常时同时计入失败次数)，标签中的模型取自当前请求"""
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        observe_stage(name, account, time.perf_counter() - start, failed)
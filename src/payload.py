@@ -0,0 +1,290 @@
+import re
+import asyncio
+import hashlib
+import tempfile
+import threading
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+
+from config import MAX_REQUEST_BYTES, REQUEST_SPOOL_THRESHOLD
+from models import ChatRequest
+from utils import json_dumps, json_loads
+
+# 提取出的图片在请求 JSON 中替换为 "{INLINE_IMAGE_PREFIX}{序号}"
+INLINE_IMAGE_PREFIX = "gemini-inline-image:"
+_MARKER = b'"data:image/'
+_BASE64 = b";base64,"
+# data URI 头部 ("data:image/xxx;base64,") 的最大长度，超出则视为普通字符串
+_MAX_HEADER = 128
+_CHUNK_SIZE = 64 * 1024
+# JSON 字符串中的转义符与结束引号
+_STRING_SPECIAL = re.compile(rb'[\\"]')
+
+class InlineImage:
+    """从请求体中提取出的 base64 图片数据
+
+    提取时边接收边写入内存缓冲区，同时计算内容摘要 (与对 base64 文本计算 sha256 一致)。
+    缓冲区超过 REQUEST_SPOOL_THRESHOLD 后由 spool() 在线程中转存到临时文件，之后每累计一批写入一次，
+    上传时同样在线程中分块读出，直接写入请求体；文件读写都不阻塞事件循环。
+    """
+
+    def __init__(self, mime: str):
+        self.mime = mime
+        self.size = 0
+        self._sha = hashlib.sha256()
+        # 尚未转存的数据 (未转存的图片即全部数据)
+        self._buffer: Optional[bytearray] = bytearray()
+        self._file = None
+        # 对冲时两个尝试可能同时在线程中读取同一个文件
+        self._file_lock = threading.Lock()
+        self.digest = ""
+
+    def write(self, data: bytes) -> None:
+        self._sha.update(data)
+        self.size += len(data)
+        self._buffer += data
+
+    async def spool(self, final: bool = False) -> None:
+        """缓冲区超过 REQUEST_SPOOL_THRESHOLD 时转存到临时文件；final 为 True 时写入已转存图片的剩余数据"""
+        pending = len(self._buffer) if self._buffer is not None else 0
+        if not pending or (pending <= REQUEST_SPOOL_THRESHOLD and not (final and self._file is not None)):
+            return
+        data, self._buffer = self._buffer, bytearray()
+        await asyncio.get_running_loop().run_in_executor(None, self._write_file, data)
+
+    def _write_file(self, data: bytes) -> None:
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="gemini-upload-")
+        self._file.write(data)
+
+    def read(self) -> bytes:
+        """已写入的全部数据"""
+        if self._file is None:
+            return bytes(self._buffer)
+        self._file.seek(0)
+        return self._file.read() + bytes(self._buffer)
+
+    def finish(self) -> None:
+        self.digest = self._sha.hexdigest()
+        if self._file is None:
+            self._buffer = bytes(self._buffer)
+
+    def _read_at(self, offset: int, size: int) -> bytes:
+        # 每次读取前定位，同一张图片的多次上传 (如换账户重试) 互不影响
+        with self._file_lock:
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    async def chunks(self, chunk_size: int = _CHUNK_SIZE) -> AsyncIterator[bytes]:
+        if self._file is None:
+            view = memoryview(self._buffer)
+            for offset in range(0, len(view), chunk_size):
+                yield view[offset:offset + chunk_size]
+            return
+        loop = asyncio.get_running_loop()
+        offset = 0
+        while offset < self.size:
+            data = await loop.run_in_executor(None, self._read_at, offset, chunk_size)
+            if not data:
+                break
+            offset += len(data)
+            yield data
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        self._buffer = None
+
+class BodyExtractor:
+    """边接收请求体边提取其中的 base64 图片 (data:image/...;base64,...)
+
+    图片数据写入 InlineImage，请求 JSON 中只留下 "gemini-inline-image:N" 占位符，
+    因此多 MB 的图片数据不会再经过 JSON 解析、Pydantic 校验与正则匹配。
+    data URI 头部含转义或图片数据中出现 "\/" 以外的转义时不再提取，该字段原样交回 JSON 解析。
+    """
+
+    def __init__(self):
+        self.json = bytearray()
+        self.images: List[InlineImage] = []
+        self._tail = b""
+        self._image: Optional[InlineImage] = None
+        # 当前图片的 data URI 头部 ("data:image/xxx")
+        self._header = b""
+        # 正在原样复制交回 JSON 解析的字符串
+        self._in_string = False
+
+    def feed(self, chunk: bytes) -> None:
+        buf = self._tail + chunk if self._tail else chunk
+        self._tail = b""
+        pos = 0
+        while pos < len(buf):
+            if self._in_string:
+                # 原样复制到结束引号 (跳过转义的字符)
+                i = pos
+                while True:
+                    match = _STRING_SPECIAL.search(buf, i)
+                    if match is None:
+                        self.json += buf[pos:]
+                        return
+                    i = match.start()
+                    if buf[i] == 0x22:
+                        break
+                    if i + 1 == len(buf):
+                        # 转义符被分到下一块，留待下次处理
+                        self.json += buf[pos:i]
+                        self._tail = buf[i:]
+                        return
+                    i += 2
+                self.json += buf[pos:i + 1]
+                self._in_string = False
+                pos = i + 1
+                continue
+
+            if self._image is not None:
+                end = buf.find(b'"', pos)
+                data = buf[pos:] if end < 0 else buf[pos:end]
+                if b"\\" in data:
+                    # JSON 中的 "/" 可能被转义为 "\/"；块末尾的转义符留待下次处理
+                    cleaned = data.replace(b"\\/", b"/")
+                    pending = end < 0 and cleaned.endswith(b"\\")
+                    if b"\\" in (cleaned[:-1] if pending else cleaned):
+                        # 其他转义 (如折行的 "\n"、"\u002b")：放弃提取，该字段交回 JSON 解析
+                        self._restore_string()
+                        continue
+                    if pending:
+                        self._tail, cleaned = b"\\", cleaned[:-1]
+                    data = cleaned
+                if data:
+                    self._image.write(data)
+                if end < 0:
+                    return
+                self._image.finish()
+                self._image = None
+                pos = end + 1
+                continue
+
+            start = buf.find(_MARKER, pos)
+            if start < 0:
+                # 标记可能被分到下一块，保留末尾不完整的部分
+                keep = len(_MARKER) - 1
+                cut = max(pos, len(buf) - keep)
+                self.json += buf[pos:cut]
+                self._tail = buf[cut:]
+                return
+            self.json += buf[pos:start]
+            pos = start
+            header_end = buf.find(_BASE64, start, start + _MAX_HEADER)
+            if header_end < 0 and len(buf) - start < _MAX_HEADER:
+                # 头部可能被分到下一块
+                self._tail = buf[start:]
+                return
+            header = buf[start + 1:header_end]
+            if header_end < 0 or b'"' in header or b"\\" in header or not self._after_url_key():
+                # 不是 image_url 中的 base64 图片，或头部含转义 (如 "image/svg\u002bxml")，按普通字符串保留交给 JSON 解析
+                self.json += _MARKER
+                pos = start + len(_MARKER)
+                continue
+            mime = buf[start + 6:header_end].decode("ascii", "replace")
+            self._header = header
+            self.json += b'"%s%d"' % (INLINE_IMAGE_PREFIX.encode(), len(self.images))
+            self._image = InlineImage(mime)
+            self.images.append(self._image)
+            pos = header_end + len(_BASE64)
+
+    def _restore_string(self) -> None:
+        """将当前图片还原为 JSON 中的字符串 (替换占位符)，之后的数据原样复制"""
+        image = self.images.pop()
+        placeholder = b'"%s%d"' % (INLINE_IMAGE_PREFIX.encode(), len(self.images))
+        del self.json[-len(placeholder):]
+        self.json += b'"' + self._header + _BASE64 + image.read()
+        image.close()
+        self._image = None
+        self._in_string = True
+
+    def _after_url_key(self) -> bool:
+        """已输出的 JSON 是否以 "url": 结尾 (只提取 image_url.url 字段的值)"""
+        head = bytes(self.json[-64:]).rstrip()
+        return head.endswith(b":") and head[:-1].rstrip().endswith(b'"url"')
+
+    async def spool(self, final: bool = False) -> None:
+        """将超过 REQUEST_SPOOL_THRESHOLD 的图片数据转存到临时文件 (final 为 True 时写入全部剩余数据)"""
+        for image in self.images:
+            await image.spool(final)
+
+    def close(self) -> None:
+        if self._image is not None:
+            raise HTTPException(status_code=400, detail="Unterminated image data")
+        self.json += self._tail
+        self._tail = b""
+
+async def read_chat_request(request: Request) -> Tuple[ChatRequest, List[InlineImage]]:
+    """读取并校验对话请求；请求体超过 MAX_REQUEST_BYTES 时返回 413"""
+    length = request.headers.get("content-length")
+    if MAX_REQUEST_BYTES and length and length.isdigit() and int(length) > MAX_REQUEST_BYTES:
+        raise HTTPException(status_code=413, detail="Request body too large")
+
+    extractor = BodyExtractor()
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if MAX_REQUEST_BYTES and received > MAX_REQUEST_BYTES:
+                raise HTTPException(status_code=413, detail="Request body too large")
+            extractor.feed(chunk)
+            await extractor.spool()
+        extractor.close()
+        await extractor.spool(final=True)
+        try:
+            data = json_loads(bytes(extractor.json))
+        except ValueError as e:
+            raise RequestValidationError([{"type": "json_invalid", "loc": ("body",), "msg": f"JSON decode error: {e}", "input": {}}])
+        try:
+            req = ChatRequest.model_validate(data)
+        except ValidationError as e:
+            raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors()])
+    except BaseException:
+        close_inline_images(extractor.images)
+        raise
+    return req, extractor.images
+
+def resolve_inline_image(url: str, images: List[InlineImage]) -> Optional[InlineImage]:
+    """将占位符还原为提取出的图片，不是占位符时返回 None"""
+    if not url.startswith(INLINE_IMAGE_PREFIX):
+        return None
+    index = url[len(INLINE_IMAGE_PREFIX):]
+    if not index.isdigit() or int(index) >= len(images):
+        return None
+    return images[int(index)]
+
+def close_inline_images(images: List[InlineImage]) -> None:
+    for image in images:
+        image.close()
+
+ImageData = Union[str, InlineImage]
+
+def image_digest(data: ImageData) -> str:
+    """图片内容摘要 (对 base64 内容计算)"""
+    if isinstance(data, InlineImage):
+        return data.digest
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def inline_image_body(body: Dict, path: Tuple[str, ...], data: InlineImage) -> Tuple[int, AsyncIterator[bytes]]:
+    """构造 body 的 JSON 请求体，path 指向的字段写入图片的 base64 内容 (分块流式输出)，返回 (长度, 分块迭代器)"""
+    placeholder = "\x00inline-image\x00"
+    node = body
+    for key in path[:-1]:
+        node = node[key]
+    node[path[-1]] = placeholder
+    encoded = json_dumps(body)
+    prefix, suffix = encoded.split(json_dumps(placeholder)[1:-1], 1)
+
+    async def stream() -> AsyncIterator[bytes]:
+        yield prefix
+        async for chunk in data.chunks():
+            yield chunk
+        yield suffix
+
+    return len(prefix) + data.size + len(suffix), stream()
@@ -0,0 +1,119 @@
+import time
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Tuple
+
+from config import logger, SESSION_POOL_SIZE, SESSION_POOL_MAX_AGE, SESSION_POOL_INTERVAL
+from auth import Account, accounts
+from session import create_google_session
+from metrics import detach_request
+
+class SessionPool:
+    """单个账户的预热 Session 池：后台保持 depth 个可用的新 Session，取用时无需等待创建"""
+
+    def __init__(self, account: Account, depth: int, max_age: float):
+        self.account = account
+        self.depth = depth
+        self.max_age = max_age
+        self._ready: Deque[Tuple[float, str]] = deque()
+        self._refill_task = None
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.discarded = 0
+        self.failures = 0
+
+    def discard_stale(self) -> None:
+        deadline = time.time() - self.max_age
+        while self._ready and self._ready[0][0] <= deadline:
+            self._ready.popleft()
+            self.discarded += 1
+
+    async def acquire(self) -> str:
+        """取出一个预热好的 Session；池为空时当场创建"""
+        self.discard_stale()
+        if self._ready:
+            _, session_name = self._ready.pop()
+            self.hits += 1
+        else:
+            self.misses += 1
+            session_name = None
+        self.schedule_refill()
+        if session_name is None:
+            session_name = await create_google_session(self.account)
+        return session_name
+
+    def items(self) -> List[Tuple[float, str]]:
+        """池中的 Session (创建时间, Session 名称)"""
+        return list(self._ready)
+
+    def restore(self, items: Iterable[Tuple[float, str]]) -> int:
+        """恢复 items() 格式的 Session (跳过过旧的)，返回恢复数量"""
+        before = len(self._ready)
+        self._ready.extend(sorted(items)[-self.depth:] if self.depth > 0 else [])
+        self.discard_stale()
+        return len(self._ready) - before
+
+    def schedule_refill(self) -> None:
+        if self.depth <= 0:
+            return
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self) -> None:
+        # 补池任务由请求触发，但其耗时不属于该请求
+        detach_request()
+        while len(self._ready) < self.depth:
+            try:
+                session_name = await create_google_session(self.account)
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"⚠️ 账户 {self.account.name} 预热 Session 失败: {e}")
+                return
+            self._ready.append((time.time(), session_name))
+            self.created += 1
+        logger.debug(f"🔥 账户 {self.account.name} Session 池已补满 ({len(self._ready)})")
+
+    def stats(self) -> dict:
+        self.discard_stale()
+        return {
+            "ready": len(self._ready),
+            "depth": self.depth,
+            "hits": self.hits,
+            "misses": self.misses,
+            "created": self.created,
+            "discarded": self.discarded,
+            "failures": self.failures,
+        }
+
+# ---------- 全局 Session 池 ----------
+SESSION_POOLS: Dict[str, SessionPool] = {}
+
+def get_pool(account: Account) -> SessionPool:
+    pool = SESSION_POOLS.get(account.name)
+    if pool is None or pool.account is not account:
+        pool = SessionPool(account, SESSION_POOL_SIZE, SESSION_POOL_MAX_AGE)
+        SESSION_POOLS[account.name] = pool
+    return pool
+
+def prune_pools() -> None:
+    """丢弃已移除或已更换凭据的账户的 Session 池 (账户列表重新加载后调用)"""
+    current = {acc.name: acc for acc in accounts}
+    for name, pool in list(SESSION_POOLS.items()):
+        if current.get(name) is not pool.account:
+            del SESSION_POOLS[name]
+
+async def acquire_session(account: Account) -> str:
+    return await get_pool(account).acquire()
+
+async def run_pool_maintainer(interval: float = SESSION_POOL_INTERVAL) -> None:
+    """后台定期丢弃过旧的 Session 并补满各账户的池"""
+    while True:
+        for account in list(accounts):
+            pool = get_pool(account)
+            pool.discard_stale()
+            pool.schedule_refill()
+        await asyncio.sleep(interval)
+
+def pool_stats() -> Dict[str, dict]:
+    return {name: pool.stats() for name, pool in SESSION_POOLS.items()}
@@ -0,0 +1,166 @@
+import os
+import time
+import asyncio
+from typing import Any, Callable, Dict, List, Optional
+
+from config import logger, APP_CONFIG_PATH, CONFIG_WATCH_INTERVAL, REQUEST_TIMEOUT_SECONDS, app_config, read_app_config
+from auth import Account, accounts, accounts_config_path, read_accounts, start_jwt_refreshers
+from cache import SESSION_CACHE, CHAT_ID_TO_ACCOUNT
+from scheduler import scheduler, POLICIES
+from admission import ADMISSION
+from hedge import HEDGER
+from pool import prune_pools
+from clients import close_account_client
+
+def _set_policy(policy: str) -> None:
+    if policy not in POLICIES:
+        raise ValueError(f"未知调度策略 {policy}")
+    scheduler.policy = policy
+
+# 可在运行中生效的 app.json 配置项: 键 -> 应用新值的函数；其余配置项变化后需重启才能生效
+HOT_SETTINGS: Dict[str, Callable[[Any], None]] = {
+    "log_level": lambda v: logger.setLevel(str(v).upper()),
+    "scheduler_policy": _set_policy,
+    "admission_queue_size": lambda v: setattr(ADMISSION, "max_queue", v),
+    "admission_queue_timeout": lambda v: setattr(ADMISSION, "timeout", v),
+    "session_cache_size": lambda v: setattr(SESSION_CACHE, "max_size", v),
+    "session_ttl": lambda v: setattr(SESSION_CACHE, "ttl", v),
+    "chat_id_cache_size": lambda v: setattr(CHAT_ID_TO_ACCOUNT, "max_size", v),
+    "chat_id_ttl": lambda v: setattr(CHAT_ID_TO_ACCOUNT, "ttl", v),
+    "hedging": lambda v: setattr(HEDGER, "enabled", v),
+    "hedge_quantile": lambda v: setattr(HEDGER, "quantile", v),
+    "hedge_min_delay": lambda v: setattr(HEDGER, "min_delay", v),
+    "hedge_max_per_second": lambda v: setattr(HEDGER, "max_per_second", v),
+    "hedge_min_samples": lambda v: setattr(HEDGER, "min_samples", v),
+}
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class ConfigReloader:
+    """不重启进程重新加载账户配置与 app.json
+
+    两个文件都读取并校验成功后才开始应用，任一失败时保持原有配置不变。账户按名称比较：
+    未变化的账户保留原有对象 (JWT、调度统计、Session 池都不受影响)，新增的账户加入调度，
+    更换了凭据的账户换用新对象，被移除的账户不再接收新请求，在途请求结束后关闭其连接池。
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._app_config = dict(app_config)
+        self._mtimes = self._current_mtimes()
+        self.reloads = 0
+        self.failures = 0
+        self.last_reload_at = 0.0
+        self.last_error: Optional[str] = None
+        self.last_result: Optional[dict] = None
+        self._drain_tasks: Dict[str, asyncio.Task] = {}
+
+    def _current_mtimes(self) -> Dict[str, Optional[int]]:
+        return {path: _mtime(path) for path in (accounts_config_path(), str(APP_CONFIG_PATH))}
+
+    async def reload(self, reason: str = "manual") -> dict:
+        async with self._lock:
+            self._mtimes = self._current_mtimes()
+            try:
+                new_accounts = read_accounts(accounts_config_path())
+                new_app_config = read_app_config()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                logger.error(f"❌ 重新加载配置失败 ({reason})，保持原有配置: {e}")
+                raise
+
+            result = {"reason": reason, "accounts": self._apply_accounts(new_accounts), "app_config": self._apply_app_config(new_app_config)}
+            self.reloads += 1
+            self.last_reload_at = time.time()
+            self.last_error = None
+            self.last_result = result
+            logger.info(f"🔄 配置已重新加载 ({reason}): {result['accounts']}")
+            return result
+
+    def _apply_accounts(self, new_accounts: List[Account]) -> Dict[str, List[str]]:
+        current = {acc.name: acc for acc in accounts}
+        merged, diff = [], {"added": [], "updated": [], "removed": [], "unchanged": []}
+        for acc in new_accounts:
+            old = current.get(acc.name)
+            if old is None:
+                diff["added"].append(acc.name)
+            elif old.signature == acc.signature:
+                # 配置未变化：保留原对象与其 JWT
+                acc = old
+                diff["unchanged"].append(acc.name)
+            else:
+                diff["updated"].append(acc.name)
+            merged.append(acc)
+
+        # 原地替换，各模块引用的 accounts 列表随之更新
+        accounts[:] = merged
+        diff["removed"] = scheduler.set_accounts(accounts)
+        start_jwt_refreshers()
+        prune_pools()
+        for name in diff["removed"]:
+            if name not in self._drain_tasks:
+                self._drain_tasks[name] = asyncio.create_task(self._drain(name))
+        # 新增的账户带来了空闲名额，放行排队中的请求
+        ADMISSION.dispatch()
+        return diff
+
+    async def _drain(self, name: str) -> None:
+        """等待被移除账户的在途请求结束后关闭其连接池 (最多等待一个请求的截止时间)"""
+        try:
+            deadline = time.monotonic() + REQUEST_TIMEOUT_SECONDS
+            while scheduler.is_draining(name) and time.monotonic() < deadline:
+                await asyncio.sleep(1.0)
+            if scheduler.get(name) is None:
+                await close_account_client(name)
+                logger.info(f"👋 账户 {name} 已移除，在途请求已结束")
+        finally:
+            self._drain_tasks.pop(name, None)
+
+    def _apply_app_config(self, new_config: dict) -> Dict[str, List[str]]:
+        changed = sorted(k for k in set(self._app_config) | set(new_config) if self._app_config.get(k) != new_config.get(k))
+        applied, restart_required, failed = [], [], []
+        for key in changed:
+            setter = HOT_SETTINGS.get(key)
+            if setter is None or key not in new_config:
+                restart_required.append(key)
+                continue
+            try:
+                setter(new_config[key])
+            except Exception as e:
+                logger.warning(f"⚠️ 配置项 {key} 未能应用: {e}")
+                failed.append(key)
+                continue
+            self._app_config[key] = new_config[key]
+            applied.append(key)
+        if restart_required:
+            logger.warning(f"⚠️ 以下配置项需重启后生效: {', '.join(restart_required)}")
+        return {"applied": applied, "restart_required": restart_required, "failed": failed}
+
+    async def run_watcher(self, interval: float = CONFIG_WATCH_INTERVAL) -> None:
+        """定期检查配置文件的修改时间，变化时重新加载"""
+        while True:
+            await asyncio.sleep(interval)
+            if self._current_mtimes() == self._mtimes:
+                continue
+            try:
+                await self.reload("file_changed")
+            except Exception:
+                # 失败已在 reload 中记录，保持原有配置，等待文件再次修改
+                continue
+
+    def stats(self) -> dict:
+        return {
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_reload_age": round(time.time() - self.last_reload_at, 1) if self.last_reload_at else None,
+            "last_error": self.last_error,
+            "last_result": self.last_result,
+            "draining": sorted(self._drain_tasks),
+        }
+
+RELOADER = ConfigReloader()
@@ -0,0 +1,57 @@
+import time
+import asyncio
+from typing import Dict, Optional
+
+import httpx
+from fastapi import HTTPException
+
+from config import RETRY_MAX_ATTEMPTS
+
+# 可以换账户重试的上游状态码：限流、超时与服务端错误
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+def is_retryable(e: BaseException) -> bool:
+    """判断上游错误是否可换账户重试；客户端错误 (4xx) 与客户端断开视为不可重试"""
+    if isinstance(e, HTTPException):
+        return e.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(e, httpx.TransportError)
+
+def should_retry(e: BaseException, attempt: int, deadline: float) -> bool:
+    return attempt < RETRY_MAX_ATTEMPTS and time.monotonic() < deadline and is_retryable(e)
+
+class RetryStats:
+    """故障转移重试计数"""
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.recovered = 0
+        self.unrecovered = 0
+        self.fatal = 0
+        self.retries_by_status: Dict[str, int] = {}
+
+    def record_retry(self, status: Optional[int]) -> None:
+        self.retries += 1
+        key = str(status)
+        self.retries_by_status[key] = self.retries_by_status.get(key, 0) + 1
+
+    def record_failure(self, e: BaseException) -> None:
+        """请求最终失败：可重试错误 (次数耗尽或已开始输出) 计入 unrecovered，其余计入 fatal"""
+        if isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+            return
+        if is_retryable(e):
+            self.unrecovered += 1
+        else:
+            self.fatal += 1
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "recovered": self.recovered,
+            "unrecovered": self.unrecovered,
+            "fatal": self.fatal,
+            "retries_by_status": dict(self.retries_by_status),
+        }
+
+RETRY_STATS = RetryStats()
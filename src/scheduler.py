@@ -0,0 +1,257 @@
+import time
+import random
+import asyncio
+from typing import Callable, Dict, Iterable, List, Optional
+
+from fastapi import HTTPException
+
+from config import (
+    logger, SCHEDULER_POLICY, ACCOUNT_MAX_CONCURRENCY, EWMA_ALPHA,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN_SECONDS, STATE_SYNC_INTERVAL,
+)
+from auth import Account, accounts
+from state import STATE_STORE
+
+class AccountState:
+    """单个账户的调度状态：在途请求数、EWMA 延迟/错误率、熔断状态"""
+
+    def __init__(self, account: Account):
+        self.account = account
+        self.in_flight = 0
+        self.ewma_latency = 0.0
+        self.ewma_error_rate = 0.0
+        self.total = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self.last_status: Optional[int] = None
+        # 其他 worker 的在途请求数与熔断截止时间 (共享状态后端定期同步)
+        self.peer_in_flight = 0
+        self.peer_circuit_open_until = 0.0
+
+    @property
+    def load(self) -> int:
+        """所有 worker 合计的在途请求数"""
+        return self.in_flight + self.peer_in_flight
+
+    def circuit_open(self, now: float) -> bool:
+        return now < max(self.circuit_open_until, self.peer_circuit_open_until)
+
+    def jwt_failing(self) -> bool:
+        mgr = self.account.jwt_mgr
+        return mgr.consecutive_failures > 0 and time.time() >= mgr.expires
+
+    def healthy(self, now: float) -> bool:
+        return not self.circuit_open(now) and not self.jwt_failing()
+
+    def has_capacity(self) -> bool:
+        return ACCOUNT_MAX_CONCURRENCY <= 0 or self.load < ACCOUNT_MAX_CONCURRENCY
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            "in_flight": self.in_flight,
+            "peer_in_flight": self.peer_in_flight,
+            "ewma_latency": round(self.ewma_latency, 4),
+            "ewma_error_rate": round(self.ewma_error_rate, 4),
+            "total": self.total,
+            "errors": self.errors,
+            "circuit_open": self.circuit_open(now),
+            "circuit_remaining": round(max(0.0, self.circuit_open_until - now, self.peer_circuit_open_until - now), 1),
+            "jwt_failing": self.jwt_failing(),
+            "last_status": self.last_status,
+        }
+
+# ---------- 调度策略 ----------
+# 策略签名: (候选账户状态列表, 调度器) -> 选中的账户状态
+
+def _round_robin(candidates: List[AccountState], scheduler: "AccountScheduler") -> AccountState:
+    scheduler.rr_index = (scheduler.rr_index + 1) % len(candidates)
+    return candidates[scheduler.rr_index]
+
+def _least_in_flight(candidates: List[AccountState], scheduler: "AccountScheduler") -> AccountState:
+    return min(candidates, key=lambda s: (s.load, s.ewma_latency, random.random()))
+
+def _power_of_two(candidates: List[AccountState], scheduler: "AccountScheduler") -> AccountState:
+    if len(candidates) == 1:
+        return candidates[0]
+    a, b = random.sample(candidates, 2)
+    return min((a, b), key=lambda s: (s.load, s.ewma_latency))
+
+POLICIES: Dict[str, Callable[[List[AccountState], "AccountScheduler"], AccountState]] = {
+    "round_robin": _round_robin,
+    "least_in_flight": _least_in_flight,
+    "p2c": _power_of_two,
+}
+
+class AccountScheduler:
+    def __init__(self, account_list: Iterable[Account], policy: str = "p2c"):
+        if policy not in POLICIES:
+            logger.warning(f"⚠️ 未知调度策略 {policy}，使用 p2c")
+            policy = "p2c"
+        self.policy = policy
+        self.rr_index = -1
+        self._states: Dict[str, AccountState] = {}
+        # 已从配置中移除、仍有在途请求的账户 (请求结束时归还名额，不再参与调度)
+        self._draining: Dict[str, AccountState] = {}
+        # 账户名额释放时的回调 (由准入控制注册)
+        self.on_release: Optional[Callable[[], None]] = None
+        self.set_accounts(account_list)
+
+    def set_accounts(self, account_list: Iterable[Account]) -> List[str]:
+        """按名称重建账户索引，已存在账户的调度状态保留，返回被移除的账户名
+
+        同名账户更换为新对象 (如更换了 cookie) 时统计与熔断状态重新开始，在途计数延续，
+        旧请求结束时按名称归还名额。被移除且仍有在途请求的账户转入排空状态。
+        """
+        states = {}
+        for acc in account_list:
+            previous = self._states.get(acc.name) or self._draining.pop(acc.name, None)
+            state = previous
+            if state is None or state.account is not acc:
+                state = AccountState(acc)
+                if previous is not None:
+                    state.in_flight = previous.in_flight
+            states[acc.name] = state
+        removed = [name for name in self._states if name not in states]
+        for name in removed:
+            if self._states[name].in_flight:
+                self._draining[name] = self._states[name]
+        self._states = states
+        return removed
+
+    def is_draining(self, name: str) -> bool:
+        return name in self._draining
+
+    def get(self, name: str) -> Optional[Account]:
+        state = self._states.get(name)
+        return state.account if state else None
+
+    def state(self, account: Account) -> Optional[AccountState]:
+        return self._states.get(account.name)
+
+    def is_healthy(self, account: Account) -> bool:
+        state = self._states.get(account.name)
+        return state is not None and state.healthy(time.time())
+
+    def pick(self, exclude: Iterable[str] = ()) -> Account:
+        """按策略选出一个健康且未达并发上限的账户"""
+        account = self.try_pick(exclude)
+        if account is None:
+            raise HTTPException(status_code=503, detail="No available account")
+        return account
+
+    def try_pick(self, exclude: Iterable[str] = (), preferred: Optional[Account] = None) -> Optional[Account]:
+        """与 pick 相同，但健康账户的并发名额都已占满时返回 None (由准入控制排队等待)
+
+        preferred (如缓存 Session 所在账户) 健康且有名额时优先选中；没有任何健康账户时抛出 503。
+        """
+        now = time.time()
+        if preferred is not None:
+            state = self._states.get(preferred.name)
+            if state is not None and state.healthy(now) and state.has_capacity():
+                return preferred
+        excluded = set(exclude)
+        healthy = [s for name, s in self._states.items() if name not in excluded and s.healthy(now)]
+        if not healthy:
+            raise HTTPException(status_code=503, detail="No available account")
+        candidates = [s for s in healthy if s.has_capacity()]
+        if not candidates:
+            return None
+        return POLICIES[self.policy](candidates, self).account
+
+    def capacity(self) -> int:
+        """健康账户的并发名额总数，0 表示不限制"""
+        if ACCOUNT_MAX_CONCURRENCY <= 0:
+            return 0
+        now = time.time()
+        return ACCOUNT_MAX_CONCURRENCY * sum(1 for s in self._states.values() if s.healthy(now))
+
+    def mean_latency(self) -> float:
+        """各账户 EWMA 延迟的平均值 (尚无数据时为 0)"""
+        latencies = [s.ewma_latency for s in self._states.values() if s.ewma_latency > 0]
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    def begin(self, account: Account) -> float:
+        state = self._states.get(account.name)
+        if state:
+            state.in_flight += 1
+        return time.perf_counter()
+
+    def end(self, account: Account, start: float, status: Optional[int] = None) -> None:
+        """请求结束：释放在途计数并更新延迟/错误统计
+
+        status 为 None 表示成功；429/5xx 计为账户失败；其他状态码 (如客户端错误、断开) 只释放计数。
+        """
+        state = self._states.get(account.name)
+        if state is None:
+            draining = self._draining.get(account.name)
+            if draining is not None:
+                draining.in_flight = max(0, draining.in_flight - 1)
+                if not draining.in_flight:
+                    del self._draining[account.name]
+            return
+        state.in_flight = max(0, state.in_flight - 1)
+        self._record(state, start, status)
+        if self.on_release is not None:
+            # 名额已释放 (熔断状态也已更新)，通知准入控制放行排队的请求
+            self.on_release()
+
+    def _record(self, state: AccountState, start: float, status: Optional[int]) -> None:
+        account = state.account
+        state.total += 1
+        state.last_status = status or 200
+        failed = status is not None and (status == 429 or status >= 500)
+        if status is not None and not failed:
+            return
+
+        state.ewma_error_rate = EWMA_ALPHA * (1.0 if failed else 0.0) + (1 - EWMA_ALPHA) * state.ewma_error_rate
+        if not failed:
+            latency = time.perf_counter() - start
+            state.ewma_latency = latency if state.ewma_latency == 0 else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * state.ewma_latency
+            state.consecutive_failures = 0
+            return
+
+        state.errors += 1
+        state.consecutive_failures += 1
+        # 429 说明账户已被限流，立即熔断；5xx 连续达到阈值后熔断
+        if status == 429 or state.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            state.circuit_open_until = time.time() + CIRCUIT_COOLDOWN_SECONDS
+            logger.warning(f"⚡ 账户 {account.name} 熔断 {CIRCUIT_COOLDOWN_SECONDS}s (状态码 {status}, 连续失败 {state.consecutive_failures} 次)")
+
+    async def sync_shared(self) -> None:
+        """发布本 worker 的在途计数与熔断状态，并读取其他 worker 的汇总"""
+        states = {name: (s.in_flight, s.circuit_open_until) for name, s in self._states.items()}
+        await STATE_STORE.call(STATE_STORE.publish_scheduler, states)
+        peers = await STATE_STORE.call(STATE_STORE.load_peer_scheduler, STATE_SYNC_INTERVAL * 5)
+        for name, s in self._states.items():
+            s.peer_in_flight, s.peer_circuit_open_until = peers.get(name, (0, 0.0))
+
+    async def run_state_sync(self, interval: float = STATE_SYNC_INTERVAL) -> None:
+        """后台定期与共享状态存储同步；memory 后端下不需要启动"""
+        try:
+            while True:
+                try:
+                    await self.sync_shared()
+                except Exception as e:
+                    logger.error(f"❌ 同步调度状态失败: {e}")
+                await asyncio.sleep(interval)
+        finally:
+            STATE_STORE.remove_worker()
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "accounts": {name: s.stats() for name, s in self._states.items()},
+            "draining": {name: s.in_flight for name, s in self._draining.items()},
+        }
+
+scheduler = AccountScheduler(accounts, SCHEDULER_POLICY)
+
+def error_status(e: BaseException) -> int:
+    """将异常映射为用于调度统计的状态码"""
+    if isinstance(e, HTTPException):
+        return e.status_code
+    if isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+        return 499
+    return 502
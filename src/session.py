@@ -1,14 +1,21 @@
 import uuid
 import time
-import base64
-from typing import List, Optional
+import asyncio
+from typing import Dict, List, Optional
 
 from fastapi import HTTPException
 
-from config import logger, http_client, IMAGE_SAVE_DIR, BASE_URL
+from config import logger, BASE_URL, UPSTREAM_API_BASE, UPLOAD_CONCURRENCY, IMAGE_SAVE_CONCURRENCY
 from auth import Account
 from utils import get_common_headers
 from models import ChatImage
+from storage import store_image_stream
+from clients import get_account_client
+from metrics import stage
+from payload import ImageData, InlineImage, image_digest, inline_image_body
+
+# 图片上传计数：实际上传 / 因内容重复而跳过
+UPLOAD_STATS = {"uploaded": 0, "deduplicated": 0}
 
 async def create_google_session(account: Account) -> str:
     jwt = await account.jwt_mgr.get()
@@ -22,19 +29,23 @@ async def create_google_session(account: Account) -> str:
     }
     
     logger.debug("🌐 申请新 Session...")
-    r = await http_client.post(
-        "https://biz-discoveryengine.googleapis.com/v1alpha/locations/global/widgetCreateSession",
-        headers=headers,
-        json=body,
-    )
+    with stage("create_session", account.name):
+        r = await get_account_client(account.name).post(
+            f"{UPSTREAM_API_BASE}/v1alpha/locations/global/widgetCreateSession",
+            headers=headers,
+            json=body,
+        )
     if r.status_code != 200:
         logger.error(f"❌ createSession 失败: {r.status_code} {r.text}")
         raise HTTPException(r.status_code, "createSession failed")
     sess_name = r.json()["session"]["name"]
     return sess_name
 
-async def upload_context_file(account: Account, session_name: str, mime_type: str, base64_content: str) -> str:
-    """上传文件到指定 Session，返回 fileId"""
+async def upload_context_file(account: Account, session_name: str, mime_type: str, base64_content: ImageData) -> str:
+    """上传文件到指定 Session，返回 fileId
+
+    base64_content 为请求体中提取出的 InlineImage 时，图片内容分块写入上传请求体，不在内存中拼接完整 JSON。
+    """
     jwt = await account.jwt_mgr.get()
     headers = get_common_headers(jwt)
     
@@ -54,11 +65,13 @@ async def upload_context_file(account: Account, session_name: str, mime_type: st
     }
 
     logger.info(f"上传图片 [{mime_type}] 到 Session...")
-    r = await http_client.post(
-        "https://biz-discoveryengine.googleapis.com/v1alpha/locations/global/widgetAddContextFile",
-        headers=headers,
-        json=body,
-    )
+    url = f"{UPSTREAM_API_BASE}/v1alpha/locations/global/widgetAddContextFile"
+    if isinstance(base64_content, InlineImage):
+        length, content = inline_image_body(body, ("addContextFileRequest", "fileContents"), base64_content)
+        headers["content-length"] = str(length)
+        r = await get_account_client(account.name).post(url, headers=headers, content=content)
+    else:
+        r = await get_account_client(account.name).post(url, headers=headers, json=body)
 
     if r.status_code != 200:
         logger.error(f"❌ 上传文件失败: {r.status_code} {r.text}")
@@ -69,6 +82,48 @@ async def upload_context_file(account: Account, session_name: str, mime_type: st
     logger.info(f"✅ 图片上传成功, ID: {file_id}")
     return file_id
 
+def get_image_digest(img: dict) -> str:
+    """图片内容摘要 (对 base64 内容计算，与对原始字节计算等价)，用于同一 Session 内的上传去重"""
+    return image_digest(img["data"])
+
+async def upload_context_files(account: Account, session_name: str, images: List[dict], uploaded: Optional[Dict[str, str]] = None) -> List[str]:
+    """并发上传多张图片 (并发数受 UPLOAD_CONCURRENCY 限制)，按输入顺序返回 fileId 列表
+
+    uploaded 为该 Session 已上传图片的 {摘要: fileId} 映射，命中的图片直接复用 fileId，新上传的图片会写回映射。
+    """
+    if uploaded is None:
+        uploaded = {}
+    sem = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def upload(img: dict, digest: str) -> str:
+        async with sem:
+            file_id = await upload_context_file(account, session_name, img["mime"], img["data"])
+        uploaded[digest] = file_id
+        return file_id
+
+    digests = []
+    tasks = {}
+    for img in images:
+        digest = get_image_digest(img)
+        digests.append(digest)
+        if digest in uploaded or digest in tasks:
+            # 该 Session 已有同样内容的图片 (或同一请求内重复)，不再上传
+            UPLOAD_STATS["deduplicated"] += 1
+        else:
+            tasks[digest] = asyncio.ensure_future(upload(img, digest))
+
+    try:
+        if tasks:
+            with stage("image_upload", account.name):
+                await asyncio.gather(*tasks.values())
+    except BaseException:
+        # 任意一张失败则取消其余上传，由上层决定是否换账户重试
+        for task in tasks.values():
+            task.cancel()
+        raise
+    UPLOAD_STATS["uploaded"] += len(tasks)
+    return [uploaded[digest] for digest in digests]
+
 async def list_session_files(account: Account, session_name: str, filter_str: str = "file_origin_type = AI_GENERATED") -> List[dict]:
     jwt = await account.jwt_mgr.get()
     headers = get_common_headers(jwt)
@@ -82,11 +137,12 @@ async def list_session_files(account: Account, session_name: str, filter_str: st
     }
     
     logger.debug("📋 列出会话文件...")
-    r = await http_client.post(
-        "https://biz-discoveryengine.googleapis.com/v1alpha/locations/global/widgetListSessionFileMetadata",
-        headers=headers,
-        json=body,
-    )
+    with stage("list_session_files", account.name):
+        r = await get_account_client(account.name).post(
+            f"{UPSTREAM_API_BASE}/v1alpha/locations/global/widgetListSessionFileMetadata",
+            headers=headers,
+            json=body,
+        )
     if r.status_code != 200:
         logger.error(f"❌ listSessionFiles 失败: {r.status_code} {r.text}")
         return []
@@ -96,15 +152,18 @@ async def list_session_files(account: Account, session_name: str, filter_str: st
     logger.info(f"✅ 找到 {len(files)} 个文件")
     return files
 
-async def download_file(account: Account, session_id: str, file_id: str) -> bytes:
-    jwt = await account.jwt_mgr.get()
+def _download_request(account: Account, session_id: str, file_id: str, jwt: str):
     headers = get_common_headers(jwt)
     headers["x-goog-encode-response-if-executable"] = "base64"
-    
-    url = f"https://biz-discoveryengine.googleapis.com/download/v1alpha/projects/{account.project_id}/locations/global/collections/default_collection/engines/agentspace-engine/sessions/{session_id}:downloadFile?fileId={file_id}&alt=media"
+    url = f"{UPSTREAM_API_BASE}/download/v1alpha/projects/{account.project_id}/locations/global/collections/default_collection/engines/agentspace-engine/sessions/{session_id}:downloadFile?fileId={file_id}&alt=media"
+    return url, headers
+
+async def download_file(account: Account, session_id: str, file_id: str) -> bytes:
+    jwt = await account.jwt_mgr.get()
+    url, headers = _download_request(account, session_id, file_id, jwt)
     
     logger.debug(f"📥 下载文件 {file_id}...")
-    r = await http_client.get(url, headers=headers)
+    r = await get_account_client(account.name).get(url, headers=headers)
     if r.status_code != 200:
         logger.error(f"❌ downloadFile 失败: {r.status_code} {r.text}")
         return b""
@@ -113,24 +172,23 @@ async def download_file(account: Account, session_id: str, file_id: str) -> byte
     return r.content
 
 async def save_generated_image(account: Account, session_name: str, file_id: str, file_name: Optional[str], mime_type: str, chat_id: str, image_index: int = 1) -> ChatImage:
-    """下载并保存生成的图片，返回本地URL"""
+    """流式下载并保存生成的图片 (边下载边解码写盘，相同内容只存一份)，返回本地URL"""
     session_id = session_name.split("/")[-1]
-    image_data = await download_file(account, session_id, file_id)
-    if not image_data:
-        raise HTTPException(500, "Failed to download image")
-    
-    # 解码base64
-    try:
-        image_bytes = base64.b64decode(image_data)
-    except Exception:
-        image_bytes = image_data  # 假设已经是bytes
-    
-    # 保存到本地
+    jwt = await account.jwt_mgr.get()
+    url, headers = _download_request(account, session_id, file_id, jwt)
     ext = mime_type.split('/')[-1] if '/' in mime_type else "png"
-    filename = f"{chat_id}_{image_index}.{ext}"
-    file_path = IMAGE_SAVE_DIR / filename
-    with open(file_path, "wb") as f:
-        f.write(image_bytes)
+
+    logger.debug(f"📥 下载文件 {file_id}...")
+    async with get_account_client(account.name).stream("GET", url, headers=headers) as r:
+        if r.status_code != 200:
+            await r.aread()
+            logger.error(f"❌ downloadFile 失败: {r.status_code} {r.text}")
+            raise HTTPException(500, "Failed to download image")
+        try:
+            filename, size = await store_image_stream(r.aiter_bytes(), ext)
+        except ValueError:
+            raise HTTPException(500, "Failed to download image")
+    logger.info(f"✅ 文件下载成功, 大小: {size} bytes")
     
     # 返回本地URL
     url = f"{BASE_URL}/images/{filename}"
@@ -138,7 +196,31 @@ async def save_generated_image(account: Account, session_name: str, file_id: str
         url=url,
         filename=filename,
         mime_type=mime_type,
-        size=len(image_bytes),
+        size=size,
         chat_id=chat_id,
         image_index=image_index
-    )
\ No newline at end of file
+    )
+
+async def save_generated_images(account: Account, session_name: str, files: List[dict], chat_id: str) -> List[ChatImage]:
+    """并发下载并保存多张生成的图片 (并发数受 IMAGE_SAVE_CONCURRENCY 限制)，按输入顺序返回成功保存的图片，失败的图片仅记录日志"""
+    sem = asyncio.Semaphore(IMAGE_SAVE_CONCURRENCY)
+
+    async def save(i: int, file_meta: dict) -> ChatImage:
+        async with sem:
+            return await save_generated_image(
+                account, session_name, file_meta["fileId"],
+                file_meta.get("fileName"), file_meta.get("mimeType", "image/png"),
+                chat_id, i + 1
+            )
+
+    if not files:
+        return []
+    with stage("save_images", account.name):
+        results = await asyncio.gather(*(save(i, f) for i, f in enumerate(files)), return_exceptions=True)
+    images = []
+    for file_meta, res in zip(files, results):
+        if isinstance(res, BaseException):
+            logger.error(f"保存图片失败 {file_meta.get('fileId')}: {res}")
+        else:
+            images.append(res)
+    return images
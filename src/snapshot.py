@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import logger, STATE_SNAPSHOT_PATH, STATE_SNAPSHOT_INTERVAL
+from state import STATE_STORE, SQLiteStore
+from cache import SESSION_CACHE, CHAT_ID_TO_ACCOUNT
+from auth import Account, accounts
+from pool import get_pool
+
+def jwt_key(account: Account) -> str:
+    """快照中 JWT 的键：账户名加凭据摘要，账户更换 cookie 或 csesidx 后不再采用旧令牌"""
+    credentials = f"{account.secure_c_ses}|{account.host_c_oses}|{account.csesidx}"
+    return f"{account.name}:{hashlib.sha256(credentials.encode()).hexdigest()[:16]}"
+
+# 预热 Session 池在快照中的命名空间：Session 名称 -> 账户名
+# 池中的 Session 取出后即归某个对话所有，因此只在正常退出时保存、恢复后立即清除，
+# 异常退出后不会把可能已分配给对话的 Session 再交给新对话
+POOL_NAMESPACE = "SESSION_POOL"
+
+class StateSnapshot:
+    """memory 状态后端的持久化：定期及退出时将 Session 缓存、chat_id 映射、预热 Session 池与各账户 JWT
+    写入 SQLite 快照
+
+    启动时恢复仍未过期的条目，重启后进行中的对话继续使用原 Session (只增量发送新轮次)，
+    各账户也不会同时请求 getoxsrf 与重新预热 Session 池。写入时先在事件循环中复制条目，再在线程中写入数据库。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.caches = (SESSION_CACHE, CHAT_ID_TO_ACCOUNT)
+        self._store: Optional[SQLiteStore] = None
+        self._lock = asyncio.Lock()
+        self.saves = 0
+        self.save_failures = 0
+        self.last_save_at = 0.0
+        self.last_save_latency = 0.0
+        self.restored: Dict[str, int] = {}
+
+    @property
+    def store(self) -> SQLiteStore:
+        if self._store is None:
+            self._store = SQLiteStore(self.path)
+        return self._store
+
+    def restore(self) -> None:
+        """恢复快照中仍有效的条目，没有快照文件时跳过"""
+        if not os.path.exists(self.path):
+            return
+        start = time.perf_counter()
+        for cache in self.caches:
+            rows = self.store.load_namespace(cache.name)
+            self.restored[cache.name] = cache.restore(
+                (key, stored_at, json.loads(value), size) for key, value, stored_at, size in rows
+            )
+        pooled: Dict[str, List[Tuple[float, str]]] = {}
+        for session_name, value, created_at, _ in self.store.load_namespace(POOL_NAMESPACE):
+            pooled.setdefault(json.loads(value), []).append((created_at, session_name))
+        self.restored[POOL_NAMESPACE] = sum(get_pool(acc).restore(pooled.get(acc.name, ())) for acc in accounts)
+        self.store.replace_namespace(POOL_NAMESPACE, [])
+        self.restored["jwt"] = sum(acc.jwt_mgr.adopt(self.store.load_jwt(jwt_key(acc))) for acc in accounts)
+        logger.info(
+            f"♻️ 已从状态快照恢复 {', '.join(f'{name} {count}' for name, count in self.restored.items())} "
+            f"({(time.perf_counter() - start) * 1000:.1f}ms)"
+        )
+
+    def _collect(self, final: bool) -> Tuple[Dict[str, List[Tuple[str, str, float, int]]], List[Tuple[str, str, float, float]]]:
+        namespaces = {
+            cache.name: [(key, json.dumps(value, ensure_ascii=False), stored_at, size) for key, stored_at, value, size in cache.items()]
+            for cache in self.caches
+        }
+        if final:
+            namespaces[POOL_NAMESPACE] = [
+                (session_name, json.dumps(acc.name), created_at, 0)
+                for acc in accounts for created_at, session_name in get_pool(acc).items()
+            ]
+        now = time.time()
+        jwts = [
+            (jwt_key(acc), acc.jwt_mgr.jwt, acc.jwt_mgr.issued_at, acc.jwt_mgr.expires)
+            for acc in accounts if acc.jwt_mgr.jwt and acc.jwt_mgr.expires > now
+        ]
+        return namespaces, jwts
+
+    def _write(self, namespaces: Dict[str, List[Tuple[str, str, float, int]]], jwts: List[Tuple[str, str, float, float]]) -> None:
+        for ns, rows in namespaces.items():
+            self.store.replace_namespace(ns, rows)
+        for row in jwts:
+            self.store.save_jwt(*row)
+
+    async def save(self, final: bool = False) -> None:
+        """写入快照；final 为 True 表示进程即将退出，此时才保存预热 Session 池"""
+        async with self._lock:
+            start = time.perf_counter()
+            namespaces, jwts = self._collect(final)
+            try:
+                await asyncio.to_thread(self._write, namespaces, jwts)
+            except Exception:
+                self.save_failures += 1
+                raise
+            self.saves += 1
+            self.last_save_at = time.time()
+            self.last_save_latency = time.perf_counter() - start
+
+    async def run(self, interval: float = STATE_SNAPSHOT_INTERVAL) -> None:
+        """后台定期写入快照"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"❌ 写入状态快照失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "interval": STATE_SNAPSHOT_INTERVAL,
+            "restored": dict(self.restored),
+            "saves": self.saves,
+            "save_failures": self.save_failures,
+            "last_save_age": round(time.time() - self.last_save_at, 1) if self.last_save_at else None,
+            "last_save_latency": round(self.last_save_latency, 4),
+        }
+
+# sqlite 状态后端的数据本身已持久化在共享存储中，不需要快照
+SNAPSHOT = StateSnapshot(str(STATE_SNAPSHOT_PATH)) if STATE_STORE is None and STATE_SNAPSHOT_PATH else None
@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from config import logger, STATE_BACKEND, STATE_DB_PATH
+
+# 当前 worker 的标识，用于区分共享存储中各进程写入的数据
+WORKER_ID = f"{os.uname().nodename}:{os.getpid()}" if hasattr(os, "uname") else str(os.getpid())
+
+# 等待其他 worker 释放写锁的上限 (秒)，超时的操作按失败处理
+BUSY_TIMEOUT = 1.0
+# 缓存命中时最多每隔该时间 (秒) 更新一次访问时间，只读的命中不必每次都取得写锁
+TOUCH_INTERVAL = 30.0
+
+T = TypeVar("T")
+
+class SQLiteStore:
+    """多个 worker 进程共享的本地状态存储 (SQLite WAL 模式)
+
+    保存 Session 缓存、chat_id 映射、各账户 JWT、调度器在途计数与熔断状态，以及用于
+    避免多个 worker 同时刷新同一账户 JWT 的租约。其他 worker 持有写锁时语句需要等待，
+    因此请求路径与后台任务通过 call() 在专用线程中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-store")
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS kv (
+                ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+                stored_at REAL NOT NULL, accessed_at REAL NOT NULL, size INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (ns, key)
+            );
+            CREATE INDEX IF NOT EXISTS kv_lru ON kv (ns, accessed_at);
+            CREATE TABLE IF NOT EXISTS jwt (
+                name TEXT PRIMARY KEY, jwt TEXT NOT NULL, issued_at REAL NOT NULL, expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY, owner TEXT NOT NULL, until REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS scheduler (
+                worker TEXT NOT NULL, account TEXT NOT NULL, in_flight INTEGER NOT NULL,
+                circuit_open_until REAL NOT NULL, updated_at REAL NOT NULL,
+                PRIMARY KEY (worker, account)
+            );
+        """)
+
+    async def call(self, fn: Callable[..., T], *args: Any) -> T:
+        """在存储专用线程中执行 fn(*args)"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def execute(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def delete(self, sql: str, params: tuple = ()) -> int:
+        """执行 DELETE 并返回删除的行数"""
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+    # ---------- JWT ----------
+    def load_jwt(self, name: str) -> Optional[Tuple[str, float, float]]:
+        rows = self.execute("SELECT jwt, issued_at, expires FROM jwt WHERE name = ?", (name,))
+        return rows[0] if rows else None
+
+    def save_jwt(self, name: str, jwt: str, issued_at: float, expires: float) -> None:
+        self.execute(
+            "INSERT INTO jwt (name, jwt, issued_at, expires) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET jwt = excluded.jwt, issued_at = excluded.issued_at, expires = excluded.expires "
+            "WHERE excluded.issued_at > jwt.issued_at",
+            (name, jwt, issued_at, expires),
+        )
+
+    def try_lease(self, name: str, ttl: float) -> bool:
+        """尝试取得 (或续期) 名为 name 的租约，持有者在 ttl 秒内独占"""
+        now = time.time()
+        self.execute(
+            "INSERT INTO leases (name, owner, until) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, until = excluded.until "
+            "WHERE leases.owner = excluded.owner OR leases.until < ?",
+            (name, WORKER_ID, now + ttl, now),
+        )
+        rows = self.execute("SELECT owner FROM leases WHERE name = ?", (name,))
+        return bool(rows) and rows[0][0] == WORKER_ID
+
+    def release_lease(self, name: str) -> None:
+        self.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, WORKER_ID))
+
+    # ---------- 调度器 ----------
+    def publish_scheduler(self, states: Dict[str, Tuple[int, float]]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM scheduler WHERE worker = ?", (WORKER_ID,))
+                self._conn.executemany(
+                    "INSERT INTO scheduler (worker, account, in_flight, circuit_open_until, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    [(WORKER_ID, name, in_flight, until, now) for name, (in_flight, until) in states.items()],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def load_peer_scheduler(self, max_age: float) -> Dict[str, Tuple[int, float]]:
+        """汇总其他 worker 的在途请求数与熔断截止时间；超过 max_age 未更新的 worker 视为已退出"""
+        rows = self.execute(
+            "SELECT account, SUM(in_flight), MAX(circuit_open_until) FROM scheduler "
+            "WHERE worker != ? AND updated_at >= ? GROUP BY account",
+            (WORKER_ID, time.time() - max_age),
+        )
+        return {account: (in_flight or 0, until or 0.0) for account, in_flight, until in rows}
+
+    # ---------- 快照 ----------
+    def replace_namespace(self, ns: str, rows: List[Tuple[str, str, float, int]]) -> None:
+        """在一个事务中以 rows (key, value, stored_at, size) 替换 ns 下的全部条目，rows 的顺序在读取时保留"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM kv WHERE ns = ?", (ns,))
+                self._conn.executemany(
+                    "INSERT INTO kv (ns, key, value, stored_at, accessed_at, size) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(ns, key, value, stored_at, now, size) for key, value, stored_at, size in rows],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def load_namespace(self, ns: str) -> List[Tuple[str, str, float, int]]:
+        """按写入顺序 (rowid) 读取 replace_namespace 保存的条目"""
+        return self.execute("SELECT key, value, stored_at, size FROM kv WHERE ns = ? ORDER BY rowid", (ns,))
+
+    def remove_worker(self) -> None:
+        self.execute("DELETE FROM scheduler WHERE worker = ?", (WORKER_ID,))
+        self.execute("DELETE FROM leases WHERE owner = ?", (WORKER_ID,))
+
+class SQLiteCache:
+    """与 TTLCache 接口一致、数据存放在 SQLiteStore 中的缓存，供多个 worker 共享
+
+    过期在读取时检查，过期条目由后台清理删除；容量上限 (LRU 按最近访问时间淘汰) 同样在后台清理时执行，
+    访问时间每 TOUCH_INTERVAL 秒最多更新一次。请求路径使用 aget()/aset() 在存储线程中读写，
+    条目数与字节数为最近一次清理时的统计。命中/未命中计数为当前 worker 的统计。
+    """
+
+    def __init__(self, name: str, store: SQLiteStore, max_size: int, ttl: float, max_bytes: int = 0):
+        self.name = name
+        self.store = store
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._count()
+
+    def _count(self) -> None:
+        self.size, self.total_bytes = self.store.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM kv WHERE ns = ?", (self.name,)
+        )[0]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, count=False) is not None
+
+    def get(self, key: str, count: bool = True) -> Optional[Any]:
+        now = time.time()
+        rows = self.store.execute("SELECT value, stored_at, accessed_at FROM kv WHERE ns = ? AND key = ?", (self.name, key))
+        if not rows or now - rows[0][1] >= self.ttl:
+            if count:
+                self.misses += 1
+            return None
+        value, _, accessed_at = rows[0]
+        if now - accessed_at >= TOUCH_INTERVAL:
+            self.store.execute("UPDATE kv SET accessed_at = ? WHERE ns = ? AND key = ?", (now, self.name, key))
+        if count:
+            self.hits += 1
+        return json.loads(value)
+
+    async def aget(self, key: str) -> Optional[Any]:
+        """在存储线程中执行 get()；等待写锁超时时按未命中处理"""
+        try:
+            return await self.store.call(self.get, key)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"⚠️ {self.name} 读取失败，按未命中处理: {e}")
+            return None
+
+    def set(self, key: str, value: Any, size: int = 0) -> None:
+        now = time.time()
+        self.store.execute(
+            "INSERT OR REPLACE INTO kv (ns, key, value, stored_at, accessed_at, size) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.name, key, json.dumps(value, ensure_ascii=False), now, now, size),
+        )
+
+    async def aset(self, key: str, value: Any, size: int = 0) -> None:
+        """在存储线程中执行 set()；等待写锁超时时放弃本次写入"""
+        try:
+            await self.store.call(self.set, key, value, size)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"⚠️ {self.name} 写入失败: {e}")
+
+    def pop(self, key: str) -> Optional[Any]:
+        value = self.get(key, count=False)
+        if value is not None:
+            self.store.execute("DELETE FROM kv WHERE ns = ? AND key = ?", (self.name, key))
+        return value
+
+    def sweep(self) -> int:
+        """清理过期条目并按 LRU 淘汰超出容量的条目，返回过期清理数量"""
+        expired = self.store.delete("DELETE FROM kv WHERE ns = ? AND stored_at <= ?", (self.name, time.time() - self.ttl))
+        self.expirations += expired
+        evicted = self.store.delete(
+            "DELETE FROM kv WHERE ns = ? AND key IN "
+            "(SELECT key FROM kv WHERE ns = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.name, self.name, self.max_size),
+        )
+        self.evictions += evicted
+        self._count()
+        return expired
+
+    async def run_sweeper(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = await self.store.call(self.sweep)
+                if removed:
+                    logger.debug(f"🧹 {self.name} 清理过期条目 {removed} 个")
+            except Exception as e:
+                logger.error(f"❌ {self.name} 清理失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "backend": "sqlite",
+            "size": self.size,
+            "max_size": self.max_size,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+def open_store() -> Optional[SQLiteStore]:
+    """按 state_backend 配置打开共享存储；memory 后端返回 None，所有状态保存在进程内"""
+    if STATE_BACKEND == "memory":
+        return None
+    if STATE_BACKEND != "sqlite":
+        logger.warning(f"⚠️ 未知状态后端 {STATE_BACKEND}，使用 memory")
+        return None
+    logger.info(f"🗄️ 使用共享状态存储: {STATE_DB_PATH}")
+    return SQLiteStore(str(STATE_DB_PATH))
+
+STATE_STORE = open_store()
@@ -0,0 +1,120 @@
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+from pathlib import Path
+from typing import AsyncIterator, Tuple
+
+from config import logger, IMAGE_SAVE_DIR, IMAGE_MAX_BYTES, IMAGE_MAX_AGE, IMAGE_JANITOR_INTERVAL
+from utils import Base64StreamDecoder
+
+# 生成图片存储计数
+STORAGE_STATS = {"stored": 0, "deduplicated": 0, "evicted": 0, "expired": 0, "files": 0, "bytes": 0}
+
+def _commit(tmp_path: Path, final_path: Path) -> bool:
+    """将临时文件落盘为内容寻址文件名；已存在相同内容时丢弃临时文件并刷新其使用时间"""
+    if final_path.exists():
+        tmp_path.unlink()
+        os.utime(final_path)
+        return False
+    os.replace(tmp_path, final_path)
+    return True
+
+async def store_image_stream(chunks: AsyncIterator[bytes], ext: str) -> Tuple[str, int]:
+    """将 (可能为 base64 编码的) 下载流边解码边写入磁盘，文件名为内容的 SHA-256，返回 (文件名, 字节数)
+
+    文件 IO 在线程池中执行，不阻塞事件循环；内存中只保留当前分片。
+    """
+    loop = asyncio.get_running_loop()
+    tmp_path = IMAGE_SAVE_DIR / f".tmp-{uuid.uuid4().hex}"
+    decoder = Base64StreamDecoder()
+    digest = hashlib.sha256()
+    size = 0
+
+    f = await loop.run_in_executor(None, open, tmp_path, "wb")
+    try:
+        async for chunk in chunks:
+            data = decoder.feed(chunk)
+            if data:
+                digest.update(data)
+                size += len(data)
+                await loop.run_in_executor(None, f.write, data)
+        data = decoder.flush()
+        if data:
+            digest.update(data)
+            size += len(data)
+            await loop.run_in_executor(None, f.write, data)
+    except BaseException:
+        await loop.run_in_executor(None, f.close)
+        await loop.run_in_executor(None, tmp_path.unlink)
+        raise
+    await loop.run_in_executor(None, f.close)
+
+    if size == 0:
+        await loop.run_in_executor(None, tmp_path.unlink)
+        raise ValueError("empty image stream")
+
+    filename = f"{digest.hexdigest()}.{ext}"
+    if await loop.run_in_executor(None, _commit, tmp_path, IMAGE_SAVE_DIR / filename):
+        STORAGE_STATS["stored"] += 1
+    else:
+        STORAGE_STATS["deduplicated"] += 1
+    return filename, size
+
+def _unlink(path: str) -> bool:
+    """删除文件；多 worker 同时清理时文件可能已被其他进程删除"""
+    try:
+        os.unlink(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def enforce_image_retention() -> None:
+    """按保留策略清理图片目录：先删除超龄文件，再按最近使用时间 (LRU) 淘汰直到总大小不超过预算"""
+    now = time.time()
+    files = []
+    for entry in os.scandir(IMAGE_SAVE_DIR):
+        if not entry.is_file():
+            continue
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        last_used = max(st.st_atime, st.st_mtime)
+        # 未完成的临时文件只清理明显遗留的
+        if entry.name.startswith(".tmp-"):
+            if now - st.st_mtime > 3600:
+                _unlink(entry.path)
+            continue
+        if IMAGE_MAX_AGE > 0 and now - last_used > IMAGE_MAX_AGE:
+            if _unlink(entry.path):
+                STORAGE_STATS["expired"] += 1
+            continue
+        files.append((last_used, st.st_size, entry.path))
+
+    total = sum(size for _, size, _ in files)
+    if IMAGE_MAX_BYTES > 0 and total > IMAGE_MAX_BYTES:
+        files.sort()
+        evicted = 0
+        for _, size, path in files:
+            if total <= IMAGE_MAX_BYTES:
+                break
+            _unlink(path)
+            total -= size
+            evicted += 1
+        files = files[evicted:]
+        STORAGE_STATS["evicted"] += evicted
+
+    STORAGE_STATS["files"] = len(files)
+    STORAGE_STATS["bytes"] = total
+
+async def run_image_janitor(interval: float = IMAGE_JANITOR_INTERVAL) -> None:
+    """后台定期执行图片保留策略"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, enforce_image_retention)
+        except Exception as e:
+            logger.error(f"❌ 清理图片目录失败: {e}")
+        await asyncio.sleep(interval)
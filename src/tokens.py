@@ -0,0 +1,68 @@
+import re
+import math
+import hashlib
+from typing import Callable, Dict, List
+
+from config import logger, TOKENIZER, IMAGE_TOKENS
+from models import Message
+from cache import TOKEN_CACHE
+from chat import format_message
+
+# 中日韩文字 (含假名、谚文与全角标点) 大多一个字符对应一个 token；按连续片段匹配比逐字符匹配快得多
+_CJK_RE = re.compile(
+    "[\u2e80-\u9fff\ua960-\ua97f\uac00-\ud7ff\uf900-\ufaff\ufe30-\ufe4f\uff00-\uffef\U00020000-\U0002ffff]+"
+)
+
+def _cjk_tokens(text: str) -> int:
+    """本地估算：中日韩文字每个字符计 1 个 token，其余 (拉丁文字、数字、符号) 约 4 个字符 1 个 token"""
+    if not text:
+        return 0
+    cjk = 0 if text.isascii() else sum(len(run) for run in _CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+def _tiktoken_backend() -> Callable[[str], int]:
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning("⚠️ 未安装 tiktoken (pip install tiktoken)，使用 cjk 分词估算")
+        return _cjk_tokens
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=())) if text else 0
+
+# 分词后端: 名称 -> 返回计数函数的工厂
+BACKENDS: Dict[str, Callable[[], Callable[[str], int]]] = {
+    "cjk": lambda: _cjk_tokens,
+    "tiktoken": _tiktoken_backend,
+}
+
+def load_backend(name: str) -> Callable[[str], int]:
+    if name not in BACKENDS:
+        logger.warning(f"⚠️ 未知分词后端 {name}，使用 cjk")
+        name = "cjk"
+    return BACKENDS[name]()
+
+count_text_tokens = load_backend(TOKENIZER)
+
+def count_message_tokens(msg: Message) -> int:
+    """单条消息的 token 数：按发送给上游的格式计算文本，每张图片另计 IMAGE_TOKENS
+
+    按消息内容摘要缓存，长对话的每次请求只需对新增轮次分词。
+    """
+    text = format_message(msg)
+    images = 0 if isinstance(msg.content, str) else sum(1 for part in msg.content if part.get("type") == "image_url")
+    key = hashlib.md5(text.encode()).hexdigest()
+    tokens = TOKEN_CACHE.get(key)
+    if tokens is None:
+        tokens = count_text_tokens(text)
+        TOKEN_CACHE.set(key, tokens)
+    return tokens + images * IMAGE_TOKENS
+
+def calculate_usage(messages: List[Message], completion: str) -> dict:
+    """计算 token 使用情况 (prompt 按完整对话计算，与是否增量发送无关)"""
+    prompt_tokens = sum(count_message_tokens(msg) for msg in messages)
+    completion_tokens = count_text_tokens(completion)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
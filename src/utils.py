@@ -1,7 +1,26 @@
+import re
 import json
 import hmac
 import hashlib
 import base64
+from typing import Any, List, Optional
+
+try:
+    import orjson  # 可选的高性能 JSON 后端: pip install orjson
+except ImportError:
+    orjson = None
+
+# 请求体序列化与上游响应解析使用 orjson (如已安装)，否则回退到标准库
+if orjson is not None:
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+else:
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+    json_loads = json.loads
+
+# 转义单个字符串为 JSON 字符串字面量 (标准库的 C 实现，短文本比 orjson 更快)
+encode_json_string = json.encoder.encode_basestring
 
 def get_common_headers(jwt: str) -> dict:
     return {
@@ -52,4 +71,91 @@ def create_jwt(key_bytes: bytes, key_id: str, csesidx: str) -> str:
     payload_b64 = kq_encode(json.dumps(payload, separators=(",", ":")))
     message     = f"{header_b64}.{payload_b64}"
     sig         = hmac.new(key_bytes, message.encode(), hashlib.sha256).digest()
-    return f"{message}.{urlsafe_b64encode(sig)}"
\ No newline at end of file
+    return f"{message}.{urlsafe_b64encode(sig)}"
+
+class JSONArrayStreamParser:
+    """增量解析流式返回的 JSON 数组，每当一个顶层元素完整到达时立即产出"""
+
+    _TOKENS = re.compile(r'["\\{}\[\]]')
+
+    def __init__(self):
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+        self._finished = False
+        self._pending: List[str] = []
+
+    def feed(self, text: str) -> List[Any]:
+        items = []
+        start = 0 if self._depth >= 2 else None
+        skip_to = 0
+        if self._escape:
+            self._escape = False
+            skip_to = 1
+
+        for m in self._TOKENS.finditer(text):
+            i = m.start()
+            if i < skip_to:
+                continue
+            ch = m.group()
+            if self._in_str:
+                if ch == "\\":
+                    skip_to = i + 2
+                    if skip_to > len(text):
+                        self._escape = True
+                elif ch == '"':
+                    self._in_str = False
+                continue
+            if ch == '"':
+                self._in_str = True
+            elif ch in "{[":
+                self._depth += 1
+                if self._depth == 2:
+                    start = i
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._finished = True
+                elif self._depth == 1 and start is not None:
+                    self._pending.append(text[start:i + 1])
+                    items.append(json_loads("".join(self._pending)))
+                    self._pending.clear()
+                    start = None
+
+        if start is not None:
+            self._pending.append(text[start:])
+        return items
+
+    def close(self) -> None:
+        """流结束时调用，若数组未闭合 (如连接中途断开) 则视为响应不完整"""
+        if not self._finished or self._pending:
+            raise ValueError("incomplete JSON array in stream")
+
+
+class Base64StreamDecoder:
+    """增量解码流式返回的 base64 数据；若首个分片不是 base64 文本则按原始字节透传"""
+
+    _B64_TEXT = re.compile(rb"[A-Za-z0-9+/=_\-\s]*")
+    _URLSAFE = bytes.maketrans(b"-_", b"+/")
+
+    def __init__(self):
+        self._buf = b""
+        self._is_b64: Optional[bool] = None
+
+    def feed(self, data: bytes) -> bytes:
+        if not data:
+            return b""
+        if self._is_b64 is None:
+            self._is_b64 = self._B64_TEXT.fullmatch(data[:1024]) is not None
+        if not self._is_b64:
+            return data
+        self._buf += data.translate(self._URLSAFE, b" \t\r\n")
+        n = len(self._buf) // 4 * 4
+        out, self._buf = self._buf[:n], self._buf[n:]
+        return base64.b64decode(out) if out else b""
+
+    def flush(self) -> bytes:
+        if not self._is_b64 or not self._buf:
+            return b""
+        out, self._buf = self._buf, b""
+        return base64.b64decode(out + b"=" * (-len(out) % 4))